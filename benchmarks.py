@@ -0,0 +1,1005 @@
+#!/usr/bin/env python3
+
+"""Compatible with Python 3.13, SOWFA 2.4.x
+Part of github.com/NotDrJeff/sowfatools
+Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
+
+Benchmarks for performance critical sowfatools functions, using synthetic data
+shaped like SOWFA output. Each benchmark also checks results against the
+reference implementation.
+
+As a script, takes a list of benchmarks to run as command line arguments.
+"""
+
+import logging
+
+import sys
+import argparse
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+import constants as const
+import utils
+import iotools
+import cache
+
+LEVEL = logging.INFO
+logger = logging.getLogger(__name__)
+
+################################################################################
+
+def _timeit(function, *args, repeat=3, **kwargs):
+    """Returns the best wall time from 'repeat' calls, and the last result"""
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def synthetic_restarts(rows, columns, restarts, overlap=0.2, seed=0):
+    """Creates a 2D array with a time column (index 0) mimicking a run which
+    was restarted 'restarts' times, each restart going back over a fraction
+    'overlap' of the previous run.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    segment_rows = rows // (restarts + 1)
+    segments = []
+    start = 0.0
+    for _ in range(restarts + 1):
+        times = start + np.arange(1, segment_rows + 1) * 0.5
+        values = rng.standard_normal((segment_rows, columns - 1))
+        segments.append(np.column_stack((times, values)))
+        start = times[int(segment_rows * (1 - overlap))]
+
+    return np.vstack(segments)
+
+
+################################################################################
+
+def _remove_overlaps_reference(data, sorting_index):
+    """Original restart-and-delete implementation of utils.remove_overlaps"""
+
+    finished = False
+    start = 1
+    while not finished:
+        for i in range(start, data.shape[0]):
+            if data[i, sorting_index] > data[i-1, sorting_index]:
+                pass
+            else:
+                diff = data[:i, sorting_index] - data[i, sorting_index]
+                diff[diff < 0] = np.inf
+                j = np.argmin(diff)
+                data = np.delete(data, np.arange(j, i), axis=0)
+                start = j
+                break
+
+        if i == data.shape[0]-1:
+            finished = True
+
+    return data
+
+
+def benchmark_remove_overlaps(rows=200_000, columns=10, restarts=20):
+    """Compares utils.remove_overlaps with the original implementation"""
+
+    logger.info(f'Benchmarking remove_overlaps: {rows:,} rows, {columns} '
+                f'columns, {restarts} restarts')
+
+    data = synthetic_restarts(rows, columns, restarts)
+
+    reference_time, reference = _timeit(_remove_overlaps_reference, data, 0,
+                                        repeat=1)
+    new_time, result = _timeit(utils.remove_overlaps, data, 0)
+
+    if not np.array_equal(reference, result):
+        logger.error('remove_overlaps result differs from reference')
+        raise AssertionError('remove_overlaps result differs from reference')
+
+    logger.info(f'  reference: {reference_time:.3f} s')
+    logger.info(f'  vectorised: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+
+
+def benchmark_read_numeric(rows=100_000, columns=152):
+    """Compares the throughput of iotools.read_numeric with np.genfromtxt and
+    np.loadtxt, for plain and compressed averaging-like files
+    """
+
+    logger.info(f'Benchmarking read_numeric: {rows:,} rows, {columns} columns')
+
+    data = synthetic_restarts(rows, columns, restarts=0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for filename in ('data', 'data.gz'):
+            filepath = Path(tmpdir) / filename
+            np.savetxt(filepath, data, fmt='%.12g', header='header')
+
+            with iotools.open_text(filepath, mode='rb') as f:
+                megabytes = len(f.read()) / 1e6
+
+            logger.info(f'  {filename}: {megabytes:.0f} MB of text')
+
+            reference = None
+            for name, function in (('genfromtxt', np.genfromtxt),
+                                   ('loadtxt', np.loadtxt),
+                                   ('read_numeric', iotools.read_numeric)):
+                elapsed, result = _timeit(function, filepath, repeat=1)
+                logger.info(f'    {name:>12}: {megabytes/elapsed:6.1f} MB/s')
+
+                if reference is None:
+                    reference = result
+                elif not np.array_equal(reference, result):
+                    logger.error(f'{name} result differs from genfromtxt')
+                    raise AssertionError(f'{name} result differs')
+
+
+def benchmark_savetxt(rows=100_000, columns=152):
+    """Compares iotools.savetxt with np.savetxt for plain and compressed
+    files, checking that the text written is identical
+    """
+
+    logger.info(f'Benchmarking savetxt: {rows:,} rows, {columns} columns')
+
+    data = synthetic_restarts(rows, columns, restarts=0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for filename in ('data', 'data.gz'):
+            reference = Path(tmpdir) / f'reference_{filename}'
+            filepath = Path(tmpdir) / filename
+
+            reference_time, _ = _timeit(np.savetxt, reference, data,
+                                        header='header', fmt='%.12g',
+                                        repeat=1)
+            new_time, _ = _timeit(iotools.savetxt, filepath, data,
+                                  header='header', fmt='%.12g', repeat=1)
+
+            with (iotools.open_text(reference, mode='rb') as f1,
+                  iotools.open_text(filepath, mode='rb') as f2):
+                if f1.read() != f2.read():
+                    logger.error('savetxt output differs from np.savetxt')
+                    raise AssertionError('savetxt output differs')
+
+            logger.info(f'  {filename}:')
+            logger.info(f'    np.savetxt: {reference_time:.2f} s, '
+                        f'{reference.stat().st_size/1e6:.0f} MB')
+            logger.info(f'    iotools.savetxt: {new_time:.2f} s, '
+                        f'{filepath.stat().st_size/1e6:.0f} MB '
+                        f'({iotools.WRITE_WORKERS} workers)')
+
+
+def benchmark_usecols(rows=50_000, heights=300):
+    """Compares reading a single height column from an averaging-like file
+    with a full parse, a parse of selected columns and the binary sidecar
+    """
+
+    logger.info(f'Benchmarking column reads: {rows:,} rows, {heights} '
+                f'heights')
+
+    data = synthetic_restarts(rows, heights + 2, restarts=0)
+    header = ' '.join(['time', 'dt'] + [f'{10*i+5}m' for i in range(heights)])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = Path(tmpdir) / 'data.gz'
+        iotools.write_blocks(filepath, [data], header=header, binary=True)
+
+        columns, _ = iotools.height_columns(filepath, [90])
+        usecols = [0, *columns]
+        reference = iotools.read_numeric(filepath)[:, usecols]
+
+        readers = {'full parse': lambda: iotools.read_numeric(filepath)
+                                         [:, usecols],
+                   'parse usecols': lambda: iotools.read_numeric(
+                                            filepath, usecols=usecols),
+                   'binary usecols': lambda: iotools.load(filepath,
+                                                          usecols=usecols)}
+
+        for name, function in readers.items():
+            elapsed, result = _timeit(function, repeat=1)
+            logger.info(f'  {name:>14}: {elapsed:.3f} s')
+
+            if not np.array_equal(reference, result):
+                logger.error(f'{name} result differs from full parse')
+                raise AssertionError(f'{name} result differs')
+
+
+def _split_groups_reference(data, group_indices, keys):
+    """Original one-mask-per-group split, with overlaps removed per group"""
+
+    groups = {}
+    for key in keys:
+        groupdata = data[np.all(data[:, group_indices] == key, axis=1)]
+        groups[key] = utils.remove_overlaps(groupdata, len(group_indices))
+
+    return groups
+
+
+def _split_groups(data, group_indices):
+    """One-pass split using iotools.sort_groups and iotools.group_runs"""
+
+    data = iotools.sort_groups(data, group_indices)
+
+    groups = {}
+    for start, end in zip(*iotools.group_runs(data, group_indices)):
+        groupdata = data[start:end]
+        groups[tuple(groupdata[0, group_indices])] = utils.remove_overlaps(
+            groupdata, len(group_indices))
+
+    return groups
+
+
+def benchmark_group_split(times=20_000, turbines=50, blades=3, samples=20,
+                          restarts=5):
+    """Compares splitting blade data by turbine and blade with one mask per
+    group against a single stable sort into contiguous runs
+    """
+
+    logger.info(f'Benchmarking group split: {times:,} times, {turbines} '
+                f'turbines, {blades} blades, {samples} samples')
+
+    # Rows ordered by time, then turbine, then blade, as in turbineOutput
+    series = synthetic_restarts(times, samples + 1, restarts)
+    turbine, blade = np.meshgrid(np.arange(turbines), np.arange(blades),
+                                 indexing='ij')
+    groups = np.column_stack((turbine.ravel(), blade.ravel()))
+    data = np.column_stack((np.tile(groups, (series.shape[0], 1)),
+                            np.repeat(series, groups.shape[0], axis=0)))
+
+    group_indices = [0, 1]
+    keys = [tuple(key) for key in groups.astype(float)]
+
+    reference_time, reference = _timeit(_split_groups_reference, data,
+                                        group_indices, keys, repeat=1)
+    new_time, result = _timeit(_split_groups, data, group_indices)
+
+    if (reference.keys() != result.keys()
+        or not all(np.array_equal(reference[key], result[key])
+                   for key in keys)):
+        logger.error('Group split result differs from reference')
+        raise AssertionError('Group split result differs from reference')
+
+    logger.info(f'  {data.shape[0]:,} rows, {len(keys)} groups')
+    logger.info(f'  one mask per group: {reference_time:.3f} s')
+    logger.info(f'  sort and runs: {new_time:.3f} s '
+                f'({reference_time/new_time:.1f}x faster)')
+
+
+def _moving_average_reference(data, val_index, weight_index):
+    """Original row-by-row implementation of utils.calculate_moving_average"""
+
+    average = np.empty_like(data[:,0])
+    weight_sum = np.empty_like(data[:,0])
+    weight_sum[0] = data[0,weight_index]
+    average[0] = data[0,val_index]*data[0,weight_index]
+    for i in range(1,average.shape[0]):
+        average[i] = (average[i-1]
+                      + data[i,val_index]*data[i,weight_index])
+        weight_sum[i] = (weight_sum[i-1]
+                         + data[i,weight_index])
+
+    return average / weight_sum
+
+
+def benchmark_running_average(rows=100_000, samples=20):
+    """Compares a dt-weighted running average of all blade samples, one column
+    at a time with the original loop and all at once with
+    utils.cumulative_average
+    """
+
+    logger.info(f'Benchmarking running average: {rows:,} rows, {samples} '
+                f'samples')
+
+    data = synthetic_restarts(rows, samples + 2, restarts=0)
+    data[:, 1] = np.random.default_rng(0).uniform(0.1, 1, rows)
+
+    def reference_average():
+        return np.column_stack([_moving_average_reference(data, i, 1)
+                                for i in range(2, data.shape[1])])
+
+    reference_time, reference = _timeit(reference_average, repeat=1)
+    new_time, result = _timeit(utils.cumulative_average, data[:, 2:],
+                               weights=data[:, 1])
+
+    if not np.array_equal(reference, result):
+        logger.error('Running average result differs from reference')
+        raise AssertionError('Running average result differs from reference')
+
+    logger.info(f'  reference: {reference_time:.3f} s')
+    logger.info(f'  vectorised: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+
+
+def _check_tolerance_reference(data, ref, tolerances):
+    """Original per-value implementation of utils.check_tolerance"""
+
+    in_tolerance = [False] * len(tolerances)
+    in_tolerance_idx = [None] * len(tolerances)
+    for i, tol in enumerate(tolerances):
+        for j, val in np.ndenumerate(data):
+            if (val < ref*(1-tol/100)) or (val > ref*(1+tol/100)):
+                if in_tolerance[i] is True:
+                    in_tolerance[i] = False
+                    in_tolerance_idx[i] = None
+            elif in_tolerance[i] is False:
+                in_tolerance[i] = True
+                in_tolerance_idx[i] = j[0]
+
+    return in_tolerance_idx
+
+
+def benchmark_convergence(rows=1_000_000, series=10,
+                          tolerances=(0.1, 0.5, 1, 2, 5)):
+    """Compares convergence indices of running averages from the original
+    loop, on one series, and from utils.convergence_indices, on all series
+    """
+
+    logger.info(f'Benchmarking convergence: {rows:,} rows, {series} series, '
+                f'{len(tolerances)} tolerances')
+
+    rng = np.random.default_rng(0)
+    data = 1 + rng.standard_normal((rows, series))
+    data[rows//2:rows//2+10, -1] = np.nan
+    averages = utils.cumulative_average(data)
+
+    reference_time, reference = _timeit(_check_tolerance_reference,
+                                        averages[:, 0], averages[-1, 0],
+                                        tolerances, repeat=1)
+    new_time, result = _timeit(utils.convergence_indices, averages,
+                               tolerances)
+
+    reference = [-1 if idx is None else idx for idx in reference]
+    if not np.array_equal(reference, result[0]):
+        logger.error('Convergence result differs from reference')
+        raise AssertionError('Convergence result differs from reference')
+
+    for i in range(1, series):
+        expected = [-1 if idx is None else idx for idx in
+                    _check_tolerance_reference(averages[::100, i],
+                                               averages[-1, i], tolerances)]
+        if not np.array_equal(expected, utils.convergence_indices(
+                averages[::100, i], tolerances, ref=averages[-1, i])):
+            logger.error('Convergence result differs from reference')
+            raise AssertionError('Convergence result differs from reference')
+
+    logger.info(f'  reference, one series: {reference_time:.3f} s')
+    logger.info(f'  vectorised, {series} series: {new_time:.3f} s '
+                f'({series*reference_time/new_time:.0f}x faster per series)')
+
+
+def _window_profiles_reference(data, starttimes, width):
+    """Original per-window implementation from precursorProfile"""
+
+    profiles = []
+    for starttime in starttimes:
+        startidx = np.argmin(np.abs(data[:,0] - starttime))
+        endidx = np.argmin(np.abs(data[:,0] - (starttime + width)))
+        profiles.append(np.average(data[startidx:endidx+1,2:], axis=0,
+                                   weights=data[startidx:endidx+1,1]))
+
+    return np.array(profiles)
+
+
+def _window_profiles(data, starttimes, width):
+    """Window averages using utils.nearest_index and utils.interval_averages"""
+
+    startidx = utils.nearest_index(data[:,0], starttimes)
+    endidx = utils.nearest_index(data[:,0], starttimes + width)
+
+    return utils.interval_averages(data[:,2:], startidx, endidx,
+                                   weights=data[:,1])
+
+
+def benchmark_window_profiles(rows=500_000, heights=50, windows=500):
+    """Compares time-averaged profiles over overlapping sliding windows, as in
+    precursorProfile offset mode, one slice at a time and from one cumulative
+    sum
+    """
+
+    logger.info(f'Benchmarking window profiles: {rows:,} rows, {heights} '
+                f'heights, {windows} windows')
+
+    data = synthetic_restarts(rows, heights + 2, restarts=0)
+    data[:, 1] = 0.5
+    data[:, 2:] += 8
+
+    width = data[-1, 0] / 10
+    starttimes = np.linspace(0, data[-1, 0] - width, windows)
+
+    reference_time, reference = _timeit(_window_profiles_reference, data,
+                                        starttimes, width, repeat=1)
+    new_time, result = _timeit(_window_profiles, data, starttimes, width)
+
+    if not np.allclose(reference, result, rtol=1e-11, atol=0):
+        logger.error('Window profiles differ from reference')
+        raise AssertionError('Window profiles differ from reference')
+
+    logger.info(f'  reference: {reference_time:.3f} s')
+    logger.info(f'  cumulative sum: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+
+
+def _integral_timescale_reference(velocity, dt):
+    """Original per-height np.correlate implementation from
+    precursorIntegralTimescale
+    """
+
+    timescales = []
+    for i in range(velocity.shape[1]):
+        R = np.correlate(velocity[:,i], velocity[:,i], mode='full')
+        R = R[R.size//2:]
+        R /= velocity.shape[0] - np.arange(R.size)
+        R /= R[0]
+
+        lag = np.arange(R.size) * dt
+        zero_idx = np.nonzero(R<=0)[0]
+        zero_idx = zero_idx[0] if len(zero_idx) > 0 else R.size
+
+        timescales.append(np.trapezoid(R[:zero_idx], lag[:zero_idx]))
+
+    return np.array(timescales)
+
+
+def _integral_timescale(velocity, dt):
+    """FFT implementation using utils.autocorrelation"""
+
+    return utils.integral_timescale(utils.autocorrelation(velocity), dt)
+
+
+def benchmark_integral_timescale(rows=50_000, heights=8):
+    """Compares integral time scales from np.correlate, one height at a time,
+    with zero-padded FFT autocorrelations of all heights at once
+    """
+
+    logger.info(f'Benchmarking integral time scale: {rows:,} rows, '
+                f'{heights} heights')
+
+    # Red noise, so that correlations decay over many samples
+    rng = np.random.default_rng(0)
+    velocity = rng.standard_normal((rows, heights))
+    for i in range(1, rows):
+        velocity[i] += 0.99 * velocity[i-1]
+    velocity -= np.mean(velocity, axis=0)
+
+    reference_time, reference = _timeit(_integral_timescale_reference,
+                                        velocity, 0.5, repeat=1)
+    new_time, result = _timeit(_integral_timescale, velocity, 0.5)
+
+    if not np.allclose(reference, result, rtol=1e-9):
+        logger.error('Integral time scales differ from reference')
+        raise AssertionError('Integral time scales differ from reference')
+
+    logger.info(f'  np.correlate: {reference_time:.3f} s')
+    logger.info(f'  FFT: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+
+
+def _welch_spectra_reference(files, dt, segment):
+    """scipy.signal.welch, one column of one file at a time, as a per-file
+    loop over turbines and blades would be written
+    """
+
+    import scipy.signal
+
+    spectra = []
+    for samples in files:
+        for i in range(samples.shape[1]):
+            _, psd = scipy.signal.welch(samples[:,i], fs=1/dt, nperseg=segment)
+            spectra.append(psd)
+
+    return np.column_stack(spectra)
+
+
+def _welch_spectra(files, dt, segment):
+    """All files stacked and transformed together with utils.welch_spectra"""
+
+    return utils.welch_spectra(np.hstack(files), dt, segment)[1]
+
+
+def benchmark_welch_spectra(rows=10_000, files=18, samples=40, segment=512):
+    """Compares Welch spectra calculated one blade sample at a time with all
+    samples of every blade file batched into one FFT
+    """
+
+    logger.info(f'Benchmarking Welch spectra: {rows:,} rows, {files} files of '
+                f'{samples} samples, segments of {segment}')
+
+    rng = np.random.default_rng(0)
+    data = [rng.standard_normal((rows, samples)) for _ in range(files)]
+
+    reference_time, reference = _timeit(_welch_spectra_reference, data, 0.01,
+                                        segment)
+    new_time, result = _timeit(_welch_spectra, data, 0.01, segment)
+
+    if not np.allclose(reference, result, rtol=1e-9):
+        logger.error('Welch spectra differ from reference')
+        raise AssertionError('Welch spectra differ from reference')
+
+    logger.info(f'  per sample: {reference_time:.3f} s')
+    logger.info(f'  batched: {new_time:.3f} s '
+                f'({reference_time/new_time:.1f}x faster)')
+
+
+def _gaussian_filter_reference(data, window):
+    """Original per-column scipy.signal.convolve loop from
+    turbineOutputFilter
+    """
+
+    import scipy.signal
+
+    kernel = scipy.signal.windows.gaussian(window, window/10)
+
+    filtered = np.empty((data.shape[0]-window+1, data.shape[1]))
+    for i in range(data.shape[1]):
+        filtered[:,i] = scipy.signal.convolve(data[:,i], kernel, mode='valid')
+    filtered /= sum(kernel)
+
+    return filtered
+
+
+def benchmark_gaussian_filter(rows=200_000, samples=60, window=1000):
+    """Compares Gaussian filtering of blade samples one column at a time with
+    overlap-add convolution of all columns at once, and when streamed in
+    blocks of rows
+    """
+
+    logger.info(f'Benchmarking Gaussian filter: {rows:,} rows, {samples} '
+                f'samples, window of {window}')
+
+    data = np.random.default_rng(0).standard_normal((rows, samples))
+
+    reference_time, reference = _timeit(_gaussian_filter_reference, data,
+                                        window)
+    new_time, result = _timeit(utils.gaussian_filter, data, window)
+    stream_time, streamed = _timeit(
+        lambda: np.concatenate(list(utils.iter_gaussian_filter(
+            iotools.row_blocks(data, 2**24), window))))
+
+    for filtered in (result, streamed):
+        if not np.allclose(reference, filtered, rtol=1e-9, atol=1e-12):
+            logger.error('Filtered data differs from reference')
+            raise AssertionError('Filtered data differs from reference')
+
+    logger.info(f'  per column: {reference_time:.3f} s')
+    logger.info(f'  overlap-add: {new_time:.3f} s '
+                f'({reference_time/new_time:.1f}x faster)')
+    logger.info(f'  streamed in 16 MiB blocks: {stream_time:.3f} s')
+
+
+def _temperature_deviation_reference(T, heights):
+    """Original per-row loops from precursorTdeviation"""
+
+    dev = np.empty(T.shape)
+    dev[0,:] = 0
+    for i in range(1, T.shape[0]):
+        dev[i,:] = (T[i,:] - T[0,:]) / T[0,:]
+    dev[1:,:] *= 100
+
+    maxdev = np.empty(T.shape[0])
+    maxheights = np.empty(T.shape[0])
+    for i in range(T.shape[0]):
+        maxidx = np.argmax(np.abs(dev[i,:]))
+        maxdev[i] = dev[i,maxidx]
+        maxheights[i] = heights[maxidx]
+
+    return maxdev, maxheights
+
+
+def _temperature_deviation(T, heights):
+    """Whole-array implementation, as applied to each streamed block"""
+
+    dev = T - T[0]
+    dev *= 100 / T[0]
+
+    maxidx = np.argmax(np.abs(dev), axis=1)
+
+    return dev[np.arange(dev.shape[0]), maxidx], heights[maxidx]
+
+
+def benchmark_temperature_deviation(rows=200_000, heights=200):
+    """Compares per-row temperature deviation and maximum deviation loops
+    with whole-array operations
+    """
+
+    logger.info(f'Benchmarking temperature deviation: {rows:,} rows, '
+                f'{heights} heights')
+
+    rng = np.random.default_rng(0)
+    T = 300 + rng.standard_normal((rows, heights))
+    z = np.linspace(5, 2000, heights)
+
+    reference_time, reference = _timeit(_temperature_deviation_reference, T,
+                                        z, repeat=1)
+    new_time, result = _timeit(_temperature_deviation, T, z)
+
+    if not (np.allclose(reference[0], result[0], rtol=1e-9)
+            and np.array_equal(reference[1], result[1])):
+        logger.error('Temperature deviation differs from reference')
+        raise AssertionError('Temperature deviation differs from reference')
+
+    logger.info(f'  per row: {reference_time:.3f} s')
+    logger.info(f'  whole array: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+
+
+def _read_openfoam_reference(readfiles):
+    """Original per-element parenthesis stripping from geostrophicWind"""
+
+    data = None
+    for readfile in readfiles:
+        rawdata = np.genfromtxt(readfile, dtype='str')
+        for i, val in np.ndenumerate(rawdata):
+            rawdata[i] = val.replace('(','').replace(')','')
+        rawdata = rawdata.astype('float')
+
+        data = rawdata if data is None else np.vstack((data, rawdata))
+
+    return utils.remove_overlaps(data, 0)
+
+
+def benchmark_read_openfoam(rows=20_000, points=20, restarts=3):
+    """Compares parsing OpenFOAM probe files of vectors in parentheses
+    element by element with removing the parentheses from the text in bulk
+    """
+
+    logger.info(f'Benchmarking OpenFOAM reader: {rows:,} rows, {points} '
+                f'vector points, {restarts} restarts')
+
+    data = synthetic_restarts(rows, 1 + 3*points, restarts)
+    starts = np.concatenate(([0], utils.find_restarts(data, 0), [rows]))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        readfiles = []
+        for i, (start, end) in enumerate(zip(starts[:-1], starts[1:])):
+            readfile = Path(tmpdir) / str(i) / 'U'
+            readfile.parent.mkdir()
+            vectors = data[start:end,1:].reshape(end-start, points, 3)
+            with open(readfile, mode='w') as f:
+                f.write('# Time\n')
+                for time, row in zip(data[start:end,0], vectors):
+                    f.write(f'{time:.12g} ' + ' '.join(
+                        f'({x:.12g} {y:.12g} {z:.12g})' for x, y, z in row)
+                        + '\n')
+            readfiles.append(readfile)
+
+        reference_time, reference = _timeit(_read_openfoam_reference,
+                                            readfiles, repeat=1)
+        new_time, (times, values) = _timeit(iotools.read_openfoam, readfiles)
+
+    result = np.column_stack((times, values.reshape(times.shape[0], -1)))
+    if not np.array_equal(reference, result):
+        logger.error('OpenFOAM data differs from reference')
+        raise AssertionError('OpenFOAM data differs from reference')
+
+    logger.info(f'  per element: {reference_time:.3f} s')
+    logger.info(f'  bulk: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+
+
+def _read_vtk_reference(filename, symbol):
+    """Original line-by-line reader and per-polygon cell centres from
+    sowfatools.read_vtk_file
+    """
+
+    with open(filename) as file:
+        surface = file.readlines()
+
+    for i, line in enumerate(surface):
+        if line.startswith('POINTS'):
+            points_start = i + 1
+        elif line.startswith('POLYGONS'):
+            points_end = i - 2
+            polygons_start = i + 1
+        elif line.startswith(symbol):
+            polygons_end = i - 3
+            vectors_start = i + 1
+
+    points = np.array([[float(j) for j in i.split()]
+                       for i in surface[points_start:points_end + 1]])
+    polygons = np.array([[int(j) for j in i.split()][1:]
+                         for i in surface[polygons_start:polygons_end + 1]])
+    vectors = np.array([[float(j) for j in i.split()]
+                        for i in surface[vectors_start:]])
+
+    cell_centres = []
+    for polygon in polygons:
+        cell = np.array([points[j, :] for j in polygon])
+        cell_centres.append(np.mean(cell, axis=0))
+
+    return np.array(cell_centres), vectors
+
+
+def _read_vtk(filename, symbol):
+    """Bulk reader from iotools"""
+
+    vtk = iotools.read_vtk(filename, fields=[symbol])
+    return iotools.vtk_cell_centres(vtk), vtk['cell_data'][symbol]
+
+
+def benchmark_read_vtk(nx=400, ny=250):
+    """Compares reading an ASCII sampled surface of quadrilateral cells line by
+    line with parsing each section in bulk, and reading it in binary
+    """
+
+    cells = nx * ny
+    logger.info(f'Benchmarking VTK reader: {cells:,} cells')
+
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.linspace(0, 3000, nx+1), np.linspace(0, 3000, ny+1))
+    points = np.column_stack((x.ravel(), y.ravel(), np.full(x.size, 90.0)))
+    i, j = np.meshgrid(np.arange(nx), np.arange(ny))
+    first = (j * (nx+1) + i).ravel()
+    polygons = np.column_stack((np.full(cells, 4), first, first+1, first+nx+2,
+                                first+nx+1))
+    vectors = rng.standard_normal((cells, 3))
+
+    header = '# vtk DataFile Version 2.0\nsampleSurface\n{}\nDATASET POLYDATA\n'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        asciifile = Path(tmpdir) / 'U_ascii.vtk'
+        with open(asciifile, mode='w') as f:
+            f.write(header.format('ASCII'))
+            f.write(f'POINTS {points.shape[0]} float\n')
+            np.savetxt(f, points, fmt='%.9g')
+            f.write(f'\nPOLYGONS {cells} {polygons.size}\n')
+            np.savetxt(f, polygons, fmt='%d')
+            f.write(f'CELL_DATA {cells}\nFIELD attributes 1\n'
+                    f'U 3 {cells} float\n')
+            np.savetxt(f, vectors, fmt='%.9g')
+
+        binaryfile = Path(tmpdir) / 'U_binary.vtk'
+        with open(binaryfile, mode='wb') as f:
+            f.write(header.format('BINARY').encode())
+            f.write(f'POINTS {points.shape[0]} double\n'.encode())
+            f.write(points.astype('>f8').tobytes() + b'\n')
+            f.write(f'POLYGONS {cells} {polygons.size}\n'.encode())
+            f.write(polygons.astype('>i4').tobytes() + b'\n')
+            f.write(f'CELL_DATA {cells}\nVECTORS U double\n'.encode())
+            f.write(vectors.astype('>f8').tobytes() + b'\n')
+
+        reference_time, reference = _timeit(_read_vtk_reference, asciifile,
+                                            'U', repeat=1)
+        new_time, result = _timeit(_read_vtk, asciifile, 'U')
+        binary_time, binary = _timeit(_read_vtk, binaryfile, 'U')
+
+    for name, (centres, values) in (('ASCII', result), ('binary', binary)):
+        if not (np.allclose(reference[0], centres, rtol=1e-12)
+                and np.allclose(reference[1], values, rtol=1e-8)):
+            logger.error(f'{name} VTK data differs from reference')
+            raise AssertionError(f'{name} VTK data differs from reference')
+
+    logger.info(f'  line by line: {reference_time:.3f} s')
+    logger.info(f'  ASCII in bulk: {new_time:.3f} s '
+                f'({reference_time/new_time:.0f}x faster)')
+    logger.info(f'  binary: {binary_time:.3f} s '
+                f'({reference_time/binary_time:.0f}x faster)')
+
+
+def _synthetic_case(casedir, rows=20_000, heights=40, turbines=6, blades=3,
+                    samples=20, seed=0):
+    """Writes raw SOWFA averaging and turbineOutput data for one case, run in
+    two time folders which overlap. Quantities have different numbers of
+    heights, so that their sizes differ.
+    """
+
+    rng = np.random.default_rng(seed)
+    quantities = {'U_mean': heights, 'V_mean': heights, 'T_mean': heights,
+                  'uu_mean': heights//2, 'uw_mean': heights//4,
+                  'Tw_mean': heights//8}
+
+    for start, end in ((0, rows*0.6), (rows*0.5, rows)):
+        times = np.arange(start, end) + 1
+
+        readdir = casedir / 'postProcessing/averaging' / f'{start:g}'
+        readdir.mkdir(parents=True)
+        np.savetxt(readdir / 'hLevelsCell', [10*np.arange(1, heights+1)],
+                   fmt='%d')
+        for quantity, columns in quantities.items():
+            data = np.column_stack((times, np.ones_like(times),
+                                    rng.standard_normal((times.shape[0],
+                                                         heights))))
+            data[:, columns+2:] = 0
+            np.savetxt(readdir / quantity, data, fmt='%.9g')
+
+        readdir = casedir / 'turbineOutput' / f'{start:g}'
+        readdir.mkdir(parents=True)
+        turbine, time_ = np.meshgrid(np.arange(turbines), times[::10])
+        data = np.column_stack((turbine.T.ravel(), time_.T.ravel(),
+                                np.ones(turbine.size),
+                                rng.standard_normal(turbine.size)))
+        np.savetxt(readdir / 'powerRotor', data, fmt='%.9g',
+                   header='Turbine    Time(s)    dt(s)    rotor power (W)',
+                   comments='#')
+
+        turbine, blade, time_ = np.meshgrid(np.arange(turbines),
+                                            np.arange(blades), times[::10],
+                                            indexing='ij')
+        data = np.column_stack((turbine.ravel(), blade.ravel(), time_.ravel(),
+                                np.ones(turbine.size),
+                                rng.standard_normal((turbine.size, samples))))
+        np.savetxt(readdir / 'Cl', data, fmt='%.9g',
+                   header='Turbine    Blade    Time(s)    dt(s)    lift '
+                   'coefficient (-)', comments='#')
+
+
+# Stitches a case with const.CASES_DIR pointing at a temporary directory
+_SHARD_SCRIPT = """
+import sys
+from pathlib import Path
+import constants
+constants.CASES_DIR = Path(sys.argv[1])
+import utils, precursorAveraging, turbineOutput
+shard = utils.parse_shard(sys.argv[3]) if len(sys.argv) > 3 else None
+precursorAveraging.precursorAveraging(sys.argv[2], shard=shard)
+turbineOutput.turbineOutput(sys.argv[2], shard=shard)
+"""
+
+
+def _outputs(casedir: Path) -> dict[str, bytes]:
+    """Returns the content of every stitched file of a case"""
+
+    sowfatoolsdir = casedir / const.SOWFATOOLS_DIR
+    return {str(path.relative_to(sowfatoolsdir)): path.read_bytes()
+            for path in sorted(sowfatoolsdir.rglob('*'))
+            if path.is_file() and path.suffix in ('.gz', '.bin')}
+
+
+def benchmark_shards(shards=3, rows=20_000):
+    """Compares stitching a case in one process with running 'shards' shards
+    of the same stitching stages as separate processes, and checks that the
+    union of the shards' outputs is identical to the serial outputs
+    """
+
+    logger.info(f'Benchmarking {shards} shards: precursorAveraging and '
+                f'turbineOutput, {rows:,} rows')
+
+    casename = 'p000'
+    command = [sys.executable, '-c', _SHARD_SCRIPT]
+    repodir = Path(__file__).resolve().parent
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        serialdir = Path(tmpdir) / 'serial'
+        sharddir = Path(tmpdir) / 'shards'
+        _synthetic_case(serialdir / casename, rows)
+        _synthetic_case(sharddir / casename, rows)
+
+        start = time.perf_counter()
+        subprocess.run([*command, serialdir, casename], cwd=repodir,
+                       check=True, capture_output=True)
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        processes = [subprocess.Popen([*command, sharddir, casename,
+                                       f'{i}/{shards}'], cwd=repodir,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+                     for i in range(1, shards+1)]
+        if any(process.wait() for process in processes):
+            raise RuntimeError('A shard failed')
+        shard_time = time.perf_counter() - start
+
+        serial = _outputs(serialdir / casename)
+        sharded = _outputs(sharddir / casename)
+
+    if serial != sharded:
+        logger.error('Union of sharded outputs differs from serial outputs')
+        raise AssertionError('Union of sharded outputs differs from serial '
+                             'outputs')
+
+    logger.info(f'  {len(serial)} identical files, '
+                f'{sum(map(len, serial.values()))/1e6:,.1f} MB')
+    logger.info(f'  serial: {serial_time:.3f} s')
+    logger.info(f'  {shards} shards: {shard_time:.3f} s '
+                f'({serial_time/shard_time:.1f}x faster)')
+
+
+def benchmark_cache(outputs=200, rows=1_000):
+    """Times checking whether outputs written with binary sidecars are up to
+    date, and checks that removing a sidecar, a new CODE_VERSION of a shared
+    module or a changed constant invalidates them, and that a changed constant
+    prevents appending to them
+    """
+
+    logger.info(f'Benchmarking fingerprint checks: {outputs} outputs')
+
+    rng = np.random.default_rng(0)
+    parameters = {'rotation': [0, 0, 330]}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        readfile = Path(tmpdir) / 'input.gz'
+        iotools.savetxt(readfile, rng.standard_normal((rows, 3)))
+
+        writefiles = [Path(tmpdir) / f'output{i}.gz' for i in range(outputs)]
+        fingerprint = cache.fingerprint([readfile], parameters,
+                                        code=[__file__])
+        for writefile in writefiles:
+            iotools.write_blocks(writefile, [rng.standard_normal((rows, 3))],
+                                 binary=True)
+            cache.record([writefile], fingerprint)
+
+        check_time, current = _timeit(
+            lambda: all(cache.is_current([writefile],
+                                         cache.fingerprint([readfile],
+                                                           parameters,
+                                                           code=[__file__]))
+                        for writefile in writefiles))
+        if not current:
+            raise AssertionError('Unchanged outputs are not up to date')
+
+        iotools.binary_paths(writefiles[0])[0].unlink()
+        if cache.is_current([writefiles[0]], fingerprint):
+            raise AssertionError('Output with a missing sidecar is up to date')
+
+        changed = cache.fingerprint([readfile], {'rotation': [0, 0, 320]},
+                                    code=[__file__])
+        if cache.is_current([writefiles[1]], changed):
+            raise AssertionError('Output is up to date after a constant '
+                                 'changed')
+        if cache.can_append([writefiles[1]], changed):
+            raise AssertionError('Output can be appended to after a constant '
+                                 'changed')
+        if not cache.can_append([writefiles[1]], fingerprint):
+            raise AssertionError('Output cannot be appended to with the same '
+                                 'parameters and code')
+
+        utils.CODE_VERSION += 1
+        try:
+            changed = cache.fingerprint([readfile], parameters,
+                                        code=[__file__])
+        finally:
+            utils.CODE_VERSION -= 1
+        if cache.is_current([writefiles[1]], changed):
+            raise AssertionError('Output is up to date after a new '
+                                 'CODE_VERSION of utils')
+
+    logger.info(f'  checked: {check_time/outputs*1e3:.3f} ms per output')
+    logger.info('  a removed sidecar, a changed constant and a new '
+                'CODE_VERSION invalidate outputs')
+
+
+################################################################################
+
+BENCHMARKS = {'overlaps': benchmark_remove_overlaps,
+              'reader': benchmark_read_numeric,
+              'writer': benchmark_savetxt,
+              'groups': benchmark_group_split,
+              'usecols': benchmark_usecols,
+              'average': benchmark_running_average,
+              'convergence': benchmark_convergence,
+              'profiles': benchmark_window_profiles,
+              'timescale': benchmark_integral_timescale,
+              'spectra': benchmark_welch_spectra,
+              'filter': benchmark_gaussian_filter,
+              'tdeviation': benchmark_temperature_deviation,
+              'openfoam': benchmark_read_openfoam,
+              'vtk': benchmark_read_vtk,
+              'shards': benchmark_shards,
+              'cache': benchmark_cache}
+
+if __name__ == '__main__':
+    utils.configure_root_logger(level=LEVEL)
+
+    DESCRIPTION = """Benchmark performance critical sowfatools functions"""
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('benchmarks', help='list of benchmarks to run',
+                        nargs='*', default=list(BENCHMARKS))
+
+    args = parser.parse_args()
+
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error(f'unknown benchmark {benchmark}. '
+                         f'Choose from {", ".join(BENCHMARKS)}')
+
+    logger.debug(f'Parsed the command line arguments: {args}')
+
+    for benchmark in args.benchmarks:
+        BENCHMARKS[benchmark]()
@@ -0,0 +1,223 @@
+"""Compatible with Python 3.13, SOWFA 2.4.x
+Part of github.com/NotDrJeff/sowfatools
+Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
+
+This module contains functions for deciding whether sowfatools output files
+are up to date. A fingerprint of the input files, parameters and code used to
+write each output is recorded beside it, and the output is only reused while
+the fingerprint matches.
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+import logging
+
+import utils
+import iotools
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_SUFFIX = '.fingerprint'
+
+# Shared modules which do most of the calculation and file handling of every
+# stage. Their CODE_VERSION is always part of the code version, so that a
+# change to any of them which alters results invalidates every output.
+SHARED_MODULES = (utils, iotools)
+
+# Also record a hash of each input file, so that an input whose modification
+# time changes without its content changing (e.g. copied or touched) does not
+# cause a recalculation
+HASH_CONTENT = False
+
+################################################################################
+
+def fingerprint_path(writefile: Path) -> Path:
+    """Returns the path of the fingerprint recorded beside an output file"""
+
+    return Path(writefile).with_suffix(FINGERPRINT_SUFFIX)
+
+
+def file_hash(filepath: Path) -> str:
+    """Returns the SHA-256 hash of the content of a file"""
+
+    with open(filepath, mode='rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def code_version(*sourcefiles) -> str:
+    """Returns a hash of the given source files, e.g. the __file__ of the
+    module which calculates an output, and the CODE_VERSION of each of
+    SHARED_MODULES
+    """
+
+    digest = hashlib.sha256()
+    for sourcefile in sourcefiles:
+        digest.update(Path(sourcefile).read_bytes())
+    for module in SHARED_MODULES:
+        digest.update(f'{module.__name__} {module.CODE_VERSION}\n'.encode())
+    return digest.hexdigest()
+
+
+def _file_stat(filepath: Path) -> dict | None:
+    """Returns the size and modification time of a file, or None if it does
+    not exist
+    """
+
+    try:
+        stat = Path(filepath).stat()
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _output_stat(writefile: Path) -> dict:
+    """Returns the size and modification time of an output file and of its
+    binary sidecar files, which downstream stages read in its place, keyed by
+    filename. Files which do not exist are None.
+    """
+
+    return {path.name: _file_stat(path)
+            for path in (Path(writefile), *iotools.binary_paths(writefile))}
+
+
+def fingerprint(readfiles, parameters=None, code=(), content=None) -> dict:
+    """Returns the fingerprint of a calculation from 'readfiles', with the
+    given parameters (anything JSON serialisable, other values are recorded
+    as strings) and source files 'code'. Constants which change the results
+    (e.g. the wind direction) should be given as parameters. Input files are
+    identified by size and modification time, and also by a hash of their
+    content when recorded if 'content' (default HASH_CONTENT) is True.
+    """
+
+    return {'inputs': {str(Path(readfile)): _file_stat(readfile)
+                       for readfile in readfiles},
+            'parameters': json.loads(json.dumps(parameters, default=str)),
+            'code': code_version(*code),
+            'content': HASH_CONTENT if content is None else content}
+
+
+def _relative_inputs(inputs: dict, writefile: Path) -> dict:
+    """Returns the inputs of a fingerprint keyed by their path relative to the
+    directory of writefile, so that a case directory may be moved
+    """
+
+    return {os.path.relpath(readfile, Path(writefile).parent): stat
+            for readfile, stat in inputs.items()}
+
+
+def _read_record(writefile: Path) -> dict | None:
+    """Returns the fingerprint recorded beside an output file, or None if there
+    is none
+    """
+
+    recordfile = fingerprint_path(writefile)
+    if not recordfile.is_file():
+        logger.debug(f'No fingerprint for {Path(writefile).name}')
+        return None
+
+    with open(recordfile) as f:
+        return json.load(f)
+
+
+def can_append(writefiles, fingerprint: dict) -> bool:
+    """Returns True if every output in writefiles was written with the same
+    parameters and code as 'fingerprint', whatever its inputs, so that rows
+    calculated now may be appended to it
+    """
+
+    for writefile in writefiles:
+        record = _read_record(writefile)
+        if (record is None
+            or record['parameters'] != fingerprint['parameters']
+            or record['code'] != fingerprint['code']):
+            return False
+
+    return True
+
+
+def is_current(writefiles, fingerprint: dict) -> bool:
+    """Returns True if every output in writefiles exists, is unchanged since it
+    was written (as are its binary sidecars), and was written from inputs,
+    parameters and code matching 'fingerprint'. An input whose modification
+    time has changed still matches if a hash of its content was recorded and
+    is unchanged.
+    """
+
+    hashes = {}
+
+    for writefile in writefiles:
+        record = _read_record(writefile)
+        if record is None:
+            return False
+
+        if _output_stat(writefile) != record['output']:
+            logger.debug(f'{Path(writefile).name} has changed')
+            return False
+
+        if (record['parameters'] != fingerprint['parameters']
+            or record['code'] != fingerprint['code']):
+            logger.debug(f'Parameters or code of {Path(writefile).name} '
+                         f'have changed')
+            return False
+
+        inputs = _relative_inputs(fingerprint['inputs'], writefile)
+        if inputs.keys() != record['inputs'].keys():
+            logger.debug(f'Inputs of {Path(writefile).name} have changed')
+            return False
+
+        for (readfile, stat), relative in zip(fingerprint['inputs'].items(),
+                                              inputs):
+            recorded = record['inputs'][relative]
+            if stat is None or recorded is None:
+                if stat != recorded:
+                    return False
+                continue
+
+            if (stat['size'] == recorded['size']
+                and stat['mtime_ns'] == recorded['mtime_ns']):
+                continue
+
+            if stat['size'] != recorded['size'] or 'sha256' not in recorded:
+                logger.debug(f'{Path(readfile).name} has changed')
+                return False
+
+            if readfile not in hashes:
+                hashes[readfile] = file_hash(readfile)
+            if hashes[readfile] != recorded['sha256']:
+                logger.debug(f'{Path(readfile).name} has changed')
+                return False
+
+    return True
+
+
+def record(writefiles, fingerprint: dict) -> None:
+    """Records the fingerprint beside each output in writefiles, once they
+    have been written. Inputs are recorded as they were when the fingerprint
+    was taken, so an input which changed during the calculation is detected
+    on the next run.
+    """
+
+    inputs = {readfile: (None if stat is None else dict(stat))
+              for readfile, stat in fingerprint['inputs'].items()}
+
+    if fingerprint['content']:
+        for readfile, stat in inputs.items():
+            if stat is not None and _file_stat(readfile) == stat:
+                stat['sha256'] = file_hash(readfile)
+
+    for writefile in writefiles:
+        output = _output_stat(writefile)
+        if output[Path(writefile).name] is None:
+            logger.debug(f'{Path(writefile).name} was not written. '
+                         f'Not recording its fingerprint.')
+            continue
+
+        with open(fingerprint_path(writefile), mode='w') as f:
+            json.dump({'output': output,
+                       'parameters': fingerprint['parameters'],
+                       'code': fingerprint['code'],
+                       'inputs': _relative_inputs(inputs, writefile)},
+                      f, indent=4)
+
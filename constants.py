@@ -22,6 +22,7 @@ TURBINEPLOT_DIR = SOWFATOOLS_DIR / 'turbinePlots'
 CONVERGENCE_DIR = SOWFATOOLS_DIR / 'convergence'
 STREAMLINES_DIR = SOWFATOOLS_DIR / 'streamLines'
 PARAVIEW_DIRECTORY = Path('postProcessing') # temporary
+MANIFEST_FILE = SOWFATOOLS_DIR / 'manifest.json'
 
 DOMAIN_HEIGHT = 1000
 DOMAIN_X = 3000
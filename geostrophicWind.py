@@ -1,58 +1,53 @@
 #!/bin/python3
 
 import logging
-import sys
-from pathlib import Path
+import argparse
 
 import numpy as np
 import numpy.core.records as rec
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 
-def main(casenames):
-    for casename in casenames:
+def main(casenames, shard=None):
+    # Each case is one unit of work, sized by its input
+    sizes = [utils.file_sizes((const.CASES_DIR / casename
+                               / 'postProcessing/geostrophicWind')
+                              .rglob('*'))
+             for casename in casenames]
+    
+    for casename in utils.shard_units(casenames, sizes, shard):
         logger.info(f'Processing geostrophic wind for case {casename}')
         
         casedir = const.CASES_DIR / casename
         outputdir = casedir / const.SOWFATOOLS_DIR
         utils.create_directory(outputdir)
-        utils.configure_logging((outputdir / f'log.{Path(__file__).stem}'),
-                                level=logging.DEBUG)
+        utils.configure_function_logger(outputdir/'log.geostrophicWind',
+                                        level=logging.DEBUG)
         
-        geodir = casedir / 'postProcessing/geostrophicWind'
-        
-        timefolders = [timefolder for timefolder in geodir.iterdir()]
-        timefolders.sort(key=lambda x: float(x.name))
+        subdirectory = 'postProcessing/geostrophicWind'
+        manifest = iotools.scan_directory(casedir, subdirectory)
+        timefolders = iotools.manifest_timefolders(casedir, subdirectory,
+                                                   manifest)
                 
         logger.info(f'Found {len(timefolders)} time folders')
-            
-        for timefolder in timefolders:
-            fname = timefolder / 'faceSource.dat.gz'
-            logger.debug(f'Reading {fname}')
-            rawdata = np.genfromtxt(fname,dtype='str')
-            for i,val in np.ndenumerate(rawdata):
-                rawdata[i] = val.replace('(','').replace(')','')
-                
-            rawdata = rawdata.astype('float')
-            
-            if 'data' in locals():
-                data = np.vstack((data,rawdata))
-            else:
-                data = np.array(rawdata)
-                
-            del rawdata
-            
-        data = utils.remove_overlaps(data,0)
         
-        dt = np.empty_like(data[:,0])
-        dt[0] = data[0,0] - np.floor(data[0,0])
-        for i in range(1,len(dt)):
-            dt[i] = data[i,0] - data[i-1,0]
+        times, U = iotools.read_openfoam([timefolder/'faceSource.dat.gz'
+                                          for timefolder in timefolders],
+                                         manifest)
+        
+        if times.size == 0:
+            logger.warning(f'No geostrophicWind data for {casename}. '
+                           f'Skipping.')
+            continue
+        
+        dt = np.diff(times, prepend=np.floor(times[0]))
         
-        data = np.insert(data,1,dt,axis=1)
+        data = np.column_stack((times, dt, U[:,0,:]))
+        del U
         
         names = ['time','dt','Ux','Uy','Uz','Umag','UAvg']
         dtype = [(name, 'float') for name in names]
@@ -60,7 +55,7 @@ def main(casenames):
         
         umag = np.linalg.norm(data[:,2:],axis=1)
         data = np.column_stack((data,umag))
-        average = utils.calculate_moving_average(data,-1,1)
+        average = utils.cumulative_average(data[:,-1],weights=data[:,1])
         finalvalue = average[-1]
         data = np.column_stack((data,average))
         
@@ -83,5 +78,15 @@ def main(casenames):
         logger.info(f'Average geostrophic wind magnitude is {finalvalue:.2f}')
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(description="""Calculate geostrophic wind
+                                                    history""")
+    
+    parser.add_argument('cases', help='list of cases to perform analysis for',
+                        nargs='+')
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
+    
+    args = parser.parse_args()
+    main(args.cases, args.shard)
     
\ No newline at end of file
@@ -0,0 +1,1566 @@
+"""Compatible with Python 3.13, SOWFA 2.4.x
+Part of github.com/NotDrJeff/sowfatools
+Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
+
+This module contains functions for reading, stitching and writing SOWFA data
+files
+"""
+
+import os
+import io
+import re
+import bisect
+import gzip
+import json
+import tempfile
+import warnings
+import collections
+import concurrent.futures
+from pathlib import Path
+import logging
+
+import numpy as np
+
+import constants as const
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Increase when a change to this module alters the data it reads or writes,
+# so that outputs written with the previous version are recalculated (see
+# cache.py)
+CODE_VERSION = 1
+
+BINARY_DTYPE = '<f8' # little-endian float64
+READ_BLOCK_SIZE = 1 << 24 # bytes of text parsed at once
+WRITE_BLOCK_VALUES = 1 << 18 # values formatted and compressed at once
+WRITE_COMPRESSLEVEL = 6
+WRITE_WORKERS = os.cpu_count() or 1
+
+_EXECUTOR = None
+
+# OpenFOAM writes vectors and tensors in parentheses, e.g. 0.5 (1 2 3)
+_PARENTHESES = bytes.maketrans(b'()', b'  ')
+_PARENTHESES_TEXT = str.maketrans('()', '  ')
+
+# Legacy VTK data types, which are big-endian in binary files
+VTK_DTYPES = {'bit': '>u1', 'char': '>i1', 'unsigned_char': '>u1',
+              'short': '>i2', 'unsigned_short': '>u2', 'int': '>i4',
+              'unsigned_int': '>u4', 'long': '>i8', 'unsigned_long': '>u8',
+              'vtkidtype': '>i4', 'vtktypeint32': '>i4',
+              'vtktypeint64': '>i8', 'float': '>f4', 'double': '>f8'}
+
+# The start of any line of a legacy VTK file which is not numeric data
+_VTK_KEYWORD = re.compile(rb'^(?![-+]?(?:nan|inf))[A-Za-z_]', re.M | re.I)
+
+################################################################################
+
+def open_text(filepath: Path, mode='rt'):
+    """Opens a text file, using gzip if the filename ends with .gz"""
+
+    if Path(filepath).suffix == '.gz':
+        return gzip.open(filepath, mode=mode)
+    else:
+        return open(filepath, mode=mode)
+
+
+def resolve_file(filepath: Path) -> Path:
+    """SOWFA may write compressed and uncompressed files in different time
+    folders of the same case. Returns whichever of 'filepath' with or without
+    the .gz suffix exists. If neither exists, 'filepath' is returned unchanged.
+    """
+
+    filepath = Path(filepath)
+    if filepath.is_file():
+        return filepath
+
+    if filepath.suffix == '.gz':
+        alternative = filepath.with_suffix('')
+    else:
+        alternative = filepath.with_name(filepath.name + '.gz')
+
+    if alternative.is_file():
+        return alternative
+
+    return filepath
+
+
+def read_first_row(filepath: Path, skip_header=0) -> np.ndarray | None:
+    """Returns the first row of numeric data in a file, ignoring comments and
+    the first 'skip_header' lines. Returns None if the file has no data.
+    """
+
+    with open_text(filepath) as f:
+        for i, line in enumerate(f):
+            if i < skip_header or line.startswith('#') or not line.strip():
+                continue
+            return np.array(line.translate(_PARENTHESES_TEXT).split(),
+                            dtype=float)
+
+    return None
+
+
+def _iter_byte_blocks(filepath: Path, block_size: int):
+    """Generator yielding large blocks of bytes from a text file (compressed
+    if the filename ends with .gz). Each block ends at a line break, and any
+    parentheses are replaced with spaces.
+    """
+
+    with open_text(filepath, mode='rb') as f:
+        remainder = b''
+        while chunk := f.read(block_size):
+            chunk = remainder + chunk
+            end = chunk.rfind(b'\n') + 1
+            remainder = chunk[end:]
+            if end:
+                yield chunk[:end].translate(_PARENTHESES)
+
+        if remainder.strip():
+            yield remainder.translate(_PARENTHESES) + b'\n'
+
+
+def iter_numeric(filepath: Path, usecols=None, max_rows=None, skip_header=0,
+                 block_size=READ_BLOCK_SIZE):
+    """Generator which parses a purely numeric, whitespace separated text file
+    (compressed or not) in large blocks, yielding a 2D array for each block.
+    Lines starting with # are ignored, as are the first 'skip_header' lines.
+    OpenFOAM vectors and tensors are flattened into separate columns.
+    Only the columns in 'usecols' are kept, and at most 'max_rows' rows are
+    read.
+    """
+
+    filepath = resolve_file(filepath)
+    rows = 0
+
+    for block in _iter_byte_blocks(filepath, block_size):
+        if max_rows is not None and rows >= max_rows:
+            break
+
+        # Each block is parsed in bulk by numpy's C parser. Unused columns are
+        # skipped without being converted.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning) # Comment-only blocks
+            values = np.loadtxt(io.BytesIO(block), comments='#',
+                                skiprows=skip_header, usecols=usecols,
+                                max_rows=None if max_rows is None
+                                         else max_rows - rows,
+                                ndmin=2)
+        skip_header = 0
+
+        if values.size == 0:
+            continue
+
+        rows += values.shape[0]
+        yield values
+
+
+def read_numeric(filepath: Path, usecols=None, max_rows=None, skip_header=0,
+                 block_size=READ_BLOCK_SIZE) -> np.ndarray:
+    """Reads a purely numeric, whitespace separated text file (compressed or
+    not) into a 2D array. A faster alternative to np.genfromtxt for SOWFA
+    output. See iter_numeric for arguments.
+    """
+
+    logger.debug(f'Reading {filepath}')
+
+    blocks = list(iter_numeric(filepath, usecols, max_rows, skip_header,
+                               block_size))
+
+    if not blocks:
+        columns = 0 if usecols is None else np.atleast_1d(usecols).size
+        return np.empty((0, columns))
+
+    return np.concatenate(blocks)
+
+
+def _is_number(name: str) -> bool:
+    try:
+        float(name)
+    except ValueError:
+        return False
+    return True
+
+
+def _read_header(filepath: Path, max_lines=10) -> tuple[str, list | None]:
+    """Returns the first line of a file and its first row of numeric data
+    (searching at most 'max_lines' lines).
+    """
+
+    header = ''
+    with open_text(filepath) as f:
+        for i, line in enumerate(f):
+            if i == 0:
+                header = line.removesuffix('\n')
+            if i >= max_lines:
+                break
+            if line.startswith('#'):
+                continue
+            try:
+                first_row = [float(value) for value
+                             in line.translate(_PARENTHESES_TEXT).split()]
+            except ValueError:
+                continue
+            if first_row:
+                return header, first_row
+
+    return header, None
+
+
+def _scan_files(directory: Path, cached_files: dict, read_headers) -> dict:
+    """Lists the files in a directory with their size and modification time.
+    Header information is only re-read for files which have changed.
+    """
+
+    files = {}
+    for file in directory.iterdir():
+        if not file.is_file():
+            continue
+
+        stat = file.stat()
+        cached = cached_files.get(file.name)
+        if (cached is not None and cached['size'] == stat.st_size
+            and cached['mtime_ns'] == stat.st_mtime_ns):
+            files[file.name] = cached
+            continue
+
+        info = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if read_headers:
+            info['header'], info['first_row'] = _read_header(file)
+        files[file.name] = info
+
+    return files
+
+
+def _load_manifest(manifestfile: Path) -> dict:
+    if not manifestfile.is_file():
+        return {}
+
+    try:
+        with open(manifestfile) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        logger.warning(f'{manifestfile} is corrupt. Rebuilding.')
+        return {}
+
+
+def _save_manifest(manifestfile: Path, manifest: dict) -> None:
+    # Written to a temporary file first, so that a partially written manifest
+    # is never read
+    manifestfile.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = manifestfile.with_name(f'{manifestfile.name}.{os.getpid()}')
+    with open(tmpfile, mode='w') as f:
+        json.dump(manifest, f)
+    os.replace(tmpfile, manifestfile)
+
+
+def scan_directory(casedir: Path, subdirectory, time_folders=True,
+                   read_headers=True) -> dict:
+    """Returns the manifest entry for 'subdirectory' of a case, e.g.
+    'postProcessing/averaging' or 'turbineOutput', which lists its time folders
+    (or, if time_folders is False, its files) along with file sizes,
+    modification times and header information. Manifests are cached per case in
+    const.MANIFEST_FILE. Only directories whose modification time has changed
+    are rescanned, along with the latest time folder, which may still be
+    written to by a running case.
+    """
+
+    manifestfile = casedir / const.MANIFEST_FILE
+    manifest = _load_manifest(manifestfile)
+
+    key = Path(subdirectory).as_posix()
+    cached = manifest.get(key, {})
+    directory = casedir / subdirectory
+    mtime_ns = directory.stat().st_mtime_ns
+
+    if not time_folders:
+        if cached.get('mtime_ns') == mtime_ns and 'files' in cached:
+            return cached
+
+        logger.debug(f'Scanning {directory}')
+        entry = {'mtime_ns': mtime_ns,
+                 'files': _scan_files(directory, cached.get('files', {}),
+                                      read_headers)}
+
+    else:
+        cached_timefolders = cached.get('timefolders', {})
+
+        if cached.get('mtime_ns') == mtime_ns and cached_timefolders:
+            names = list(cached_timefolders)
+        else:
+            logger.debug(f'Scanning {directory}')
+            names = [path.name for path in directory.iterdir()
+                     if path.is_dir() and _is_number(path.name)]
+        names.sort(key=float)
+
+        timefolders = {}
+        for i, name in enumerate(names):
+            timefolder = directory / name
+            folder_mtime_ns = timefolder.stat().st_mtime_ns
+            folder_cached = cached_timefolders.get(name, {})
+
+            if (folder_cached.get('mtime_ns') == folder_mtime_ns
+                and i != len(names) - 1):
+                timefolders[name] = folder_cached
+                continue
+
+            logger.debug(f'Scanning {timefolder}')
+            timefolders[name] = {'mtime_ns': folder_mtime_ns,
+                                 'files': _scan_files(timefolder,
+                                                      folder_cached.get('files',
+                                                                        {}),
+                                                      read_headers)}
+
+        entry = {'mtime_ns': mtime_ns, 'timefolders': timefolders}
+
+    if entry != cached:
+        manifest[key] = entry
+        _save_manifest(manifestfile, manifest)
+
+    return entry
+
+
+def manifest_timefolders(casedir: Path, subdirectory, entry: dict) -> list[Path]:
+    """Returns the time folders of a manifest entry as paths, in time order"""
+
+    return [casedir / subdirectory / name for name in entry['timefolders']]
+
+
+def manifest_quantities(entry: dict) -> set[str]:
+    """Returns the names of all files appearing in any time folder of a
+    manifest entry. Compressed and uncompressed files are the same quantity.
+    """
+
+    return {filename.removesuffix('.gz')
+            for timefolder in entry['timefolders'].values()
+            for filename in timefolder['files']}
+
+
+def manifest_resolve(entry: dict, readfile: Path) -> tuple[Path, dict | None]:
+    """Like resolve_file, finds a file in a time folder with or without the
+    .gz suffix, but using a manifest entry instead of the filesystem. Returns
+    the path and its manifest information, or None if it is not listed.
+    """
+
+    readfile = Path(readfile)
+    timefolder = entry['timefolders'].get(readfile.parent.name, {})
+    files = timefolder.get('files', {})
+
+    name = readfile.name.removesuffix('.gz')
+    for candidate in (readfile.name, name, f'{name}.gz'):
+        if candidate in files:
+            return readfile.with_name(candidate), files[candidate]
+
+    return readfile, None
+
+
+def manifest_size(entry: dict, readfiles: list[Path]) -> int:
+    """Returns the total size in bytes of the files listed in a manifest entry,
+    ignoring any which are not listed
+    """
+
+    size = 0
+    for readfile in readfiles:
+        _, info = manifest_resolve(entry, readfile)
+        if info is not None:
+            size += info['size']
+
+    return size
+
+
+def group_order(data: np.ndarray, group_indices) -> np.ndarray | None:
+    """Returns the row order which groups the rows of a 2D array by the values
+    in the group_indices columns (e.g. turbine, then blade), so that each
+    group is a contiguous run of rows. The sort is stable, so rows within a
+    group keep their original (time) order. Returns None if the rows are
+    already grouped.
+    """
+
+    keys = data[:, list(group_indices)]
+    if keys.shape[0] < 2:
+        return None
+
+    # Already sorted if the first differing key between rows always increases
+    differences = np.diff(keys, axis=0)
+    first = np.argmax(differences != 0, axis=1)
+    if np.all(differences[np.arange(differences.shape[0]), first] >= 0):
+        return None
+
+    # np.lexsort is stable, and sorts by the last key first
+    return np.lexsort(keys.T[::-1])
+
+
+def sort_groups(data: np.ndarray, group_indices) -> np.ndarray:
+    """Returns the rows of a 2D array grouped by the values in the
+    group_indices columns (see group_order). No copy is made if the rows are
+    already grouped.
+    """
+
+    order = group_order(data, group_indices)
+    if order is None:
+        return data
+
+    return data[order]
+
+
+def group_runs(data: np.ndarray, group_indices) -> tuple[np.ndarray,
+                                                          np.ndarray]:
+    """Returns the start and end rows of each contiguous run of equal values
+    in the group_indices columns of a 2D array, in a single pass
+    """
+
+    keys = data[:, list(group_indices)]
+    changes = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.append(changes, keys.shape[0])
+
+    if keys.shape[0] == 0:
+        return starts[:0], ends[:0]
+
+    return starts, ends
+
+
+def _stitch_file_chunked(readfile: Path, later_start, sorting_index,
+                         group_indices, skip_header, max_memory):
+    """Generator used by stitch_time_folders when a memory budget is given.
+    The rows to keep are found from the group and sorting columns alone, then
+    the file is read again in blocks of rows, each of about a quarter of
+    max_memory bytes of text. Each group's rows are yielded in the same order
+    as when the whole file is read at once.
+    """
+
+    keys = read_numeric(readfile, usecols=[*group_indices, sorting_index],
+                        skip_header=skip_header)
+    if keys.size == 0:
+        return
+
+    key_sorting_index = len(group_indices)
+    keep = keys[:, key_sorting_index] < later_start
+
+    if group_indices:
+        key_group_indices = list(range(len(group_indices)))
+        order = group_order(keys, key_group_indices)
+        if order is None:
+            order = np.arange(keys.shape[0])
+
+        keys = keys[order]
+        sorted_keep = keep[order]
+        for start, end in zip(*group_runs(keys, key_group_indices)):
+            sorted_keep[start:end] &= utils.remove_overlaps(
+                keys[start:end], key_sorting_index, return_mask=True)
+        keep[order] = sorted_keep
+    else:
+        keep &= utils.remove_overlaps(keys, key_sorting_index,
+                                      return_mask=True)
+
+    logger.debug(f'Keeping {np.count_nonzero(keep)} of {keep.shape[0]} '
+                 f'records from {readfile}')
+    del keys
+
+    row = 0
+    for block in iter_numeric(readfile, skip_header=skip_header,
+                              block_size=max(max_memory // 4, 1 << 16)):
+        block_keep = keep[row:row+block.shape[0]]
+        row += block.shape[0]
+
+        block = block[block_keep]
+        if group_indices:
+            block = sort_groups(block, group_indices)
+
+        yield block
+
+
+def stitch_time_folders(readfiles: list[Path], sorting_index=0,
+                        group_indices=(), skip_header=0, manifest=None,
+                        max_memory=None):
+    """Generator which reads files from successive time folders (in time
+    order) and yields, for each file, the rows which are not superseded by a
+    later restart. Only one file is held in memory at a time.
+
+    Each file is assumed to begin at its earliest value of the sorting_index
+    column, so that the start of every later file can be found by reading only
+    its first row. Overlaps within a file are removed with
+    utils.remove_overlaps. If group_indices are given (e.g. turbine and blade
+    columns), overlaps within a file are removed separately for each group,
+    and the rows of each file are yielded grouped (see sort_groups).
+    If a manifest entry from scan_directory is given, files are found and
+    their first rows are taken from the manifest, without opening them.
+
+    If max_memory (bytes) is given, each file is read in blocks of rows
+    instead of all at once. Each group's rows are yielded in the same order.
+    """
+
+    found, first_rows = [], []
+    for readfile in readfiles:
+        if manifest is None:
+            readfile = resolve_file(readfile)
+            exists = readfile.is_file()
+        else:
+            readfile, info = manifest_resolve(manifest, readfile)
+            exists = info is not None
+
+        if not exists:
+            logger.warning(f'{readfile} does not exist. Skipping.')
+            continue
+
+        found.append(readfile)
+        if manifest is None:
+            first_rows.append(read_first_row(readfile, skip_header))
+        else:
+            first_rows.append(info['first_row'])
+
+    readfiles = found
+    first_values = np.array([np.inf if row is None else row[sorting_index]
+                             for row in first_rows])
+
+    # Rows at or beyond the start of any later file are superseded
+    later_starts = np.full(len(readfiles), np.inf)
+    if len(readfiles) > 1:
+        later_starts[:-1] = np.minimum.accumulate(first_values[:0:-1])[::-1]
+
+    for readfile, later_start in zip(readfiles, later_starts):
+        if max_memory is not None:
+            yield from _stitch_file_chunked(readfile, later_start,
+                                            sorting_index, group_indices,
+                                            skip_header, max_memory)
+            continue
+
+        data = read_numeric(readfile, skip_header=skip_header)
+        if data.size == 0:
+            continue
+
+        if group_indices:
+            data = sort_groups(data, group_indices)
+
+        keep = data[:, sorting_index] < later_start
+
+        if group_indices:
+            for start, end in zip(*group_runs(data, group_indices)):
+                keep[start:end] &= utils.remove_overlaps(data[start:end],
+                                                         sorting_index,
+                                                         return_mask=True)
+        else:
+            keep &= utils.remove_overlaps(data, sorting_index,
+                                          return_mask=True)
+
+        logger.debug(f'Keeping {np.count_nonzero(keep)} of {data.shape[0]} '
+                     f'records from {readfile}')
+
+        yield data[keep]
+
+
+def read_openfoam_layout(filepath: Path) -> tuple[int, int]:
+    """Returns the number of points and components per point in an OpenFOAM
+    formatted time history, e.g. probes or faceSource output, from its first
+    row of data. Each row is a time followed by one value per point, vectors
+    and tensors in parentheses. Returns (0, 0) if the file has no data.
+    """
+
+    with open_text(resolve_file(filepath)) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+
+            if '(' not in line:
+                return len(line.split()) - 1, 1
+
+            groups = line.split('(')[1:]
+            return len(groups), len(groups[0].split(')')[0].split())
+
+    return 0, 0
+
+
+def read_openfoam(readfiles: list[Path], manifest=None,
+                  max_memory=None) -> tuple[np.ndarray, np.ndarray]:
+    """Reads OpenFOAM formatted time histories of scalars, vectors or tensors
+    (e.g. probes, faceSource or sets output) from successive time folders,
+    concatenated with overlapping restarts removed. Parentheses are removed
+    from the text in bulk, and the rows parsed directly to floats. See
+    stitch_time_folders for the other arguments.
+
+    Returns the times, and the values shaped (time, point, component).
+    """
+
+    points, components = 0, 0
+    for readfile in readfiles:
+        if manifest is None:
+            readfile = resolve_file(readfile)
+            exists = readfile.is_file()
+        else:
+            readfile, info = manifest_resolve(manifest, readfile)
+            exists = info is not None
+
+        if exists:
+            points, components = read_openfoam_layout(readfile)
+            break
+
+    blocks = [block for block in stitch_time_folders(readfiles,
+                                                     manifest=manifest,
+                                                     max_memory=max_memory)
+              if block.size]
+
+    if not blocks:
+        return np.empty(0), np.empty((0, points, components))
+
+    data = np.concatenate(blocks)
+    del blocks
+
+    # Cached manifests may not have first rows for files with parentheses, in
+    # which case overlaps between time folders remain
+    data = utils.remove_overlaps(data, 0)
+
+    logger.debug(f'Read {data.shape[0]} times of {points} points with '
+                 f'{components} components')
+
+    return data[:,0], data[:,1:].reshape(data.shape[0], points, components)
+
+
+def _vtk_line(data: bytes, pos: int) -> tuple[list[str], int]:
+    """Returns the words of the next non-blank line of a legacy VTK file from
+    byte 'pos', and the position after it
+    """
+
+    while pos < len(data):
+        end = data.find(b'\n', pos)
+        end = len(data) if end == -1 else end
+        words = data[pos:end].decode('ascii', errors='replace').split()
+        pos = end + 1
+        if words:
+            return words, pos
+
+    return [], pos
+
+
+def _vtk_values(data: bytes, pos: int, count: int, vtktype: str, binary,
+                convert=True) -> tuple[np.ndarray | None, int]:
+    """Reads 'count' values of a legacy VTK data type from byte 'pos', either
+    in binary or as ASCII text, which is parsed in bulk up to the next
+    keyword. Returns the values (None if convert is False, in which case the
+    section is only skipped) and the position after them.
+    """
+
+    dtype = np.dtype(VTK_DTYPES[vtktype.lower()])
+
+    if binary:
+        end = pos + count * dtype.itemsize
+        values = (np.frombuffer(data, dtype=dtype, count=count, offset=pos)
+                  if convert else None)
+
+        # Binary data is followed by a line break
+        while end < len(data) and data[end:end+1] in b' \r\n':
+            end += 1
+        return values, end
+
+    match = _VTK_KEYWORD.search(data, pos)
+    end = len(data) if match is None else match.start()
+    if not convert:
+        return None, end
+
+    # Text is parsed at full precision, whatever the declared type
+    values = np.fromstring(data[pos:end], sep=' ',
+                           dtype=float if dtype.kind == 'f' else np.int64)
+    if values.size != count:
+        raise ValueError(f'Expected {count} values at byte {pos} of VTK file, '
+                         f'found {values.size}')
+
+    return values, end
+
+
+def _vtk_cells(data: bytes, pos: int, words: list[str], binary,
+               convert=True) -> tuple[tuple | None, int]:
+    """Reads a POLYGONS (or VERTICES, LINES, TRIANGLE_STRIPS) section, in
+    either the classic layout of a point count followed by point indices for
+    each cell, or the OFFSETS and CONNECTIVITY layout of VTK 5. Returns
+    (offsets, connectivity), where cell i has the points
+    connectivity[offsets[i]:offsets[i+1]].
+    """
+
+    cells, size = int(words[1]), int(words[2])
+
+    nextwords, nextpos = _vtk_line(data, pos)
+    if nextwords and nextwords[0] == 'OFFSETS':
+        offsets, pos = _vtk_values(data, nextpos, cells, nextwords[1], binary,
+                                   convert)
+        nextwords, pos = _vtk_line(data, pos)
+        connectivity, pos = _vtk_values(data, pos, size, nextwords[1], binary,
+                                        convert)
+        if not convert:
+            return None, pos
+        return (offsets.astype(np.int64), connectivity.astype(np.int64)), pos
+
+    values, pos = _vtk_values(data, pos, size, 'int', binary, convert)
+    if not convert:
+        return None, pos
+
+    values = values.astype(np.int64)
+
+    # Surfaces usually have the same number of points in every cell, in
+    # which case each cell is one row
+    if cells and size % cells == 0 and np.all(
+            values[::size//cells] == size // cells - 1):
+        points_per_cell = size // cells - 1
+        counts = np.full(cells, points_per_cell)
+        connectivity = values.reshape(cells, -1)[:,1:].ravel()
+
+    else:
+        counts = np.empty(cells, dtype=np.int64)
+        starts = np.empty(cells, dtype=np.int64)
+        start = 0
+        for i in range(cells):
+            starts[i] = start
+            counts[i] = values[start]
+            start += counts[i] + 1
+        keep = np.ones(size, dtype=bool)
+        keep[starts] = False
+        connectivity = values[keep]
+
+    offsets = np.zeros(cells + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return (offsets, connectivity), pos
+
+
+def read_vtk(filepath: Path, fields=None, geometry=True) -> dict:
+    """Reads a legacy VTK polydata file (e.g. an OpenFOAM sampled surface),
+    in ASCII or binary. Each section is parsed in bulk. Only the cell and
+    point data arrays named in 'fields' are converted (all if None), and if
+    geometry is False, the points and polygons are skipped.
+
+    Returns a dict with 'points' (point, 3), 'offsets' and 'connectivity'
+    (see _vtk_cells) for the polygons, and 'cell_data' and 'point_data' dicts
+    of arrays shaped (cell or point, component).
+    """
+
+    logger.debug(f'Reading {filepath}')
+
+    with open(filepath, mode='rb') as f:
+        data = f.read()
+
+    pos = 0
+    for _ in range(3):
+        words, pos = _vtk_line(data, pos)
+        if words and words[0] in ('ASCII', 'BINARY'):
+            break
+    else:
+        raise ValueError(f'{filepath} is not a legacy VTK file')
+    binary = words[0] == 'BINARY'
+
+    vtk = {'points': None, 'offsets': None, 'connectivity': None,
+           'cell_data': {}, 'point_data': {}}
+    attributes = vtk['cell_data']
+    tuples = 0
+
+    def wanted(name):
+        return fields is None or name in fields
+
+    while True:
+        words, pos = _vtk_line(data, pos)
+        if not words:
+            break
+        keyword = words[0].upper()
+
+        if keyword == 'DATASET':
+            if words[1].upper() != 'POLYDATA':
+                raise ValueError(f'{filepath} is not polydata')
+
+        elif keyword == 'POINTS':
+            points, pos = _vtk_values(data, pos, 3*int(words[1]), words[2],
+                                      binary, geometry)
+            if geometry:
+                vtk['points'] = points.astype(float).reshape(-1, 3)
+
+        elif keyword in ('POLYGONS', 'VERTICES', 'LINES', 'TRIANGLE_STRIPS'):
+            convert = geometry and keyword == 'POLYGONS'
+            cells, pos = _vtk_cells(data, pos, words, binary, convert)
+            if convert:
+                vtk['offsets'], vtk['connectivity'] = cells
+
+        elif keyword in ('CELL_DATA', 'POINT_DATA'):
+            attributes = vtk[keyword.lower()]
+            tuples = int(words[1])
+
+        elif keyword == 'SCALARS':
+            components = int(words[3]) if len(words) > 3 else 1
+            lookup, pos = _vtk_line(data, pos) # LOOKUP_TABLE
+            values, pos = _vtk_values(data, pos, tuples*components, words[2],
+                                      binary, wanted(words[1]))
+            if values is not None:
+                attributes[words[1]] = values.astype(float).reshape(tuples,
+                                                                    components)
+
+        elif keyword in ('VECTORS', 'NORMALS'):
+            values, pos = _vtk_values(data, pos, tuples*3, words[2], binary,
+                                      wanted(words[1]))
+            if values is not None:
+                attributes[words[1]] = values.astype(float).reshape(tuples, 3)
+
+        elif keyword == 'FIELD':
+            for _ in range(int(words[2])):
+                words, pos = _vtk_line(data, pos)
+                name, components, count = words[0], int(words[1]), int(words[2])
+                values, pos = _vtk_values(data, pos, components*count,
+                                          words[3], binary, wanted(name))
+                if values is not None:
+                    attributes[name] = values.astype(float).reshape(count,
+                                                                    components)
+
+        elif keyword == 'METADATA':
+            # Information keys end at a blank line
+            end = data.find(b'\n\n', pos)
+            pos = len(data) if end == -1 else end + 2
+
+        else:
+            raise ValueError(f'Unsupported VTK keyword {words[0]} in '
+                             f'{filepath}')
+
+    return vtk
+
+
+def vtk_cell_centres(vtk: dict) -> np.ndarray:
+    """Returns the centre of each polygon of a surface from read_vtk, as the
+    mean of its points
+    """
+
+    points, offsets = vtk['points'], vtk['offsets']
+    connectivity = vtk['connectivity']
+    counts = np.diff(offsets)
+
+    if counts.size and np.all(counts == counts[0]):
+        return np.mean(points[connectivity.reshape(counts.size, -1)], axis=1)
+
+    return (np.add.reduceat(points[connectivity], offsets[:-1], axis=0)
+            / counts[:, np.newaxis])
+
+
+def read_vtk_series(readfiles: list[Path], field: str, directory=None,
+                    max_memory=None) -> tuple[np.ndarray, np.ndarray]:
+    """Reads 'field' from the same surface at successive times, e.g. the
+    files of one surface in each time folder. The geometry is read from the
+    first file only. Returns the cell centres and the values shaped (time,
+    cell, component), memory-mapped in 'directory' (see scratch_array) if
+    they would not fit within max_memory bytes.
+    """
+
+    vtk = read_vtk(readfiles[0], fields=[field])
+    if field not in vtk['cell_data']:
+        raise ValueError(f'{readfiles[0]} has no cell data {field}')
+    centres = vtk_cell_centres(vtk)
+
+    first = vtk['cell_data'][field]
+    values = scratch_array((len(readfiles), *first.shape),
+                           Path(readfiles[0]).parent if directory is None
+                           else directory,
+                           max_memory)
+    values[0] = first
+    del vtk, first
+
+    for i, readfile in enumerate(readfiles[1:], start=1):
+        cell_data = read_vtk(readfile, fields=[field],
+                             geometry=False)['cell_data']
+        if field not in cell_data or cell_data[field].shape != values.shape[1:]:
+            raise ValueError(f'{readfile} does not match the surface in '
+                             f'{readfiles[0]}')
+        values[i] = cell_data[field]
+
+    return centres, values
+
+
+def binary_paths(textfile: Path) -> tuple[Path, Path]:
+    """Returns the paths of the binary sidecar (raw data and JSON header) which
+    accompany a text output file.
+    """
+
+    textfile = Path(textfile)
+    return textfile.with_suffix('.bin'), textfile.with_suffix('.json')
+
+
+def write_binary_header(textfile: Path, shape: tuple, columns: list[str],
+                        heights=None, time_range=None, revisions=(),
+                        changed_row=0, **metadata) -> None:
+    """Writes the JSON header of a binary sidecar. The size and modification
+    time of the text file are recorded so that a stale sidecar can be
+    detected. Must be called after the text file has been written.
+
+    Each write is recorded as a revision, with the text file modification time
+    and the first row which changed ('changed_row'), appended to any previous
+    'revisions'. Derived files use the revisions to recompute only the rows
+    which have changed. Any other metadata (e.g. the text block index) is
+    stored as given.
+    """
+
+    _, headerfile = binary_paths(textfile)
+    stat = Path(textfile).stat()
+
+    revisions = [*revisions, {'mtime_ns': stat.st_mtime_ns,
+                              'first_row': int(changed_row)}]
+
+    binary_header = {'dtype': BINARY_DTYPE,
+                     'shape': [int(i) for i in shape],
+                     'columns': columns,
+                     'heights': None if heights is None
+                                else [float(i) for i in heights],
+                     'time_range': None if time_range is None
+                                   else [float(i) for i in time_range],
+                     'source': {'name': Path(textfile).name,
+                                'size': stat.st_size,
+                                'mtime_ns': stat.st_mtime_ns},
+                     'revisions': revisions,
+                     **metadata}
+
+    with open(headerfile, mode='w') as f:
+        json.dump(binary_header, f, indent=4)
+
+
+def read_binary_header(textfile: Path) -> dict | None:
+    """Returns the JSON header of the binary sidecar for 'textfile', or None
+    if the sidecar is missing or older than the text file.
+    """
+
+    binaryfile, headerfile = binary_paths(textfile)
+    if not (binaryfile.is_file() and headerfile.is_file()):
+        return None
+
+    with open(headerfile) as f:
+        binary_header = json.load(f)
+
+    textfile = Path(textfile)
+    if textfile.is_file():
+        stat = textfile.stat()
+        if (stat.st_size != binary_header['source']['size']
+            or stat.st_mtime_ns != binary_header['source']['mtime_ns']):
+            logger.warning(f'{binaryfile.name} is stale. Ignoring.')
+            return None
+
+    expected_size = (np.prod(binary_header['shape'])
+                     * np.dtype(binary_header['dtype']).itemsize)
+    if binaryfile.stat().st_size != expected_size:
+        logger.warning(f'{binaryfile.name} is incomplete. Ignoring.')
+        return None
+
+    return binary_header
+
+
+def load(textfile: Path, usecols=None) -> np.ndarray:
+    """Loads a 2D array from a sowfatools output file. If an up-to-date binary
+    sidecar exists, it is memory-mapped (copy-on-write, so the array may be
+    modified without changing the file). Otherwise the text file is parsed.
+
+    If usecols is given, only those columns are returned (as a copy), either
+    taken from the binary sidecar or converted while parsing the text.
+    """
+
+    binary_header = read_binary_header(textfile)
+
+    if binary_header is None:
+        return read_numeric(textfile, usecols=usecols)
+
+    binaryfile, _ = binary_paths(textfile)
+    logger.debug(f'Memory-mapping {binaryfile}')
+
+    shape = tuple(binary_header['shape'])
+    if 0 in shape:
+        data = np.empty(shape, dtype=binary_header['dtype'])
+    else:
+        data = np.memmap(binaryfile, dtype=binary_header['dtype'], mode='c',
+                         shape=shape)
+
+    if usecols is None:
+        return data
+
+    return np.array(data[:, usecols])
+
+
+def iter_load(textfile: Path, usecols=None, max_memory=None):
+    """Generator which yields a sowfatools output file in blocks of rows of at
+    most about max_memory bytes, from its binary sidecar if there is one and
+    otherwise by parsing the text in blocks, so that files larger than memory
+    can be streamed. Yields the whole array if max_memory is None.
+    """
+
+    if max_memory is None:
+        yield load(textfile, usecols=usecols)
+        return
+
+    binary_header = read_binary_header(textfile)
+
+    if binary_header is None:
+        logger.debug(f'Streaming {textfile}')
+        yield from iter_numeric(textfile, usecols=usecols,
+                                block_size=max(int(max_memory), 1))
+        return
+
+    data = load(textfile)
+    if usecols is None:
+        for block in row_blocks(data, max_memory):
+            yield np.array(block)
+        return
+
+    columns = np.atleast_1d(usecols).size
+    rows = max(1, int(max_memory // (8 * columns)))
+    for start in range(0, data.shape[0], rows):
+        yield np.array(data[start:start+rows, usecols])
+
+
+def read_shape(textfile: Path) -> tuple[int, int]:
+    """Returns the shape of the 2D array in a sowfatools output file, from its
+    binary sidecar if there is one, without loading the data
+    """
+
+    binary_header = read_binary_header(textfile)
+    if binary_header is not None:
+        return tuple(binary_header['shape'])
+
+    first_row = read_first_row(textfile)
+    if first_row is None:
+        return (0, 0)
+
+    return (read_numeric(textfile, usecols=[0]).shape[0], first_row.shape[0])
+
+
+def scratch_array(shape: tuple, directory: Path, max_memory=None) -> np.ndarray:
+    """Returns an uninitialised float64 array. If it would not fit within
+    max_memory bytes, it is memory-mapped to an anonymous temporary file in
+    'directory' instead, which is removed when the array is deleted.
+    """
+
+    nbytes = int(np.prod(shape)) * np.dtype(BINARY_DTYPE).itemsize
+    if max_memory is None or nbytes <= max_memory or nbytes == 0:
+        return np.empty(shape, dtype=BINARY_DTYPE)
+
+    logger.debug(f'Memory-mapping a scratch array of {nbytes/2**20:.0f} MiB '
+                 f'in {directory}')
+    with tempfile.TemporaryFile(dir=directory) as f:
+        f.truncate(nbytes)
+        return np.memmap(f, dtype=BINARY_DTYPE, mode='w+', shape=shape)
+
+
+def row_blocks(data: np.ndarray, max_memory=None):
+    """Generator which yields a 2D array in blocks of rows of at most
+    max_memory bytes, e.g. for writing a memory-mapped array. Yields the whole
+    array if max_memory is None.
+    """
+
+    if max_memory is None or data.shape[0] == 0:
+        yield data
+        return
+
+    rows = max(1, int(max_memory // max(data[0].nbytes, 1)))
+    for start in range(0, data.shape[0], rows):
+        yield data[start:start+rows]
+
+
+def read_columns_header(textfile: Path) -> list[str]:
+    """Returns the column names of a sowfatools output file, from its binary
+    sidecar if there is one, or from the first line of the text file
+    """
+
+    binary_header = read_binary_header(textfile)
+    if binary_header is not None:
+        return binary_header['columns']
+
+    with open_text(textfile) as f:
+        header = f.readline()
+
+    return header.removeprefix('#').split()
+
+
+def height_columns(textfile: Path, heights=None) -> tuple[list[int],
+                                                           np.ndarray]:
+    """Resolves heights to column indices of a sowfatools output file whose
+    header names height columns as e.g. '90m'. Returns the index and height of
+    the column nearest to each of 'heights', or of every height column if
+    heights is None.
+    """
+
+    indices = []
+    available = []
+    for i, name in enumerate(read_columns_header(textfile)):
+        if not name.endswith('m'):
+            continue
+        try:
+            available.append(float(name.removesuffix('m')))
+        except ValueError:
+            continue
+        indices.append(i)
+
+    if not indices:
+        raise ValueError(f'No height columns found in the header of '
+                         f'{textfile}')
+
+    indices = np.array(indices)
+    available = np.array(available)
+
+    if heights is None:
+        return indices.tolist(), available
+
+    nearest = [np.argmin(np.abs(available - height)) for height in heights]
+    return indices[nearest].tolist(), available[nearest]
+
+
+def _executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Returns the thread pool shared by all TextWriters. zlib releases the
+    GIL while compressing, so blocks are compressed in parallel.
+    """
+
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+            max_workers=WRITE_WORKERS, thread_name_prefix='iotools')
+    return _EXECUTOR
+
+
+def _format_block(block: np.ndarray, fmt: str, compresslevel,
+                  binary=False) -> tuple[bytes, bytes | None]:
+    """Formats all rows of a 2D array at once, in the same layout as
+    np.savetxt. If compresslevel is not None, the text is compressed as a
+    complete gzip member. If binary is True, the values are also returned in
+    binary, parsed back from the text so that they are exactly the values a
+    reader of the text would get.
+    """
+
+    rowfmt = ' '.join([fmt] * block.shape[1]) + '\n'
+    text = (rowfmt * block.shape[0]) % tuple(block.ravel().tolist())
+
+    values = None
+    if binary:
+        values = np.fromstring(text, dtype=BINARY_DTYPE, sep=' ').tobytes()
+
+    text = text.encode()
+    if compresslevel is not None:
+        text = gzip.compress(text, compresslevel=compresslevel, mtime=0)
+
+    return text, values
+
+
+class TextWriter:
+    """Writes 2D arrays to a text file in the same layout as np.savetxt.
+    Blocks of rows are formatted and, for .gz files, compressed on a thread
+    pool as independent gzip members. The result is a multi-member gzip
+    stream which gzip.open and np.loadtxt read as a single file.
+
+    The byte offset and first row of every block are recorded in 'index', so
+    that the file can later be truncated at a block boundary and resumed. To
+    resume, pass 'resume' as (offset, rows, index) for the retained blocks.
+
+    If 'binaryfile' (an open file) is given, the values as written to text are
+    also written to it in binary.
+    """
+
+    def __init__(self, writefile: Path, header='', fmt='%.12g',
+                 compresslevel=WRITE_COMPRESSLEVEL, resume=None,
+                 binaryfile=None):
+        self.writefile = Path(writefile)
+        self.binaryfile = binaryfile
+        self.fmt = fmt
+        self.compress = self.writefile.suffix == '.gz'
+        self.compresslevel = compresslevel if self.compress else None
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_binary = False
+
+        if resume is None:
+            self.rows = 0
+            self.index = []
+            self.file = open(self.writefile, mode='wb')
+
+            if header:
+                header = header.replace('\n', '\n# ')
+                self._submit(f'# {header}\n'.encode())
+
+        else:
+            offset, self.rows, index = resume
+            self.index = [list(entry) for entry in index]
+            self.file = open(self.writefile, mode='r+b')
+            self.file.seek(offset)
+            self.file.truncate()
+
+    def _submit(self, text: bytes) -> None:
+        if self.compress:
+            text = gzip.compress(text, compresslevel=self.compresslevel,
+                                 mtime=0)
+        future = concurrent.futures.Future()
+        future.set_result((text, None))
+        self._queue(future)
+
+    def _queue(self, future, row=None) -> None:
+        # Limit the number of blocks held in memory
+        self.pending.append((future, row))
+        while len(self.pending) > 2 * WRITE_WORKERS:
+            self._flush_one()
+
+    def _flush_one(self) -> None:
+        future, row = self.pending.popleft()
+        if row is not None:
+            self.index.append([self.file.tell(), row])
+
+        text, values = future.result()
+        self.file.write(text)
+        if values is not None:
+            self.binaryfile.write(values)
+
+    def _submit_block(self, block: np.ndarray, binary) -> None:
+        future = _executor().submit(_format_block, block, self.fmt,
+                                    self.compresslevel, binary)
+        self._queue(future, self.rows)
+        self.rows += block.shape[0]
+
+    def _flush_buffer(self) -> None:
+        if self.buffer:
+            self._submit_block(np.concatenate(self.buffer), self.buffer_binary)
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data: np.ndarray, binary=True) -> None:
+        """Writes rows of data, also to binaryfile (if given) unless binary
+        is False. Rows are buffered into blocks of a fixed size, so the file
+        written does not depend on how the rows are split between calls.
+        """
+
+        if data.ndim == 1: # One value per row, as np.savetxt
+            data = data[:, np.newaxis]
+        if data.size == 0:
+            return
+
+        binary = binary and self.binaryfile is not None
+        if self.buffer and (data.shape[1] != self.buffer[0].shape[1]
+                            or binary != self.buffer_binary):
+            self._flush_buffer()
+        self.buffer_binary = binary
+
+        block_rows = max(1, WRITE_BLOCK_VALUES // data.shape[1])
+        start = 0
+
+        # Complete a partially filled block first
+        if self.buffered:
+            start = min(block_rows - self.buffered, data.shape[0])
+            self.buffer.append(np.array(data[:start]))
+            self.buffered += start
+            if self.buffered == block_rows:
+                self._flush_buffer()
+
+        while data.shape[0] - start >= block_rows:
+            self._submit_block(data[start:start+block_rows], binary)
+            start += block_rows
+
+        # The caller may reuse its array, so the remainder is copied
+        if start < data.shape[0]:
+            self.buffer.append(np.array(data[start:]))
+            self.buffered += data.shape[0] - start
+
+    def close(self) -> None:
+        self._flush_buffer()
+        while self.pending:
+            self._flush_one()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def savetxt(writefile: Path, data: np.ndarray, header='', fmt='%.12g',
+            compresslevel=WRITE_COMPRESSLEVEL) -> None:
+    """Drop-in replacement for np.savetxt using a TextWriter"""
+
+    logger.debug(f'Saving file {Path(writefile).name}')
+    with TextWriter(writefile, header, fmt, compresslevel) as f:
+        f.write(data)
+
+
+class _OutputFile:
+    """A text output file with an optional binary sidecar, used by
+    write_blocks and write_groups. If 'keep_rows' is given, the first
+    'keep_rows' rows of an existing file are kept and new rows are appended;
+    the existing file must have an up-to-date sidecar (see plan_append).
+    """
+
+    def __init__(self, writefile: Path, header, fmt, binary, compresslevel,
+                 keep_rows=None):
+        self.writefile = Path(writefile)
+        self.header = header
+        self.binary = binary
+        self.rows = 0
+        self.columns = 0
+        self.time_range = [np.nan, np.nan]
+        self.revisions = ()
+        self.changed_row = 0
+
+        binaryfile, _ = binary_paths(writefile)
+
+        if keep_rows is not None:
+            binary_header = read_binary_header(writefile)
+            if (not binary or binary_header is None
+                or 'blocks' not in binary_header):
+                raise ValueError(f'{writefile} has no up-to-date binary '
+                                 f'sidecar and cannot be appended to')
+            self.revisions = binary_header['revisions']
+
+        if not keep_rows or not binary_header['blocks']:
+            self.binaryfile = open(binaryfile, mode='wb') if binary else None
+            self.text = TextWriter(writefile, header, fmt, compresslevel,
+                                   binaryfile=self.binaryfile)
+            return
+
+        # Rows from the start of the last retained text block are rewritten
+        index = binary_header['blocks']
+        i = max(bisect.bisect_right([row for _, row in index], keep_rows) - 1,
+                0)
+        offset, row = index[i]
+        old = load(writefile)
+        head = np.array(old[row:keep_rows])
+        self.time_range = [old[0,0], old[keep_rows-1,0]]
+        del old
+
+        self.binaryfile = open(binaryfile, mode='r+b')
+        self.binaryfile.truncate(keep_rows * binary_header['shape'][1]
+                                 * np.dtype(BINARY_DTYPE).itemsize)
+        self.binaryfile.seek(0, os.SEEK_END)
+
+        self.text = TextWriter(writefile, fmt=fmt, compresslevel=compresslevel,
+                               resume=(offset, row, index[:i]),
+                               binaryfile=self.binaryfile)
+        self.text.write(head, binary=False) # Already in the binary file
+
+        self.rows = keep_rows
+        self.columns = binary_header['shape'][1]
+        self.changed_row = keep_rows
+
+    def write(self, block: np.ndarray) -> None:
+        if block.shape[0] == 0:
+            return
+
+        if self.rows and block.shape[1] != self.columns:
+            raise ValueError(f'Cannot write {block.shape[1]} columns to '
+                             f'{self.writefile} with {self.columns} columns')
+
+        self.text.write(block)
+
+        if self.rows == 0:
+            self.time_range[0] = block[0,0]
+        self.time_range[1] = block[-1,0]
+        self.rows += block.shape[0]
+        self.columns = block.shape[1]
+
+    def close(self, heights=None, write_header=True, **metadata) -> None:
+        """Closes the files. The sidecar header is only written if
+        'write_header' is True, so that an incomplete file is never marked as
+        up to date.
+        """
+
+        self.text.close()
+        if not self.binary:
+            return
+
+        self.binaryfile.close()
+        if write_header:
+            write_binary_header(self.writefile, (self.rows, self.columns),
+                                self.header.split(), heights,
+                                self.time_range if self.rows else None,
+                                self.revisions, self.changed_row,
+                                blocks=self.text.index, **metadata)
+
+
+def write_blocks(writefile: Path, blocks, header='', fmt='%.12g',
+                 binary=False, heights=None,
+                 compresslevel=WRITE_COMPRESSLEVEL, keep_rows=None,
+                 **metadata) -> int:
+    """Writes an iterable of 2D arrays to a single text file (compressed if
+    the filename ends with .gz), in the same layout as np.savetxt. If binary
+    is True, a binary sidecar is written alongside, including any metadata.
+    If keep_rows is given, the first keep_rows rows of the existing file are
+    kept and the blocks are appended after them. Returns the number of rows
+    in the file.
+    """
+
+    if keep_rows is None:
+        logger.debug(f'Saving file {Path(writefile).name}')
+    else:
+        logger.debug(f'Appending to file {Path(writefile).name} after row '
+                     f'{keep_rows}')
+
+    f = _OutputFile(writefile, header, fmt, binary, compresslevel, keep_rows)
+    try:
+        for block in blocks:
+            f.write(block)
+    except BaseException:
+        f.close(write_header=False)
+        raise
+    f.close(heights, **metadata)
+
+    logger.debug(f'{writefile} has {f.rows} records')
+    return f.rows
+
+
+def write_groups(writefiles: dict, blocks, group_indices, first_index,
+                 header='', fmt='%.12g', binary=False,
+                 compresslevel=WRITE_COMPRESSLEVEL, keep_rows=None,
+                 **metadata) -> None:
+    """Splits an iterable of 2D arrays into groups and writes each group to
+    its own text file, in the same layout as np.savetxt. 'writefiles' maps a
+    tuple of group values (from the group_indices columns) to a filepath.
+    Each block is split in one pass into contiguous runs of equal group
+    values. Columns before 'first_index' are not written. If binary is True, a
+    binary sidecar is written alongside each file, including any metadata. If
+    keep_rows is given, it maps each key to the number of rows of the
+    existing file to keep, after which the new rows are appended.
+    """
+
+    group_indices = list(group_indices)
+
+    files = {}
+    try:
+        for key, writefile in writefiles.items():
+            logger.info(f'Saving file {writefile.name}')
+            files[key] = _OutputFile(writefile, header, fmt, binary,
+                                     compresslevel,
+                                     None if keep_rows is None
+                                     else keep_rows[key])
+
+        for block in blocks:
+            # Blocks from stitch_time_folders are already grouped
+            block = sort_groups(block, group_indices)
+            for start, end in zip(*group_runs(block, group_indices)):
+                key = tuple(block[start, group_indices])
+                if key in files:
+                    files[key].write(block[start:end, first_index:])
+    except BaseException:
+        for f in files.values():
+            f.close(write_header=False)
+        raise
+
+    for f in files.values():
+        f.close(**metadata)
+
+
+################################################################################
+
+def manifest_sources(manifest: dict, readfiles: list[Path]) -> dict:
+    """Returns the size and modification time of each of 'readfiles' which
+    exists, keyed by time folder, for recording the sources of a stitched
+    file.
+    """
+
+    sources = {}
+    for readfile in readfiles:
+        readfile, info = manifest_resolve(manifest, readfile)
+        if info is not None:
+            sources[readfile.parent.name] = {'name': readfile.name,
+                                             'size': info['size'],
+                                             'mtime_ns': info['mtime_ns']}
+    return sources
+
+
+def plan_append(writefiles: list[Path], readfiles: list[Path],
+                manifest: dict, sorting_index=0) -> tuple | None:
+    """Decides how stitched files can be brought up to date by appending,
+    after new time folders appear. Returns the readfiles which must be read
+    (new time folders, plus the last stitched time folder if it has grown),
+    and the cutoff value of the sorting_index column from which existing rows
+    are superseded. The readfiles are empty if the files are up to date.
+    Returns None if the files must be rewritten, e.g. because an earlier time
+    folder has changed or there is no up-to-date binary sidecar.
+    """
+
+    sources = manifest_sources(manifest, readfiles)
+
+    stitched = None
+    for writefile in writefiles:
+        binary_header = read_binary_header(writefile)
+        if (binary_header is None or 'blocks' not in binary_header
+            or 'sources' not in binary_header):
+            return None
+        if stitched is None:
+            stitched = binary_header['sources']
+        elif binary_header['sources'] != stitched:
+            return None
+
+    if not stitched:
+        return None
+
+    names = list(sources)
+    stitched_names = list(stitched)
+    last = stitched_names[-1]
+
+    # All earlier time folders must be unchanged, with new ones only after
+    n = len(stitched_names) - 1
+    if names[:n] != stitched_names[:-1] or last not in sources:
+        return None
+    if any(sources[name] != stitched[name] for name in stitched_names[:-1]):
+        return None
+
+    new = names[n:]
+    if sources[last] == stitched[last]:
+        new.remove(last)
+
+    cutoff = np.inf
+    newfiles = []
+    for readfile in readfiles:
+        readfile, info = manifest_resolve(manifest, readfile)
+        if readfile.parent.name in new:
+            newfiles.append(readfile)
+            if info['first_row'] is not None:
+                cutoff = min(cutoff, info['first_row'][sorting_index])
+
+    return newfiles, cutoff
+
+
+def rows_before(textfile: Path, value, column=0) -> int:
+    """Returns the number of leading rows of a sowfatools output file whose
+    value in 'column' is less than 'value'. The column must be increasing.
+    """
+
+    data = load(textfile)
+    if data.shape[0] == 0:
+        return 0
+
+    # Bisection only touches a few rows of a memory-mapped file
+    return bisect.bisect_left(data[:, column], value)
+
+
+def input_revisions(readfiles: list[Path]) -> dict:
+    """Returns the latest revision of each of 'readfiles', for recording the
+    inputs of a derived file
+    """
+
+    revisions = {}
+    for readfile in readfiles:
+        binary_header = read_binary_header(readfile)
+        if binary_header is not None and binary_header.get('revisions'):
+            revisions[Path(readfile).name] = (binary_header['revisions'][-1]
+                                              ['mtime_ns'])
+    return revisions
+
+
+def valid_rows(writefile: Path, readfiles: list[Path]) -> int:
+    """Returns the number of leading rows of a derived file, computed row by
+    row from 'readfiles', which are unaffected by changes to the readfiles
+    since it was written. Returns 0 if this cannot be determined.
+    """
+
+    binary_header = read_binary_header(writefile)
+    if (binary_header is None or 'blocks' not in binary_header
+        or 'inputs' not in binary_header):
+        return 0
+
+    rows = binary_header['shape'][0]
+    for readfile in readfiles:
+        read_header = read_binary_header(readfile)
+        if read_header is None:
+            return 0
+
+        revisions = read_header.get('revisions', [])
+        mtimes = [revision['mtime_ns'] for revision in revisions]
+        recorded = binary_header['inputs'].get(Path(readfile).name)
+        if recorded not in mtimes:
+            return 0
+
+        for revision in revisions[mtimes.index(recorded)+1:]:
+            rows = min(rows, revision['first_row'])
+
+    return rows
+
+
+if __name__ == '__main__':
+    logger.error('This module is not intended to be run as a script')
@@ -0,0 +1,235 @@
+"""Compatible with Python 3.13, SOWFA 2.4.x
+Part of github.com/NotDrJeff/sowfatools
+Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
+
+This module contains functions for running a series of postProcessing stages
+as a dependency graph. Each stage declares the files it reads and writes as
+glob patterns relative to a case directory, and a stage depends on every
+stage whose outputs match its inputs. Independent stages can run at once.
+"""
+
+import glob
+import time
+import fnmatch
+import concurrent.futures
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+################################################################################
+
+def stage(function, inputs, outputs, *args, name=None, **kwargs) -> dict:
+    """Returns a stage which calls function(*args, **kwargs), reading files
+    matching the 'inputs' patterns and writing files matching the 'outputs'
+    patterns. The function must be defined at module level so that it can be
+    run on another process.
+    """
+
+    if name is None:
+        name = f'{function.__module__}.{function.__name__}'
+
+    return {'name': name, 'function': function, 'args': args,
+            'kwargs': kwargs, 'inputs': [str(pattern) for pattern in inputs],
+            'outputs': [str(pattern) for pattern in outputs]}
+
+
+def _patterns_overlap(first: str, second: str) -> bool:
+    """Returns True if two glob patterns could match the same file"""
+
+    return (first == second or fnmatch.fnmatchcase(first, second)
+            or fnmatch.fnmatchcase(second, first))
+
+
+def dependencies(stages: list[dict]) -> dict[str, list[str]]:
+    """Returns the names of the stages which each stage depends on, i.e. those
+    declared before it whose outputs match any of its inputs. Stage names
+    must be unique.
+    """
+
+    names = [stage['name'] for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Stage names are not unique: {names}')
+
+    depends = {}
+    for i, later in enumerate(stages):
+        depends[later['name']] = [
+            earlier['name'] for earlier in stages[:i]
+            if any(_patterns_overlap(output, pattern)
+                   for output in earlier['outputs']
+                   for pattern in later['inputs'])]
+
+    return depends
+
+
+def _glob_files(directory: Path, pattern: str) -> list[Path]:
+    """Returns the files in directory matching pattern"""
+
+    return [path for path in Path(directory).glob(pattern) if path.is_file()]
+
+
+def estimate_work(stages: list[dict], directory: Path) -> dict[str, int]:
+    """Returns an estimate of the work done by each stage, as the bytes of
+    input it reads. Inputs which do not exist yet are estimated by assuming
+    that each stage writes as many bytes as it reads, spread evenly over its
+    output files. A glob output is assumed to hold one file for each distinct
+    input filename of its stage.
+    """
+
+    depends = dependencies(stages)
+    work = {}
+    files = {} # estimated number of output files of each stage
+
+    for stage in stages:
+        name = stage['name']
+        work[name] = 0
+        names = set()
+        missing = 0
+
+        for pattern in stage['inputs']:
+            existing = _glob_files(directory, pattern)
+            if existing:
+                work[name] += sum(path.stat().st_size for path in existing)
+                names.update(path.name for path in existing)
+                continue
+
+            for earlier in stages:
+                if (earlier['name'] not in depends[name]
+                    or not any(_patterns_overlap(output, pattern)
+                               for output in earlier['outputs'])):
+                    continue
+
+                # A glob input reads all of the outputs which it matches
+                covered = [output for output in earlier['outputs']
+                           if fnmatch.fnmatchcase(output, pattern)]
+                if glob.has_magic(pattern) and covered:
+                    share = len(covered) / len(earlier['outputs'])
+                    work[name] += work[earlier['name']] * share
+                    missing += max(1, round(files[earlier['name']] * share))
+                else:
+                    work[name] += work[earlier['name']] / files[earlier['name']]
+                    missing += 1
+
+        literal = [output for output in stage['outputs']
+                   if not glob.has_magic(output)]
+        globbed = len(stage['outputs']) - len(literal)
+        files[name] = max(1, len(literal)
+                             + globbed * max(1, len(names) + missing))
+
+    return {name: round(estimate) for name, estimate in work.items()}
+
+
+def log_plan(stages: list[dict], directory: Path) -> dict[str, int]:
+    """Logs the stages in the order they would start in a serial run, with
+    their dependencies, estimated work and the number of their outputs which
+    already exist. Returns the estimated work of each stage in bytes.
+    """
+
+    depends = dependencies(stages)
+    work = estimate_work(stages, directory)
+
+    logger.info(f'Pipeline of {len(stages)} stages in {directory}:')
+    for i, stage in enumerate(stages, start=1):
+        existing = sum(bool(_glob_files(directory, pattern))
+                       for pattern in stage['outputs'])
+
+        logger.info(f'{i:>3} {stage["name"]}')
+        logger.info(f'        after: {", ".join(depends[stage["name"]]) or "-"}')
+        logger.info(f'        work: {work[stage["name"]]/1e6:,.1f} MB, '
+                    f'outputs existing: {existing}/{len(stage["outputs"])}')
+
+    logger.info(f'Estimated work: {sum(work.values())/1e6:,.1f} MB')
+
+    return work
+
+
+def _run_stage(stage: dict) -> float:
+    """Calls the function of a stage. Returns the run time in seconds."""
+
+    start = time.perf_counter()
+    stage['function'](*stage['args'], **stage['kwargs'])
+    return time.perf_counter() - start
+
+
+def run_pipeline(stages: list[dict], directory: Path, workers=1,
+                 dry_run=False) -> dict[str, str]:
+    """Runs every stage once all of the stages it depends on have finished,
+    with up to 'workers' stages running at once on separate processes. If a
+    stage fails, the stages depending on it are not run but independent
+    stages are, and the first exception is re-raised at the end. If dry_run
+    is True, the plan is logged and nothing is run.
+
+    Returns the status of each stage ('ok', 'failed', 'skipped' or
+    'planned').
+    """
+
+    depends = dependencies(stages)
+
+    if dry_run:
+        log_plan(stages, directory)
+        return {stage['name']: 'planned' for stage in stages}
+
+    status = {}
+    error = None
+    pending = list(stages)
+
+    def ready():
+        """Removes and returns the next pending stage which can start, marking
+        stages which depend on failures as skipped
+        """
+
+        for stage in list(pending):
+            states = [status.get(name) for name in depends[stage['name']]]
+            if any(state in ('failed', 'skipped') for state in states):
+                logger.warning(f'Skipping {stage["name"]}, which depends on '
+                               f'a failed stage')
+                status[stage['name']] = 'skipped'
+                pending.remove(stage)
+            elif all(state == 'ok' for state in states):
+                pending.remove(stage)
+                return stage
+        return None
+
+    if workers == 1:
+        while (stage := ready()) is not None:
+            logger.debug(f'Starting {stage["name"]}')
+            try:
+                _run_stage(stage)
+                status[stage['name']] = 'ok'
+            except Exception as exception:
+                logger.error(f'{stage["name"]} failed: '
+                             f'{type(exception).__name__}: {exception}')
+                status[stage['name']] = 'failed'
+                error = error or exception
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as executor:
+            running = {}
+
+            while True:
+                while len(running) < workers and (stage := ready()):
+                    logger.debug(f'Starting {stage["name"]}')
+                    running[executor.submit(_run_stage, stage)] = stage['name']
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        seconds = future.result()
+                        status[name] = 'ok'
+                        logger.debug(f'Finished {name} in {seconds:.1f} s')
+                    except Exception as exception:
+                        logger.error(f'{name} failed: '
+                                     f'{type(exception).__name__}: {exception}')
+                        status[name] = 'failed'
+                        error = error or exception
+
+    if error is not None:
+        raise error
+
+    return status
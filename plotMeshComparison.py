@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 
@@ -48,7 +49,7 @@ def main():
         timedirs.sort(key = lambda x: float(x.name))
     
         fname = linedir / timedirs[-1] / f'lineV6_qmean_Uprime_UAvg_omegaAvg_uRMS_omega_U_uTPrime2.xy'
-        data = np.genfromtxt(fname)
+        data = iotools.read_numeric(fname)
         height_idx = np.argmin(np.abs(data[:,0] - const.TURBINE_HUB_HEIGHT))
         U = const.WIND_ROTATION.apply(data[height_idx,7:10])
         
@@ -63,7 +64,7 @@ def main():
         timedirs.sort(key = lambda x: float(x.name))
     
         fname = linedir / timedirs[-1] / f'lineV3_qmean_Uprime_UAvg_omegaAvg_uRMS_omega_U_uTPrime2.xy'
-        data = np.genfromtxt(fname)
+        data = iotools.read_numeric(fname)
         height_idx = np.argmin(np.abs(data[:,0] - const.TURBINE_HUB_HEIGHT))
         U = const.WIND_ROTATION.apply(data[height_idx,7:10])
         
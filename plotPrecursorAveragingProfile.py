@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 LEVEL = logging.INFO
@@ -54,7 +55,7 @@ def main(casename):
             filepath = avgdir/filename
             
             logger.debug(f"Generating array from {filepath.stem}")
-            data = np.genfromtxt(filepath)
+            data = iotools.load(filepath)
             
             logger.debug(f"Plotting")
             ax.plot(data[:,1],data[:,0],
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 
@@ -30,13 +31,13 @@ def main():
         avgdir = casedir / const.SOWFATOOLS_DIR / 'averaging'
         
         fname = avgdir / f'{casename}_uu_mean.gz'
-        data = np.genfromtxt(fname)
+        data = iotools.load(fname)
         
         fname = avgdir / f'{casename}_vv_mean.gz'
-        data[:,1:] += np.genfromtxt(fname)[:,1:]
+        data[:,1:] += iotools.load(fname)[:,1:]
         
         fname = avgdir / f'{casename}_ww_mean.gz'
-        data[:,1:] += np.genfromtxt(fname)[:,1:]
+        data[:,1:] += iotools.load(fname)[:,1:]
         
         data[:,1:] /= 2
         
@@ -62,7 +63,7 @@ def main():
         for i,D in np.ndenumerate(range(2, 2*len(axs)+1, 2)):
             fname = linedir / timedirs[-1] / f'lineV{D}_kSGSmean_p_Q_TAvg_TTPrime2_epsilonSGSmean_nuSgs_kappat_nuSGSmean_T_kResolved_p_rghAvg_Tprime_kSGS_p_rgh_TRMS.xy'
             # UAvg contained in columns 1-3
-            data = np.genfromtxt(fname)
+            data = iotools.read_numeric(fname)
             # U = const.WIND_ROTATION.apply(data[:,7:10])
             
             axs[i].plot(data[:,11], data[:,0])
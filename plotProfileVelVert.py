@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +31,7 @@ def main():
         avgdir = casedir / const.SOWFATOOLS_DIR / 'averaging'
         
         fname = avgdir / f'{casename}_U_sw.gz'
-        data = np.genfromtxt(fname)
+        data = iotools.load(fname)
         
         with gzip.open(fname,mode='rt') as file:
             heights = (file.readline().removeprefix('#').split())[2:]
@@ -53,7 +54,7 @@ def main():
         for i,D in np.ndenumerate(range(2, 2*len(axs)+1, 2)):
             fname = linedir / timedirs[-1] / f'lineV{D}_qmean_Uprime_UAvg_omegaAvg_uRMS_omega_U_uTPrime2.xy'
             # UAvg contained in columns 7-9
-            data = np.genfromtxt(fname)
+            data = iotools.read_numeric(fname)
             U = const.WIND_ROTATION.apply(data[:,7:10])
             
             axs[i].plot(U[:,0], data[:,0])
@@ -8,11 +8,13 @@ import gzip as gz
 import numpy as np
 import matplotlib.pyplot as plt
 
+import iotools
+
 ################################################################################
 
 def plotU(case,turbine,label):
     file = f'{case}/sowfatools/turbineOutput/{case}_powerRotor_turbine{turbine}.gz'
-    data = np.loadtxt(file)
+    data = iotools.load(file)
     print(f'plotting case {case}, turbine {turbine}')
     plt.plot(data[:,0],data[:,2]*1e-6,label=label)
 
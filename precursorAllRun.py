@@ -4,14 +4,25 @@
 Part of github.com/NotDrJeff/sowfatools
 Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
 
-Runs a series of postProcessing functions on SOWFA precursor data.
+Runs a series of postProcessing functions on SOWFA precursor data. Each
+function is a stage declaring the files it reads and writes, and runs once the
+stages it depends on have finished (see pipeline.py). Cases are run in
+parallel on a pool of worker processes, each case logging to its own file, and
+a summary of the status and run time of every case is reported.
+
+As a script, takes an optional list of cases as command line arguments.
 """
 
 import logging
+
 import re
+import time
+import argparse
+import concurrent.futures
 
 import constants as const
 import utils
+import pipeline
 
 import precursorAveraging
 import precursorAveragingReduce
@@ -27,71 +38,309 @@ import precursorIntensityAlt
 import precursorPower
 import precursorVelocityChange
 import precursorConvectiveVelocity
+import precursorIntegralTimescale
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
 
 ################################################################################
 
-def precursorAllRun():
-    """Runs a series of postProcessing functions on SOWFA precursor data."""
+def precursorStages(casename, max_memory=None) -> list[dict]:
+    """Returns the postProcessing stages for one SOWFA precursor case, with
+    the files each reads and writes relative to the case directory.
+    max_memory (bytes) is passed to the functions which can work within it.
+    """
+
+    avgdir = const.SOWFATOOLS_DIR / 'averaging'
 
-    cases = [path for path in const.CASES_DIR.iterdir()
-             if path.is_dir() and re.fullmatch('p[0-9]{3}', path.name)]
+    def averaging(*quantities):
+        return [avgdir / f'{casename}_{quantity}.gz' for quantity in quantities]
 
-    logger.info('Found %s precursor cases', len(cases))
+    transform_inputs, transform_outputs = [], []
+    for quantities, suffixes in (
+            (precursorTransform.VECTOR_QUANTITIES,
+             precursorTransform.VECTOR_SUFFIXES),
+            (precursorTransform.SYMMTENSOR_QUANTITIES,
+             precursorTransform.SYMMTENSOR_SUFFIXES)):
+        for quantity, components in quantities.items():
+            transform_inputs += averaging(*components)
+            transform_outputs += averaging(*[f'{quantity}_{suffix}'
+                                             for suffix in suffixes])
 
-    for casedir in cases:
-        casename = casedir.name
+    derived = const.SOWFATOOLS_DIR / 'derived'
 
-        precursorAveraging.precursorAveraging(casename)
+    stages = [
+        pipeline.stage(precursorAveraging.precursorAveraging,
+                       ['postProcessing/averaging/*/*'], averaging('*'),
+                       casename, max_memory=max_memory),
         #precursorAveragingReduce.main(casename)  # This script requires updating.
-        precursorTransform.precursorTransform(casename)
+        pipeline.stage(precursorTransform.precursorTransform,
+                       transform_inputs, transform_outputs, casename,
+                       max_memory=max_memory),
 
-        precursorIntensity.precursorIntensity(casename)
-        precursorStability.precursor_richardson_gradient(casename)
-        precursorStability.precursor_richardson_flux(casename)
-        precursorStability.precursor_obukhov(casename)
+        pipeline.stage(precursorIntensity.precursorIntensity,
+                       averaging('U_mean_mag', 'uu_mean', 'vv_mean',
+                                 'ww_mean'),
+                       averaging('TI'), casename),
+        pipeline.stage(precursorStability.precursor_richardson_gradient,
+                       averaging('U_mean', 'V_mean', 'T_mean'),
+                       averaging('Ri'), casename),
+        pipeline.stage(precursorStability.precursor_richardson_flux,
+                       averaging('U_mean', 'V_mean', 'T_mean', 'uw_mean',
+                                 'vw_mean', 'Tw_mean'),
+                       averaging('Rf'), casename),
+        pipeline.stage(precursorStability.precursor_obukhov,
+                       averaging('T_mean', 'uw_mean', 'vw_mean', 'Tw_mean'),
+                       averaging('OL'), casename),
 
-        #precursorTdeviation.main(casename) # This script requires updating.
+        pipeline.stage(precursorTdeviation.precursorTdeviation,
+                       averaging('T_mean'),
+                       [derived / f'{casename}_Tdeviation.gz',
+                        derived / f'{casename}_Tdeviation_maxima.gz'],
+                       casename, max_memory=max_memory),
         #precursorSources.precursorSources(casename,times_to_report) # This script requires updating.
         #precursorSourcesReduce.main(casename,N) # This script requires updating.
+    ]
+
+    ############################################################################
+
+    if casename in ['p007','p006']: # Alt SGS model cases
+        width = 2000
+    else:
+        width = 3000
+
+    if casename in ['p002', 'p202', 'p005', 'p006', 'p007', 'p011', 'p013']:  # NBL
+       starttime = 18000
+
+    elif casename in ['p004']:  # NBL, later time window
+        starttime = 80000
+
+    elif casename in ['p003', 'p008', 'p012', 'p014']:  # CBL
+        starttime = 10000
+
+    elif casename in ['p001']: # Long runtime case
+        starttime = None
+        offset = 2000
+
+    else:
+        raise ValueError(f'Unknown case {casename}')
+
+    # p001 is a long run which we use to compare the evolution of profiles over time.
+    if casename == 'p001':
+        profiledir = const.SOWFATOOLS_DIR / f'profiles_w{width}_o{offset}'
+        stages.append(pipeline.stage(precursorProfile.precursorProfile,
+                                     [avgdir / '*.gz'], [profiledir / '*.gz'],
+                                     casename, width, offset=offset))
+        return stages
+
+    endtime = starttime + width
+    profiledir = const.SOWFATOOLS_DIR / f'profiles_{starttime}_{endtime}'
+
+    def profiles(*quantities):
+        return [profiledir / f'{casename}_{quantity}_{starttime}_{endtime}.gz'
+                for quantity in quantities]
+
+    stages += [
+        pipeline.stage(precursorProfile.precursorProfile,
+                       [avgdir / '*.gz'], [profiledir / '*.gz'],
+                       casename, width, starttime),
+        pipeline.stage(precursorIntensityAlt.precursorIntensityAlt,
+                       profiles('uu_mean', 'vv_mean', 'ww_mean'), [],
+                       casename, width, starttime),
+        pipeline.stage(precursorPower.precursorPower,
+                       profiles('U_mean_sw'), [], casename, width, starttime),
+        pipeline.stage(precursorIntegralTimescale.precursorIntegralTimescale,
+                       averaging('U_mean', 'V_mean'),
+                       [const.SOWFATOOLS_DIR / 'integralTimescale'
+                        / f'{casename}_integralTimescale_{starttime}.gz'],
+                       casename, starttime, max_memory=max_memory),
+        # precursorVelocityChange.precursorVelocityChange(casename, width, starttime) # Requres update
+        # precursorConvectiveVelocity.main() # Requires major refactoring
+    ]
+
+    return stages
+
+
+def precursorCase(casename, max_memory=None, workers=1, dry_run=False):
+    """Runs a series of postProcessing functions on one SOWFA precursor case,
+    each as soon as the stages whose outputs it reads have finished, with up
+    to 'workers' stages running at once. If dry_run is True, the plan and its
+    estimated work are logged instead.
+    """
+
+    stages = precursorStages(casename, max_memory)
+    pipeline.run_pipeline(stages, const.CASES_DIR / casename, workers,
+                          dry_run)
+
+
+def _initialise_worker(level):
+    """Removes console output inherited by worker processes, which would
+    interleave between cases. Each case logs to its own files instead.
+    """
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+        handler.close()
+
+    root_logger.setLevel(level)
 
-        ########################################################################
 
-        if casename in ['p007','p006']: # Alt SGS model cases
-            width = 2000
-        else:
-            width = 3000
+def _run_case(casename, max_memory=None,
+              stage_workers=1) -> tuple[str, str, str, float]:
+    """Runs precursorCase, with all of its output also logged to
+    log.precursorAllRun in the case's sowfatools directory. Errors are logged
+    rather than raised. Returns the case name, status, error message and run
+    time in seconds.
 
-        if casename in ['p002', 'p202', 'p005', 'p006', 'p007', 'p011', 'p013']:  # NBL
-           starttime = 18000
+    If max_memory (bytes) is given, it is shared between the stage workers,
+    and each stage which can plan its work within a budget is given its
+    share.
+    """
 
-        elif casename in ['p004']:  # NBL, later time window
-            starttime = 80000
+    sowfatoolsdir = const.CASES_DIR / casename / const.SOWFATOOLS_DIR
+    utils.create_directory(sowfatoolsdir)
 
-        elif casename in ['p003', 'p008', 'p012', 'p014']:  # CBL
-            starttime = 10000
+    root_logger = logging.getLogger()
+    case_handler = utils.create_file_handler(sowfatoolsdir/'log.precursorAllRun')
+    root_logger.addHandler(case_handler)
 
-        elif casename in ['p001']: # Long runtime case
-            starttime = None
-            offset = 2000
+    if max_memory is not None:
+        max_memory //= stage_workers
+        logger.debug(f'Memory budget of {casename} is '
+                     f'{max_memory/2**30:.1f} GiB per stage')
 
-        else:
-            raise ValueError('Unknown case %s',casename)
+    start = time.perf_counter()
+    try:
+        precursorCase(casename, max_memory, stage_workers)
+        status, message = 'ok', ''
+    except Exception as error:
+        logger.exception(f'{casename} failed')
+        status, message = 'failed', ': '.join(filter(None, (
+            type(error).__name__, str(error))))
+    finally:
+        utils.close_function_logger()
+        root_logger.removeHandler(case_handler)
+        case_handler.close()
+
+    return casename, status, message, time.perf_counter() - start
+
+
+def precursorAllRun(cases=None, workers=1, max_memory=None, stage_workers=1,
+                    dry_run=False, shard=None):
+    """Runs a series of postProcessing functions on SOWFA precursor data, for
+    'cases' or every pNNN case in const.CASES_DIR. Cases are run on 'workers'
+    processes, each within max_memory bytes where the functions allow it
+    (see _run_case), and up to 'stage_workers' independent stages of each
+    case run at once.
+    Returns (casename, status, message, seconds) for every case.
+
+    If dry_run is True, the stages of each case, their dependencies and
+    estimated work are logged instead, and nothing is run. If shard (i, N) is
+    given, only the cases of that shard are run, split by the size of their
+    averaging data.
+    """
+
+    if cases is None:
+        cases = sorted(path.name for path in const.CASES_DIR.iterdir()
+                       if path.is_dir()
+                       and re.fullmatch('p[0-9]{3}', path.name))
+
+    cases = utils.shard_units(cases,
+                              [utils.file_sizes((const.CASES_DIR / casename
+                                                 / 'postProcessing/averaging')
+                                                .rglob('*'))
+                               for casename in cases],
+                              shard)
+
+    if dry_run:
+        for casename in cases:
+            try:
+                precursorCase(casename, max_memory, dry_run=True)
+            except ValueError as error:
+                logger.error(f'{casename}: {error}')
+        return []
+
+    logger.info(f'Found {len(cases)} precursor cases. Running on {workers} '
+                f'workers')
+
+    start = time.perf_counter()
+    results = []
+
+    if workers == 1:
+        for casename in cases:
+            results.append(_run_case(casename, max_memory,
+                                     stage_workers))
+            logger.info(f'{casename} {results[-1][1]} after '
+                        f'{results[-1][3]:.0f} s')
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_initialise_worker,
+                initargs=(logging.getLogger().level,)) as executor:
+
+            futures = {executor.submit(_run_case, casename, max_memory,
+                                       stage_workers):
+                       casename for casename in cases}
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as error: # e.g. a worker killed by the OS
+                    results.append((futures[future], 'failed',
+                                    f'{type(error).__name__}: {error}',
+                                    float('nan')))
+                logger.info(f'{results[-1][0]} {results[-1][1]} after '
+                            f'{results[-1][3]:.0f} s')
+
+    ############################################################################
+
+    results.sort()
+    failed = [result for result in results if result[1] != 'ok']
+
+    logger.info(f'Finished {len(results)} cases in '
+                f'{time.perf_counter() - start:.0f} s, {len(failed)} failed')
+    logger.info(f'{"case":<8} {"status":<8} {"time (s)":>10}  message')
+    for casename, status, message, elapsed in results:
+        logger.info(f'{casename:<8} {status:<8} {elapsed:>10.1f}  {message}')
+
+    return results
 
-        # p001 is a long run which we use to compare the evolution of profiles over time.
-        if casename == 'p001':
-            precursorProfile.precursorProfile(casename,width,offset=offset)
-        else:
-            precursorProfile.precursorProfile(casename,width,starttime)
-            precursorIntensityAlt.precursorIntensityAlt(casename,width,starttime)
-            precursorPower.precursorPower(casename,width,starttime)
-            # precursorVelocityChange.precursorVelocityChange(casename, width, starttime) # Requres update
-            # precursorConvectiveVelocity.main() # Requires major refactoring
 
 ################################################################################
 
 if __name__ == '__main__':
     utils.configure_root_logger(level=LEVEL)
-    precursorAllRun()
+
+    DESCRIPTION = """Run postProcessing functions on SOWFA precursor cases"""
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('cases', help='list of cases to run (default: all '
+                        'pNNN cases)', nargs='*')
+    parser.add_argument('-j', '--workers', help='number of cases to run at '
+                        'once', type=int, default=1)
+    parser.add_argument('--max-memory', help='memory budget for each worker, '
+                        'e.g. 8G, shared between its stage workers. Stages '
+                        'which stitch, transform, stream or correlate data '
+                        'plan their work within it. The others read one '
+                        'averaging file at a time and are not limited',
+                        type=utils.parse_memory)
+    parser.add_argument('-s', '--stage-workers', help='number of independent '
+                        'stages of each case to run at once', type=int,
+                        default=1)
+    parser.add_argument('-n', '--dry-run', help='print the stages of each '
+                        'case and their estimated work without running them',
+                        action='store_true')
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
+
+    args = parser.parse_args()
+
+    logger.debug(f'Parsed the command line arguments: {args}')
+
+    results = precursorAllRun(args.cases or None, args.workers,
+                              args.max_memory, args.stage_workers,
+                              args.dry_run, args.shard)
+
+    if any(status != 'ok' for _, status, _, _ in results):
+        raise SystemExit(1)
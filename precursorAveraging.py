@@ -17,15 +17,86 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
 
+MEMORY_EXPANSION = 4 # peak memory per byte of (possibly compressed) input
+
 ################################################################################
 
-def precursorAveraging(casename, overwrite=False):
+def _stitch_quantity(casename, quantity, timefolders, manifest, writedir,
+                     header, heights, overwrite=False, append=False,
+                     max_memory=None):
+    """Stitches one averaging quantity from every time folder into writedir.
+    See precursorAveraging.
+    """
+
+    logger.info(f'Processing {quantity.stem} for {casename}')
+
+    writefile = writedir / (f'{casename}_{quantity.stem}.gz')
+    readfiles = [timefolder/quantity for timefolder in timefolders]
+    sources = iotools.manifest_sources(manifest, readfiles)
+    keep_rows = None
+
+    fingerprint = cache.fingerprint(
+        [iotools.manifest_resolve(manifest, readfile)[0]
+         for readfile in readfiles], code=[__file__])
+
+    if (writefile.exists() and append
+        and not cache.can_append([writefile], fingerprint)):
+        logger.warning(f'{writefile.name} was written by other code or '
+                       f'parameters. Rewriting.')
+
+    elif writefile.exists() and append:
+        plan = iotools.plan_append([writefile], readfiles, manifest)
+        if plan is None:
+            logger.warning(f'{writefile.name} cannot be appended to. '
+                           f'Rewriting.')
+        elif not plan[0]:
+            logger.info(f'{writefile.name} is up to date. '
+                        f'Skipping {quantity.stem}.')
+            cache.record([writefile], fingerprint)
+            return
+        else:
+            readfiles, cutoff = plan
+            keep_rows = iotools.rows_before(writefile, cutoff)
+            logger.info(f'Appending {len(readfiles)} time folders from '
+                        f'time {cutoff}')
+
+    elif cache.is_current([writefile], fingerprint) and overwrite is False:
+        logger.warning(f'{writefile.name} is up to date. '
+                       f'Skipping {quantity.stem}.')
+        return
+
+    # Rows are streamed from each time folder straight to the output
+    blocks = iotools.stitch_time_folders(readfiles, sorting_index=0,
+                                         manifest=manifest,
+                                         max_memory=max_memory)
+
+    logger.debug(f'Saving file {writefile.name}')
+    iotools.write_blocks(writefile, blocks, header=header, fmt='%.12g',
+                         binary=True, heights=heights, keep_rows=keep_rows,
+                         sources=sources)
+
+    cache.record([writefile], fingerprint)
+
+
+def precursorAveraging(casename, overwrite=False, append=False, workers=1,
+                       max_memory=None, shard=None):
     """Stitches SOWFA precursor averaging files from mutliple run start times
     together, removing overlaps. Takes a list of cases as command line arguments.
+    
+    If append is True, existing files are brought up to date by reading only
+    new time folders and appending to the stitched data.
+    
+    Quantities are stitched on 'workers' processes, largest first, with as
+    many running at once as fit within max_memory bytes (estimated as
+    MEMORY_EXPANSION times their input file sizes). Each worker reads files
+    in blocks of rows which fit within its share of max_memory. If shard
+    (i, N) is given, only the quantities of that shard are stitched.
     """
 
     casedir = const.CASES_DIR / casename
@@ -52,21 +123,21 @@ def precursorAveraging(casename, overwrite=False):
     writedir = sowfatoolsdir / 'averaging'
     utils.create_directory(writedir)
 
-    timefolders = [timefolder for timefolder in readdir.iterdir()]
-    timefolders.sort(key=lambda x: float(x.name))
+    manifest = iotools.scan_directory(casedir, 'postProcessing/averaging')
+    timefolders = iotools.manifest_timefolders(casedir,
+                                               'postProcessing/averaging',
+                                               manifest)
 
-    quantities = set()
-    for timefolder in timefolders:
-        for file in timefolder.iterdir():
-            if file.stem != 'hLevelsCell':
-                quantities.add(Path(file.name))
+    quantities = sorted(Path(quantity) for quantity
+                        in iotools.manifest_quantities(manifest)
+                        if quantity != 'hLevelsCell')
 
     logger.info(f'Found {len(quantities)} quantities across '
                 f'{len(timefolders)} time folders')
 
     for timefolder in timefolders:
         try:
-            heights = np.genfromtxt(timefolder/'hLevelsCell')
+            heights = iotools.read_numeric(timefolder/'hLevelsCell').ravel()
             break
         except FileNotFoundError:
             continue
@@ -81,32 +152,24 @@ def precursorAveraging(casename, overwrite=False):
 
     ############################################################################
 
-    for quantity in quantities:
-        logger.info(f'Processing {quantity.stem} for {casename}')
-
-        writefile = writedir / (f'{casename}_{quantity.stem}.gz')
-        if writefile.exists() and overwrite is False:
-            logger.warning(f'{writefile} exists. Skipping {quantity.stem}.')
-            continue
+    sizes = {quantity: iotools.manifest_size(manifest,
+                                             [timefolder/quantity
+                                              for timefolder in timefolders])
+             for quantity in quantities}
 
-        for timefolder in timefolders:
-            readfile = timefolder / quantity
-            logger.debug(f'Reading {readfile}')
-            rawdata = np.genfromtxt(readfile)
-            if 'data' not in locals():
-                data = np.array(rawdata)
-            else:
-                data = np.vstack((data,rawdata))
+    quantities = utils.shard_units(quantities,
+                                   [sizes[quantity] for quantity in quantities],
+                                   shard, key=casename)
 
-            del rawdata  # Deleted for memory efficiency only
+    # Quantities are independent, so they can be stitched in parallel
+    block_memory = None if max_memory is None else max_memory // workers
+    tasks = [(casename, quantity, timefolders, manifest, writedir, header,
+              heights, overwrite, append, block_memory)
+             for quantity in quantities]
 
-        data = utils.remove_overlaps(data,0)
-
-        writefile = writedir / (f'{casename}_{quantity.stem}.gz')
-        logger.debug(f'Saving file {writefile.name}')
-        np.savetxt(writefile,data,header=header,fmt='%.12g')
-
-        del data  # Must be deleted for next loop to work
+    utils.run_tasks(_stitch_quantity, tasks,
+                    [sizes[quantity] for quantity in quantities], workers,
+                    max_memory, expansion=MEMORY_EXPANSION)
 
     logger.info(f'Finished processing averaging for case {casename}')
 
@@ -122,10 +185,20 @@ if __name__ == '__main__':
                         nargs='+')
     parser.add_argument('-o','--overwrite', help='option to overwrite exisiting files',
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('-a','--append', help='option to append new time folders to exisiting files',
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('-j', '--workers', help='number of quantities to '
+                        'stitch at once', type=int, default=1)
+    parser.add_argument('--max-memory', help='memory budget for all workers, '
+                        'e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
 
     args = parser.parse_args()
 
     logger.debug(f'Parsed the command line arguments: {args}')
 
     for casename in args.cases:
-        precursorAveraging(casename,args.overwrite)
+        precursorAveraging(casename,args.overwrite,args.append,args.workers,
+                           args.max_memory,args.shard)
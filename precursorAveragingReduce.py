@@ -7,13 +7,13 @@ plotting purposes"""
 
 import logging
 import sys
-import gzip
 from pathlib import Path
 
 import numpy as np
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 LEVEL = logging.DEBUG
@@ -31,26 +31,16 @@ def main(casename, N=10, heights_to_keep=[const.TURBINE_HUB_HEIGHT,250,500],
 		filename = (avgdir / f'{casename}_{quantity}.gz')
 
 		logger.debug(f"Reading heights from {filename}")
-		with gzip.open(filename, mode='rt') as file:
-			header = file.readline().split()[3::2]
-
-		heights = np.array([(i.split('_')[-1]) for i in header],dtype=int)
-		
-		# create array of indices for keeping time and selected heights
-		idx = np.empty(len(heights_to_keep)+1, dtype=int)
-		idx[0] = 0
-		for i, height in enumerate(heights_to_keep):
-			idx[i+1] = np.argmin(np.abs(heights - height))
-		
-		# offset idx to ignore time, dt and averages columns
-		idx[1:] = 2*idx[1:] + 2
+		idx, heights = iotools.height_columns(filename, heights_to_keep)
+		logger.debug(f"Using columns {idx} at heights {heights}")
 
+		# Only the time column and selected heights are read
 		logger.info(f"Generating array from {filename}")
-		data = np.genfromtxt(filename)
+		data = iotools.load(filename, usecols=[0, *idx])
 
 		logger.debug(f"Reducing dataset. {N=}")
 		org_size = data.shape
-		data = data[::N,idx] # keep time column and select heights
+		data = data[::N]
 		new_size = data.shape
 
 		logger.debug(f"Reduced data from {org_size} to {new_size}")
@@ -60,7 +50,7 @@ def main(casename, N=10, heights_to_keep=[const.TURBINE_HUB_HEIGHT,250,500],
 
 		header = ' '.join(['time'] + [f'{i}m' for i in heights_to_keep])
 
-		np.savetxt(filename, data, fmt='%.4g', header=header)
+		iotools.savetxt(filename, data, fmt='%.4g', header=header)
 
 if __name__=="__main__":
     main(sys.argv[1])
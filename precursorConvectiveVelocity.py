@@ -1,8 +1,10 @@
 import numpy as np
 
+import iotools
+
 def main():
-    resolved_vertical_flux = np.loadtxt('p001_Tw_mean_16000_20000.gz')
-    sgs_vertical_flux = np.loadtxt('p001_q3_mean_16000_20000.gz')
+    resolved_vertical_flux = iotools.read_numeric('p001_Tw_mean_16000_20000.gz')
+    sgs_vertical_flux = iotools.read_numeric('p001_q3_mean_16000_20000.gz')
 
     total_vertical_flux = resolved_vertical_flux
     total_vertical_flux[:,1] += sgs_vertical_flux[:,1]
@@ -1,52 +1,169 @@
 #!/usr/bin/env python3
 
-import gzip as gz
+"""Compatible with Python 3.13, SOWFA 2.4.x
+Part of github.com/NotDrJeff/sowfatools
+Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
+
+Calculates integral time scales of velocity fluctuations at every height from
+SOWFA precursor averaging data. Assumes data has been stitched with
+precursorAveraging.py
+
+As a script, takes a list of cases as command line arguments.
+"""
+
+import logging
+
+import argparse
 
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.interpolate as interpolate
 
+import constants as const
+import utils
+import iotools
+import cache
+
+LEVEL = logging.INFO
+logger = logging.getLogger(__name__)
+
+QUANTITIES = ('U_mean', 'V_mean')
+
+################################################################################
+
+def precursorIntegralTimescale(casename, starttime=None, quantities=QUANTITIES,
+                               overwrite=False, max_memory=None):
+    """Calculates integral time scales of velocity fluctuations at every height
+    from SOWFA precursor averaging data, from 'starttime' if given.
+
+    Each history is resampled to uniform time steps, and the autocorrelation
+    of its fluctuations is integrated up to the first zero crossing. If
+    max_memory (bytes) is given, heights are processed in chunks of columns
+    which fit within it.
+    """
+
+    casedir = const.CASES_DIR / casename
+    sowfatoolsdir = casedir / const.SOWFATOOLS_DIR
+    readdir = sowfatoolsdir / 'averaging'
+
+    if not readdir.is_dir():
+        logger.warning(f'{readdir} directory does not exist. '
+                       f'Skipping {casename}.')
+        return
+
+    logfilename = 'log.precursorIntegralTimescale'
+    utils.configure_function_logger(sowfatoolsdir/logfilename, level=LEVEL)
+
+    ############################################################################
+
+    logger.info(f'Calculating integral time scales for {casename}')
+
+    writedir = sowfatoolsdir / 'integralTimescale'
+    utils.create_directory(writedir)
+
+    if starttime is None:
+        writefile = writedir / f'{casename}_integralTimescale.gz'
+    else:
+        writefile = writedir / f'{casename}_integralTimescale_{starttime}.gz'
+
+    readfiles = [readdir / f'{casename}_{quantity}.gz'
+                 for quantity in quantities]
+
+    for readfile in readfiles:
+        if not readfile.is_file():
+            logger.warning(f'{readfile.name} does not exist. '
+                           f'Skipping {casename}.')
+            return
+
+    fingerprint = cache.fingerprint(readfiles, {'starttime': starttime,
+                                                'quantities': quantities},
+                                    code=[__file__])
+    if cache.is_current([writefile], fingerprint) and overwrite is False:
+        logger.warning(f'{writefile.name} is up to date. '
+                       f'Skippping {casename}.')
+        return
+
+    columns, heights = iotools.height_columns(readfiles[0])
+    rows, _ = iotools.read_shape(readfiles[0])
+
+    timescales = np.empty((heights.shape[0], len(quantities)))
+
+    ############################################################################
+
+    for i, (quantity, readfile) in enumerate(zip(quantities, readfiles)):
+        logger.info(f'Processing {quantity}')
+
+        # Each height is correlated independently, so heights can be processed
+        # in chunks
+        for chunk in utils.column_chunks(columns, rows, max_memory, copies=6):
+            logger.debug(f'Reading {readfile} columns {chunk[0]}-{chunk[-1]}')
+            data = iotools.load(readfile, usecols=[0, *chunk])
+
+            if starttime is not None:
+                data = data[data[:,0] >= starttime]
+
+            if data.shape[0] < 2:
+                logger.warning(f'Too few times in {readfile.name}. '
+                               f'Skipping {casename}.')
+                return
+
+            times, velocity = utils.resample_uniform(data[:,0], data[:,1:])
+            del data
+
+            velocity -= np.mean(velocity, axis=0)
+            correlation = utils.autocorrelation(velocity)
+            del velocity
+
+            first = columns.index(chunk[0])
+            timescales[first:first+len(chunk), i] = utils.integral_timescale(
+                correlation, times[1] - times[0])
+            del correlation
 
-U = np.loadtxt('p001_U_mean.gz')
-V = np.loadtxt('p001_V_mean.gz')
+        logger.info(f'Integral time scale of {quantity} ranges from '
+                    f'{np.nanmin(timescales[:,i]):.5g} to '
+                    f'{np.nanmax(timescales[:,i]):.5g} s')
 
-U = U[(U[:,0]>=18000),:]
-V = V[(V[:,0]>=18000),:]
+    data = np.column_stack((heights, timescales))
+    header = ' '.join(['heights_m', *quantities])
 
-with gz.open('p001_U_mean.gz', 'rt') as f:
-    header = f.readline()
-    
-header = header.removeprefix('# ').split()
-idx = (header.index('85m'),header.index('245m'),header.index('495m'))
+    logger.info(f'Saving file {writefile}')
+    iotools.savetxt(writefile, data, fmt='%.12g', header=header)
+    cache.record([writefile], fingerprint)
 
-t  = U[:,0]
-dt = U[:,1]
-t_uniform = np.linspace(t[0],t[-1],t.size)
-dt_uniform = t_uniform[1] - t_uniform[0]
+    logger.info(f'Finished calculating integral time scales for {casename}')
 
-U = U[:,idx]
-V = V[:,idx]
 
-u = U - np.average(U,axis=0)
-v = V - np.average(V,axis=0) 
+################################################################################
 
-for i,_ in enumerate(idx):
-    for j,vel in enumerate((u[:,i],v[:,i])):
-        interpolation_function = interpolate.interp1d(t,vel,kind='linear')
-        vel_uniform = interpolation_function(t_uniform)
+if __name__ == '__main__':
+    utils.configure_root_logger(level=LEVEL)
 
-        R = np.correlate(vel_uniform,vel_uniform,mode='full')
-        R = R[R.size//2:] # keep only positive lags (symmetry)
-        N_i = vel.size - np.arange(R.size)        
-        R /= N_i
-        R /= R[0] # normalize
+    DESCRIPTION = """Calculate integral time scales of velocity fluctuations at
+                     every height"""
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('cases', help='list of cases to perform analysis for',
+                        nargs='+')
+    parser.add_argument('-t', '--starttime', help='time from which to include '
+                        'data', type=float)
+    parser.add_argument('-q', '--quantities', help='averaging quantities to '
+                        'use', nargs='+', default=list(QUANTITIES))
+    parser.add_argument('-o', '--overwrite',
+                        help='option to overwrite exisiting files',
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--max-memory', help='memory budget for the '
+                        'correlations, e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
 
-        lag = np.arange(R.size) * dt_uniform
+    args = parser.parse_args()
 
-        zero_idx = np.nonzero(R<=0)[0] # where returns tuple of arrays.
-        zero_idx = zero_idx[0] if len(zero_idx) > 0 else R.size
-            # Find first time R is 0 or less.
+    logger.debug(f'Parsed the command line arguments: {args}')
 
-        integral = np.trapezoid(R[:zero_idx],lag[:zero_idx])
+    # Each case is one unit of work, sized by its inputs
+    sizes = [utils.file_sizes(const.CASES_DIR / casename / const.SOWFATOOLS_DIR
+                              / 'averaging' / f'{casename}_{quantity}.gz'
+                              for quantity in args.quantities)
+             for casename in args.cases]
 
-        print(f'Height {i}, Component {j} : {integral} s')
+    for casename in utils.shard_units(args.cases, sizes, args.shard):
+        precursorIntegralTimescale(casename, args.starttime, args.quantities,
+                                   args.overwrite, args.max_memory)
@@ -23,13 +23,17 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
 
+QUANTITIES = ('U_mean_mag', 'uu_mean', 'vv_mean', 'ww_mean')
+
 ################################################################################
 
-def precursorIntensity(casename, overwrite=False):
+def precursorIntensity(casename, overwrite=False, append=False):
     """Calculates turbulence intensity from SOWFA precursor averaging data.
     This version calculates an intensity for each time step, using the mean
     velocity at the local height. For an alternative formulation in line with
@@ -37,6 +41,9 @@ def precursorIntensity(casename, overwrite=False):
     
     TI = rms(u)/U
        = sqrt[ 1/3 * (ux^2 + uy^2 + uz^2) ] / sqrt[ Ux^2 + Uy^2 + Uz^2 ]
+    
+    If append is True, only rows which are new or have changed since an
+    existing file was written are recalculated.
     """
     
     casedir = const.CASES_DIR / casename
@@ -56,15 +63,21 @@ def precursorIntensity(casename, overwrite=False):
     logger.info(f"Calculating turbulence intensity for {casename}")
     
     writefile = avgdir/f'{casename}_TI.gz'
-    if writefile.exists() and overwrite is False:
-        logger.warning(f'{writefile.name} already exists. '
-                       f'Skippping {casename}.')
-        return
     
     # We assume resolved mean velocity magnitude has already been calculated by
     # precursorTransform
     
-    readfile = avgdir/f'{casename}_U_mean_mag.gz'
+    readfiles = [avgdir / f'{casename}_{quantity}.gz'
+                 for quantity in QUANTITIES]
+    
+    fingerprint = cache.fingerprint(readfiles, code=[__file__])
+    if (cache.is_current([writefile], fingerprint) and overwrite is False
+        and not append):
+        logger.warning(f'{writefile.name} is up to date. '
+                       f'Skippping {casename}.')
+        return
+    
+    readfile = readfiles[0]
     if not readfile.is_file():
         logger.warning(f'{readfile.name} file does not exist. '
                        f'Skipping {casename}')
@@ -75,20 +88,33 @@ def precursorIntensity(casename, overwrite=False):
         
     header = header.removeprefix('# ').removesuffix('\n')
     
+    start = 0
+    if (writefile.exists() and append
+        and not cache.can_append([writefile], fingerprint)):
+        logger.warning(f'{writefile.name} was written by other code or '
+                       f'parameters. Rewriting {casename}.')
+    elif writefile.exists() and append:
+        start = iotools.valid_rows(writefile, readfiles)
+        logger.info(f'Recalculating from row {start}')
+    
     logger.debug(f'Reading {readfile}')
-    U = np.loadtxt(readfile)
+    U = iotools.load(readfile)[start:]
+    
+    if start and U.shape[0] == 0:
+        logger.info(f'{writefile.name} is up to date. Skipping {casename}.')
+        cache.record([writefile], fingerprint)
+        return
         
     ############################################################################
 
-    for quantity in ('uu_mean', 'vv_mean', 'ww_mean'):
-        readfile = avgdir / f'{casename}_{quantity}.gz'
+    for readfile in readfiles[1:]:
         if not readfile.is_file():
             logger.warning(f'{readfile.name} file does not exist. '
                            f'Skipping {casename}')
             return
         
         logger.debug(f'Reading {readfile}')
-        rawdata = np.genfromtxt(readfile)
+        rawdata = iotools.load(readfile)[start:]
         
         if 'TI' not in locals():
             TI = rawdata
@@ -100,7 +126,11 @@ def precursorIntensity(casename, overwrite=False):
     TI[:,2:] = np.sqrt(TI[:,2:]/3) / U[:,2:]
     
     logger.info(f'Saving file {writefile.name}')
-    np.savetxt(writefile,TI,header=header,fmt='%.12g')
+    iotools.write_blocks(writefile, [TI], header=header, fmt='%.12g',
+                         binary=True, keep_rows=start or None,
+                         inputs=iotools.input_revisions(readfiles))
+    
+    cache.record([writefile], fingerprint)
 
 
 ################################################################################
@@ -114,11 +144,22 @@ if __name__ == '__main__':
                         nargs='+')
     parser.add_argument('-o', '--overwrite', help='option to overwrite exisiting files',
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('-a', '--append', help='option to only recalculate new or changed rows',
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
-    for casename in args.cases:
-        precursorIntensity(casename, args.overwrite)
+    # Each case is one unit of work, sized by its inputs
+    sizes = [utils.file_sizes(const.CASES_DIR / casename / const.SOWFATOOLS_DIR
+                              / 'averaging' / f'{casename}_{quantity}.gz'
+                              for quantity in QUANTITIES)
+             for casename in args.cases]
+    
+    for casename in utils.shard_units(args.cases, sizes, args.shard):
+        precursorIntensity(casename, args.overwrite, args.append)
         
\ No newline at end of file
@@ -27,6 +27,7 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
 
 
 ################################################################################
@@ -54,7 +55,7 @@ def precursorIntensityAlt(casename, width, starttime, overwrite=False):
     for quantity in ['uu_mean', 'vv_mean', 'ww_mean']:
         fname = datadir / f'{casename}_{quantity}_{starttime}_{endtime}.gz'
         logger.debug(f'Reading {fname}')
-        rawdata = np.genfromtxt(fname)
+        rawdata = iotools.load(fname, usecols=[0,1]) # heights and first window
 
         if 'uu' not in locals():
             heights = rawdata[:,0]
@@ -17,6 +17,7 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
@@ -45,7 +46,7 @@ def precursorPower(casename : str, width : int, starttime=0, tilt=0):
 
     readfile = datadir / f'{casename}_U_mean_sw_{starttime}_{endtime}.gz'
     logger.debug(f'Reading {readfile}')
-    data = np.genfromtxt(readfile)
+    data = iotools.load(readfile)
 
     rotor_bottom = const.TURBINE_HUB_HEIGHT - const.TURBINE_RADIUS
     rotor_top    = const.TURBINE_HUB_HEIGHT + const.TURBINE_RADIUS
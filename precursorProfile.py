@@ -21,6 +21,8 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
@@ -28,13 +30,14 @@ logger = logging.getLogger(__name__)
 ################################################################################
 
 def precursorProfile(casename: str, width: int, starttime=None, offset=None,
-                     overwrite=False):
+                     overwrite=False, shard=None):
     """Calculates time-average from SOWFA precursor averaging files for every height.
     The casename and the time window width must be specified as command line
     arguments. The user must also specify either a starttime or an offset.
     Specifying a startime will mean one average is taken from that startime.
     Specifying an offset means that multiple averages are taken, each one starting
-    an offset from the previous.""" 
+    an offset from the previous. If shard (i, N) is given, only the quantities
+    of that shard are averaged.""" 
 
     casedir = const.CASES_DIR / casename
     sowfatoolsdir = casedir / const.SOWFATOOLS_DIR
@@ -68,7 +71,9 @@ def precursorProfile(casename: str, width: int, starttime=None, offset=None,
 
     utils.create_directory(writedir)
 
-    readfiles = [readfile for readfile in readdir.iterdir()]
+    # Binary sidecars are read through their text file
+    readfiles = [readfile for readfile in readdir.iterdir()
+                 if readfile.suffix == '.gz']
     logger.info(f'Found {len(readfiles)} quantities')
 
     logger.debug(f'Reading heights from {readfiles[0].name}')
@@ -76,6 +81,11 @@ def precursorProfile(casename: str, width: int, starttime=None, offset=None,
         heights = f.readline().split()[3:]
     heights = np.array([i.removesuffix('m') for i in heights],dtype=int)
 
+    readfiles = utils.shard_units(sorted(readfiles),
+                                  [utils.file_sizes([readfile])
+                                   for readfile in sorted(readfiles)],
+                                  shard, key=casename)
+
     ############################################################################
 
     first_readfile = True
@@ -90,13 +100,17 @@ def precursorProfile(casename: str, width: int, starttime=None, offset=None,
             writefile = writedir / f'{readfile.stem}_w{width}_o{offset}.gz'
             header = 'heights_m'
 
-        if writefile.exists() and overwrite is False:
-            logger.warning(f'{writefile.name} already exists. '
-                           f'Skippping {casename}.')
+        fingerprint = cache.fingerprint([readfile], {'width': width,
+                                                     'starttime': starttime,
+                                                     'offset': offset},
+                                        code=[__file__])
+        if cache.is_current([writefile], fingerprint) and overwrite is False:
+            logger.warning(f'{writefile.name} is up to date. '
+                           f'Skippping {quantity}.')
             continue
 
         logger.debug(f'Reading {readfile}')
-        fulldata = np.genfromtxt(readfile)
+        fulldata = iotools.load(readfile)
 
         ########################################################################
 
@@ -132,29 +146,28 @@ def precursorProfile(casename: str, width: int, starttime=None, offset=None,
         else:
             data_to_write = np.array(heights)
 
-        for i in range(N_windows):
-            if not starttime_mode:
-                starttime = lower_time_limit + offset*i # type: ignore
-                endtime = starttime + width
-                header = header + f' {starttime}_{endtime}'
-
-            startidx = np.argmin(np.abs(fulldata[:,0] - starttime))
-            endidx = np.argmin(np.abs(fulldata[:,0] - endtime))
+        if starttime_mode:
+            starttimes = np.array([starttime])
+        else:
+            starttimes = lower_time_limit + offset*np.arange(N_windows) # type: ignore
+            header = header + ''.join(f' {start}_{start+width}'
+                                      for start in starttimes)
 
-            logger.debug(f'Calculating time average for range '
-                         f'{starttime:=7,} - {endtime:=7,} s')
+        # Window edges are the nearest times, and all windows are averaged
+        # from one cumulative sum
+        startidx = utils.nearest_index(fulldata[:,0], starttimes)
+        endidx = utils.nearest_index(fulldata[:,0], starttimes + width)
 
-            average_profile = np.average(fulldata[startidx:endidx+1,2:],
-                                         axis=0,
-                                         weights=fulldata[startidx:endidx+1,1])
-            
-            if quantity == 'Tu_sw':
-                import pdb; pdb.set_trace()
+        logger.debug(f'Calculating time averages for {N_windows} windows')
+        average_profiles = utils.interval_averages(fulldata[:,2:], startidx,
+                                                   endidx,
+                                                   weights=fulldata[:,1])
 
-            data_to_write = np.column_stack((data_to_write,average_profile))
+        data_to_write = np.column_stack((data_to_write,average_profiles.T))
 
         logger.info(f"Saving file {writefile}")
-        np.savetxt(writefile, data_to_write, fmt='%.12g', header=header)
+        iotools.savetxt(writefile, data_to_write, fmt='%.12g', header=header)
+        cache.record([writefile], fingerprint)
 
     logger.info(f'Finished processing case {casename}.')
 
@@ -183,7 +196,11 @@ if __name__ == '__main__':
     
     parser.add_argument('-o','--overwrite', help='option to overwrite exisiting files',
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
 
     args = parser.parse_args()
 
-    precursorProfile(args.casename, args.width, args.starttime, args.restart, args.overwrite)
+    precursorProfile(args.casename, args.width, args.starttime, args.restart, args.overwrite,
+                     args.shard)
@@ -23,6 +23,8 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 
 ################################################################################
@@ -53,72 +55,92 @@ def precursorSources(casename, times_to_report, overwrite=False):
     writedir = sowfatoolsdir / 'SourceHistory'
     utils.create_directory(writedir)
     
-    timefolders = [timefolder for timefolder in readdir.iterdir()]
-    timefolders.sort(key=lambda x: float(x.name))
+    manifest = iotools.scan_directory(casedir, 'postProcessing/SourceHistory')
+    timefolders = iotools.manifest_timefolders(casedir,
+                                               'postProcessing/SourceHistory',
+                                               manifest)
+    if not timefolders:
+        logger.warning(f'No time folders found in {readdir}. '
+                       f'Skipping case {casename}.')
+        return
     
     QUANTITIES = ['SourceUXHistory.gz','SourceUYHistory.gz']
     HEADER = 'time dt Sx Sy Smag Savg_x Savg_y Savg_mag'
     
-    ############################################################################
+    writefile = writedir / (f'{casename}_sourceMomentum.gz')
     
-    for quantity in QUANTITIES:
-        logger.info(f'Processing {quantity} for {casename}')
-        
-        writefile = writedir / (f'{casename}_{quantity}')
-        if writefile.exists() and overwrite is False:
-            logger.warning(f'{writefile} exists. Skipping {quantity.stem}.')
-            continue
-        
-        for timefolder in timefolders:
-            readfile = timefolder / quantity
-            logger.debug(f'Reading {readfile}')
-            data_for_current_time = np.genfromtxt(readfile, skip_header=1)
-            if 'data_for_current_quantity' in locals():
-                data_for_current_quantity = \
-                    np.vstack((data_for_current_quantity,
-                               data_for_current_time))
-            else:
-                data_for_current_quantity = data_for_current_time
-            
-            # data must be deleted for the next loop to work correctly
-            del data_for_current_time
-        
-        data_for_current_quantity = \
-            utils.remove_overlaps(data_for_current_quantity,0)
-        
-        if 'completedata' in locals():
-            completedata = np.column_stack((completedata,
-                                            data_for_current_quantity[:,2]))
-        else:
-            completedata = data_for_current_quantity
-        
-        # data must be deleted for the next loop to work correctly
-        del data_for_current_quantity
+    readfiles = {quantity: [timefolder/quantity for timefolder in timefolders]
+                 for quantity in QUANTITIES}
+    fingerprint = cache.fingerprint(
+        [iotools.manifest_resolve(manifest, readfile)[0]
+         for quantity in QUANTITIES for readfile in readfiles[quantity]],
+        code=[__file__])
+    if cache.is_current([writefile], fingerprint) and overwrite is False:
+        logger.warning(f'{writefile.name} is up to date. '
+                       f'Skipping case {casename}.')
+        return
     
     ############################################################################
     
-    mag = np.linalg.norm(completedata[:,2:4],axis=1)
-    completedata = np.column_stack((completedata,mag))
-
-    for i,_ in enumerate(QUANTITIES):
-        average = utils.calculate_moving_average(completedata,i+2,1)
-        completedata = np.column_stack((completedata,average))
+    logger.info(f'Processing {", ".join(QUANTITIES)} for {casename}')
     
-    mag = np.linalg.norm(completedata[:,5:7],axis=1)
-    completedata = np.column_stack((completedata,mag))
+    # Each quantity is streamed one time folder at a time
+    blocks = [iotools.stitch_time_folders(readfiles[quantity], sorting_index=0,
+                                          skip_header=1, manifest=manifest)
+              for quantity in QUANTITIES]
     
-    writefile = writedir / (f'{casename}_sourceMomentum.gz')
-    logger.debug(f'Saving file {writefile.name}')
-    np.savetxt(writefile,completedata,header=HEADER,fmt='%.12g')
+    report = None
+    if times_to_report is not None:
+        report = {time: (np.inf, np.nan) for time in times_to_report}
+    
+    iotools.write_blocks(writefile, _source_blocks(*blocks, report),
+                         header=HEADER, fmt='%.12g', binary=True)
+    cache.record([writefile], fingerprint)
     
     # Report running average at specified times if requested
-    if times_to_report is not None:
-        time_indices = np.array([np.argmin(np.abs(completedata[:,0] - time))
-                                for time in times_to_report])
+    if report is not None:
+        for time, (_, average) in report.items():
+            logger.info(f'Average after {time} s is {average:.3e}')
+
+
+def _source_blocks(blocks_x, blocks_y, report=None):
+    """Generator which combines blocks of x and y source history into rows of
+    time, dt, source, source magnitude, running average and running average
+    magnitude. Running sums are carried between blocks. If report is given,
+    it maps times to (distance, average magnitude) of the nearest row so far,
+    and is updated in place.
+    """
+    
+    total = np.zeros(2)
+    weight_total = 0.0
+    
+    for block_x, block_y in zip(blocks_x, blocks_y, strict=True):
+        if (block_x.shape[0] != block_y.shape[0]
+            or not np.array_equal(block_x[:,0], block_y[:,0])):
+            raise ValueError('x and y source histories have different times')
         
-        for i, time in np.ndenumerate(times_to_report):
-            logger.info(f'Average after {time} s is '
-                        f'{completedata[time_indices[i],-1]:.3e}')
+        source = np.column_stack((block_x[:,2], block_y[:,2]))
+        dt = block_x[:,1]
+        
+        weighted = source * dt[:,np.newaxis]
+        average = ((total + np.cumsum(weighted, axis=0))
+                   / (weight_total + np.cumsum(dt))[:,np.newaxis])
+        total += weighted.sum(axis=0)
+        weight_total += dt.sum()
+        
+        average_mag = np.linalg.norm(average, axis=1)
+        data = np.column_stack((block_x[:,:2], source,
+                                np.linalg.norm(source, axis=1),
+                                average, average_mag))
+        
+        if report is not None and data.shape[0] > 0:
+            for time, (distance, _) in report.items():
+                index = np.argmin(np.abs(data[:,0] - time))
+                if abs(data[index,0] - time) < distance:
+                    report[time] = (abs(data[index,0] - time),
+                                    average_mag[index])
+        
+        yield data
 
 
 ################################################################################
@@ -134,10 +156,19 @@ if __name__ == '__main__':
     
     parser.add_argument("-t", "--times", help="What times to report",
                         nargs='*', type=int)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
-    for casename in args.cases:
+    # Each case is one unit of work, sized by its inputs
+    sizes = [utils.file_sizes((const.CASES_DIR / casename
+                               / 'postProcessing/SourceHistory')
+                              .glob('*/SourceU?History*'))
+             for casename in args.cases]
+    
+    for casename in utils.shard_units(args.cases, sizes, args.shard):
         precursorSources(casename, args.times)
@@ -15,6 +15,7 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 LEVEL = logging.DEBUG
@@ -36,7 +37,7 @@ def main(casename,N):
 	header = ' '.join(header)
 
 	logger.info(f"Generating array from {filename}")
-	data = np.genfromtxt(filename)
+	data = iotools.load(filename)
 
 	logger.debug(f"Reducing dataset. {N=}")
 	org_size = data.shape
@@ -48,7 +49,7 @@ def main(casename,N):
 
 	filename = srcdir / f'{casename}_sourceMomentum_reduced.gz'
 	logger.info(f"Writing output to {filename}")
-	np.savetxt(filename, data, fmt='%.4g', header=header)
+	iotools.savetxt(filename, data, fmt='%.4g', header=header)
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description="""Reduce source history to
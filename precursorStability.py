@@ -21,17 +21,26 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
 
+# Averaging quantities read to calculate each output
+QUANTITIES = {'Ri': ['U_mean', 'V_mean', 'T_mean'],
+              'Rf': ['U_mean', 'V_mean', 'T_mean', 'uw_mean','vw_mean','Tw_mean'],
+              'OL': ['T_mean', 'uw_mean','vw_mean','Tw_mean']}
 
 ################################################################################
 
-def precursor_richardson_gradient(casename, overwrite=False):
+def precursor_richardson_gradient(casename, overwrite=False, append=False):
     """Calculates gradient Richardson number from SOWFA precursor averaging data.
 
     Ri = (g/theta)*(dtheta/dz) / ((dU/dz)^2+(dV/dz)^2)
+
+    If append is True, only rows which are new or have changed since an
+    existing file was written are recalculated.
     """
 
     casedir = const.CASES_DIR / casename
@@ -52,12 +61,8 @@ def precursor_richardson_gradient(casename, overwrite=False):
     logger.info("Calculating gradient Richardson number for %s", casename)
 
     writefile = avgdir/f'{casename}_Ri.gz'
-    if writefile.exists() and overwrite is False:
-        logger.warning('%s already exists. Skippping %s.',
-                       writefile.name, casename)
-        return
 
-    quantities = ['U_mean', 'V_mean', 'T_mean']
+    quantities = QUANTITIES['Ri']
     readfiles = [avgdir/f'{casename}_{quantity}.gz' for quantity in quantities]
     for readfile in readfiles:
         if not readfile.is_file():
@@ -65,6 +70,23 @@ def precursor_richardson_gradient(casename, overwrite=False):
                         readfile.name, casename)
             return
 
+    fingerprint = cache.fingerprint(readfiles, {'g': const.g},
+                                    code=[__file__])
+    if (cache.is_current([writefile], fingerprint) and overwrite is False
+        and not append):
+        logger.warning('%s is up to date. Skippping %s.',
+                       writefile.name, casename)
+        return
+
+    start = 0
+    if (writefile.exists() and append
+        and not cache.can_append([writefile], fingerprint)):
+        logger.warning('%s was written by other code or parameters. '
+                       'Rewriting %s.', writefile.name, casename)
+    elif writefile.exists() and append:
+        start = iotools.valid_rows(writefile, readfiles)
+        logger.info('Recalculating from row %d', start)
+
     logger.debug('Getting heights')
     with gzip.open(readfiles[0],mode='rt') as f:
         header = f.readline()
@@ -73,13 +95,18 @@ def precursor_richardson_gradient(casename, overwrite=False):
                   for height in header.split()[2:]]) # exclude time and dt column
 
     logger.debug('Reading %s', readfiles[0])
-    U = np.loadtxt(readfiles[0])
+    U = iotools.load(readfiles[0])[start:]
 
     logger.debug('Reading %s', readfiles[1])
-    V = np.loadtxt(readfiles[1])
+    V = iotools.load(readfiles[1])[start:]
 
     logger.debug('Reading %s', readfiles[2])
-    T = np.loadtxt(readfiles[2])
+    T = iotools.load(readfiles[2])[start:]
+
+    if start and U.shape[0] == 0:
+        logger.info('%s is up to date. Skipping %s.', writefile.name, casename)
+        cache.record([writefile], fingerprint)
+        return
 
     ############################################################################
 
@@ -106,14 +133,21 @@ def precursor_richardson_gradient(casename, overwrite=False):
     header = " ".join(header.split()[:-1])
 
     logger.info('Saving file %s',writefile.name)
-    np.savetxt(writefile,Ri,header=header,fmt='%.12g')
+    iotools.write_blocks(writefile, [Ri], header=header, fmt='%.12g',
+                         binary=True, keep_rows=start or None,
+                         inputs=iotools.input_revisions(readfiles))
+
+    cache.record([writefile], fingerprint)
 
 ################################################################################
 
-def precursor_richardson_flux(casename, overwrite=False):
+def precursor_richardson_flux(casename, overwrite=False, append=False):
     """Calculates flux Richardson number from SOWFA precursor averaging data.
 
     Rf = (g/theta)*(w'theta') / (u'w'(dU/dz)+v'w'(dV/dz))
+
+    If append is True, only rows which are new or have changed since an
+    existing file was written are recalculated.
     """
 
     casedir = const.CASES_DIR / casename
@@ -134,12 +168,8 @@ def precursor_richardson_flux(casename, overwrite=False):
     logger.info("Calculating flux Richardson number for %s", casename)
 
     writefile = avgdir/f'{casename}_Rf.gz'
-    if writefile.exists() and overwrite is False:
-        logger.warning('%s already exists. Skippping %s.',
-                       writefile.name, casename)
-        return
 
-    quantities = ['U_mean', 'V_mean', 'T_mean', 'uw_mean','vw_mean','Tw_mean']
+    quantities = QUANTITIES['Rf']
     readfiles = [avgdir/f'{casename}_{quantity}.gz' for quantity in quantities]
     for readfile in readfiles:
         if not readfile.is_file():
@@ -147,6 +177,23 @@ def precursor_richardson_flux(casename, overwrite=False):
                         readfile.name, casename)
             return
 
+    fingerprint = cache.fingerprint(readfiles, {'g': const.g},
+                                    code=[__file__])
+    if (cache.is_current([writefile], fingerprint) and overwrite is False
+        and not append):
+        logger.warning('%s is up to date. Skippping %s.',
+                       writefile.name, casename)
+        return
+
+    start = 0
+    if (writefile.exists() and append
+        and not cache.can_append([writefile], fingerprint)):
+        logger.warning('%s was written by other code or parameters. '
+                       'Rewriting %s.', writefile.name, casename)
+    elif writefile.exists() and append:
+        start = iotools.valid_rows(writefile, readfiles)
+        logger.info('Recalculating from row %d', start)
+
     logger.debug('Getting heights')
     with gzip.open(readfiles[0],mode='rt') as f:
         header = f.readline()
@@ -155,22 +202,27 @@ def precursor_richardson_flux(casename, overwrite=False):
                   for height in header.split()[2:]]) # exclude time and dt column
 
     logger.debug('Reading %s', readfiles[0])
-    U = np.loadtxt(readfiles[0])
+    U = iotools.load(readfiles[0])[start:]
 
     logger.debug('Reading %s', readfiles[1])
-    V = np.loadtxt(readfiles[1])
+    V = iotools.load(readfiles[1])[start:]
 
     logger.debug('Reading %s', readfiles[2])
-    T = np.loadtxt(readfiles[2])
+    T = iotools.load(readfiles[2])[start:]
 
     logger.debug('Reading %s', readfiles[3])
-    uw = np.loadtxt(readfiles[3])
+    uw = iotools.load(readfiles[3])[start:]
 
     logger.debug('Reading %s', readfiles[4])
-    vw = np.loadtxt(readfiles[4])
+    vw = iotools.load(readfiles[4])[start:]
 
     logger.debug('Reading %s', readfiles[5])
-    Tw = np.loadtxt(readfiles[5])
+    Tw = iotools.load(readfiles[5])[start:]
+
+    if start and U.shape[0] == 0:
+        logger.info('%s is up to date. Skipping %s.', writefile.name, casename)
+        cache.record([writefile], fingerprint)
+        return
 
     ############################################################################
 
@@ -194,11 +246,15 @@ def precursor_richardson_flux(casename, overwrite=False):
     header = " ".join(header.split()[:-1])
 
     logger.info('Saving file %s',writefile.name)
-    np.savetxt(writefile,Rf,header=header,fmt='%.12g')
+    iotools.write_blocks(writefile, [Rf], header=header, fmt='%.12g',
+                         binary=True, keep_rows=start or None,
+                         inputs=iotools.input_revisions(readfiles))
+
+    cache.record([writefile], fingerprint)
 
 ################################################################################
 
-def precursor_obukhov(casename, overwrite=False):
+def precursor_obukhov(casename, overwrite=False, append=False):
     """Calculates Obukhov length from SOWFA precursor averaging data.
     Technically, Obukhov is calculated only from surface layer, where turbulent
     fluxes are approximately constant with height. Here it is calculated as a
@@ -207,6 +263,9 @@ def precursor_obukhov(casename, overwrite=False):
 
     L = (-theta * ustar^3) / ( kappa*g*(w'theta') )
     ustar = ( (u'w')^2 + (v'w')^2 )^(1/4)
+
+    If append is True, only rows which are new or have changed since an
+    existing file was written are recalculated.
     """
 
     casedir = const.CASES_DIR / casename
@@ -227,12 +286,8 @@ def precursor_obukhov(casename, overwrite=False):
     logger.info("Calculating Obukhov length for %s", casename)
 
     writefile = avgdir/f'{casename}_OL.gz'
-    if writefile.exists() and overwrite is False:
-        logger.warning('%s already exists. Skippping %s.',
-                       writefile.name, casename)
-        return
 
-    quantities = ['T_mean', 'uw_mean','vw_mean','Tw_mean']
+    quantities = QUANTITIES['OL']
     readfiles = [avgdir/f'{casename}_{quantity}.gz' for quantity in quantities]
     for readfile in readfiles:
         if not readfile.is_file():
@@ -240,6 +295,24 @@ def precursor_obukhov(casename, overwrite=False):
                         readfile.name, casename)
             return
 
+    fingerprint = cache.fingerprint(readfiles, {'g': const.g,
+                                                'vonkarman': const.VONKARMAN},
+                                    code=[__file__])
+    if (cache.is_current([writefile], fingerprint) and overwrite is False
+        and not append):
+        logger.warning('%s is up to date. Skippping %s.',
+                       writefile.name, casename)
+        return
+
+    start = 0
+    if (writefile.exists() and append
+        and not cache.can_append([writefile], fingerprint)):
+        logger.warning('%s was written by other code or parameters. '
+                       'Rewriting %s.', writefile.name, casename)
+    elif writefile.exists() and append:
+        start = iotools.valid_rows(writefile, readfiles)
+        logger.info('Recalculating from row %d', start)
+
     logger.debug('Getting heights')
     with gzip.open(readfiles[0],mode='rt') as f:
         header = f.readline()
@@ -248,16 +321,21 @@ def precursor_obukhov(casename, overwrite=False):
                   for height in header.split()[2:]]) # exclude time and dt column
 
     logger.debug('Reading %s', readfiles[0])
-    T = np.loadtxt(readfiles[0])
+    T = iotools.load(readfiles[0])[start:]
 
     logger.debug('Reading %s', readfiles[1])
-    uw = np.loadtxt(readfiles[1])
+    uw = iotools.load(readfiles[1])[start:]
 
     logger.debug('Reading %s', readfiles[2])
-    vw = np.loadtxt(readfiles[2])
+    vw = iotools.load(readfiles[2])[start:]
 
     logger.debug('Reading %s', readfiles[3])
-    Tw = np.loadtxt(readfiles[3])
+    Tw = iotools.load(readfiles[3])[start:]
+
+    if start and T.shape[0] == 0:
+        logger.info('%s is up to date. Skipping %s.', writefile.name, casename)
+        cache.record([writefile], fingerprint)
+        return
 
     ############################################################################
 
@@ -272,7 +350,11 @@ def precursor_obukhov(casename, overwrite=False):
     L[:,2:] = -T[:,2:] * ustar[:,2:] / (const.VONKARMAN*const.g*Tw[:,2:])
 
     logger.info('Saving file %s',writefile.name)
-    np.savetxt(writefile,L,header=header,fmt='%.12g')
+    iotools.write_blocks(writefile, [L], header=header, fmt='%.12g',
+                         binary=True, keep_rows=start or None,
+                         inputs=iotools.input_revisions(readfiles))
+
+    cache.record([writefile], fingerprint)
 
 ################################################################################
 
@@ -285,12 +367,27 @@ if __name__ == '__main__':
                         nargs='+')
     parser.add_argument('-o', '--overwrite', help='option to overwrite exisiting files',
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('-a', '--append', help='option to only recalculate new or changed rows',
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
 
     args = parser.parse_args()
 
     logger.debug('Parsed the command line arguments: %s', args)
 
-    for casename in args.cases:
-        precursor_richardson_gradient(casename, args.overwrite)
-        precursor_richardson_flux(casename, args.overwrite)
-        precursor_obukhov(casename, args.overwrite)
+    FUNCTIONS = {'Ri': precursor_richardson_gradient,
+                 'Rf': precursor_richardson_flux,
+                 'OL': precursor_obukhov}
+
+    # Each output of each case is one unit of work, sized by its inputs
+    units = [(casename, output) for casename in args.cases
+             for output in FUNCTIONS]
+    sizes = [utils.file_sizes(const.CASES_DIR / casename / const.SOWFATOOLS_DIR
+                              / 'averaging' / f'{casename}_{quantity}.gz'
+                              for quantity in QUANTITIES[output])
+             for casename, output in units]
+
+    for casename, output in utils.shard_units(units, sizes, args.shard):
+        FUNCTIONS[output](casename, args.overwrite, args.append)
@@ -1,111 +1,202 @@
-#!/bin/python3
-"""Written for python 3.12 for the sowfatools package.
+#!/usr/bin/env python3
+
+"""Compatible with Python 3.13, SOWFA 2.4.x
+Part of github.com/NotDrJeff/sowfatools
 Jeffrey Johnston. February 2024.
 
 Calculates percentage deviation of T_mean from intial conditions over time.
-To reduce the size of the dataset, we take only keep every N samples of 
-sowftools/averaging data at heights_to_keep which is saved to a file.
+To reduce the size of the dataset, we take only keep every N samples of
+sowftools/averaging data at heights_to_keep which is saved to a file. The
+maximum deviation and its height at every time are saved to a second file.
 Directly reports maximum deviation at height of occurence every t seconds as
-well as the maximum deviation at the hub height."""
+well as the maximum deviation at the hub height.
+
+As a script, takes a list of cases as command line arguments.
+"""
 
 import logging
-import sys
-import gzip
-from pathlib import Path
+
+import argparse
 
 import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
+LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
-LEVEL = logging.DEBUG
-
-def main(casename, N=1000, t=20000,
-		 heights_to_keep=[const.TURBINE_HUB_HEIGHT,500,700,900]):
-	casedir = const.CASES_DIR / casename
-	utils.configure_logging((casedir / f'log.{Path(__file__).stem}'),
-                            level=LEVEL)
-
-	filename = (casedir / const.SOWFATOOLS_DIR / 'averaging'
-			    / f'{casename}_T_mean.gz')
-	
-	logger.info(f"Generating array from {filename}")
-	T = np.genfromtxt(filename)
-	
-	logger.debug(f"Reducing dataset.")
-	times = T[:,0]
-	T = T[:,2::2] #ignore average columns
-
-	logger.debug(f"Getting heights from {filename}")
-	with gzip.open(filename, mode='rt') as file:
-		header = file.readline().split()[3::2]
-
-	heights = np.array([(i.split('_')[-1]) for i in header],dtype=int)
-	heights_idx = [np.argmin(np.abs(heights - i)) for i in heights_to_keep]
-
-	logger.debug(f'Calculating temperature deviation')
-
-	dev = np.empty(T.shape)
-	dev[0,:] = 0
-
-	for i in range(1, T.shape[0]):
-		dev[i,:] = (T[i,:] - T[0,:]) / T[0,:]
-	
-	dev[1:,:] *= 100
-	del T
-
-	logger.debug("Calculating maximum deviation at each time")
-
-	maxdev = np.empty(times.shape) # heights of maximum deviation for each time
-	maxheights = np.empty(times.shape) # maximum deviation for each time
-	for i in range(times.shape[0]):
-		maxidx = np.argmax(np.abs(dev[i,:]))
-		maxdev[i] = dev[i,maxidx]
-		maxheights[i] = heights[maxidx]
-
-	time_samples = int(times[-1] // t)
-	times_idx = [np.argmin(np.abs(times-i*t))
-				 for i in range(time_samples+1)]
-
-	logger.info(f"Reporting deviation:")
-	for i in range(1,time_samples+1):
-		idx = times_idx[i]
-		logger.info(f"After {i*t}s, the max deviation is {maxdev[idx]:.2f}% "
-			        f"at {maxheights[idx]}m")
-		logger.info(f"	Deviation at hub height is "
-			        f"{dev[idx,heights_idx[0]]:.2f}%")
-		
-	logger.info(f"The max deviation at hub height "
-			    f"({const.TURBINE_HUB_HEIGHT})m is "
-				f"{np.max(np.abs(dev[:,heights_idx[0]])):.2f}%")
-	
-	logger.info(f"The max deviation at any height is "
-				f"{np.max(maxdev):.2f}%")
-
-	logger.debug(f"Reducing dataset time samples. {N=}")
-	# Arbitrary reduction of dataset. Here we keep data for turbine hub height,
-	# as well as a few other heights. We skip timesteps accoring to N.
-
-	org_size = dev.shape
-
-	dev = dev[::N,heights_idx]
-	times = times[::N]
-
-	new_size = dev.shape
-
-	logger.debug(f"Reduced data from {org_size} to {new_size}")
-
-	outputdir = casedir / const.SOWFATOOLS_DIR / 'derived'
-	utils.create_directory(outputdir)
-
-	filename = outputdir / f'{casename}_Tdeviation'
-	logger.info(f"Writing output to {filename}")
-
-	header = ' '.join(['time'] + [f'{i}m' for i in heights_to_keep])
-	dev = np.column_stack((times,dev))
-
-	np.savetxt(filename, dev, fmt='%.12g', header=header)
-
-if __name__=="__main__":
-    main(sys.argv[1])
+
+HEIGHTS_TO_KEEP = (const.TURBINE_HUB_HEIGHT, 500, 700, 900)
+
+################################################################################
+
+def precursorTdeviation(casename, N=1000, t=20000,
+                        heights_to_keep=HEIGHTS_TO_KEEP, overwrite=False,
+                        max_memory=None):
+    """Calculates percentage deviation of T_mean from the first time at every
+    height. Every N-th time at heights_to_keep is saved, as is the maximum
+    deviation and its height at every time. The input is streamed in blocks
+    of rows of at most max_memory bytes, if given.
+    """
+
+    casedir = const.CASES_DIR / casename
+    sowfatoolsdir = casedir / const.SOWFATOOLS_DIR
+    readfile = sowfatoolsdir / 'averaging' / f'{casename}_T_mean.gz'
+
+    if not readfile.is_file():
+        logger.warning(f'{readfile} does not exist. Skipping {casename}.')
+        return
+
+    logfilename = 'log.precursorTdeviation'
+    utils.configure_function_logger(sowfatoolsdir/logfilename, level=LEVEL)
+
+    ############################################################################
+
+    logger.info(f'Calculating temperature deviation for {casename}')
+
+    writedir = sowfatoolsdir / 'derived'
+    utils.create_directory(writedir)
+
+    writefile = writedir / f'{casename}_Tdeviation.gz'
+    maximafile = writedir / f'{casename}_Tdeviation_maxima.gz'
+
+    # t only changes what is reported, not the outputs
+    fingerprint = cache.fingerprint([readfile], {'N': N,
+                                                 'heights': heights_to_keep},
+                                    code=[__file__])
+    if (cache.is_current([writefile, maximafile], fingerprint)
+        and overwrite is False):
+        logger.warning(f'{writefile.name} is up to date. '
+                       f'Skippping {casename}.')
+        return
+
+    logger.debug(f'Getting heights from {readfile}')
+    columns, heights = iotools.height_columns(readfile)
+    heights_idx = utils.nearest_index(heights, heights_to_keep)
+
+    header = ' '.join(['time'] + [f'{height}m' for height in heights_to_keep])
+    maxima_header = 'time max_deviation_percent height_m'
+
+    ############################################################################
+
+    # Only the time column and height columns are read (not dt)
+    blocks = iotools.iter_load(readfile, usecols=[0, *columns],
+                               max_memory=max_memory)
+
+    times = []
+    maxdev = []     # maximum deviation for each time
+    maxheights = [] # heights of maximum deviation for each time
+    hubdev = []     # deviation at hub height for each time
+
+    T0 = None
+    row = 0
+
+    logger.info(f'Writing output to {writefile} and {maximafile}')
+    with (iotools.TextWriter(writefile, header=header) as reduced,
+          iotools.TextWriter(maximafile, header=maxima_header) as maxima):
+
+        for block in blocks:
+            logger.debug(f'Processing rows {row}-{row+block.shape[0]-1}')
+
+            if T0 is None:
+                T0 = block[0,1:].copy()
+
+            dev = block[:,1:]
+            dev -= T0
+            dev *= 100 / T0
+
+            maxidx = np.argmax(np.abs(dev), axis=1)
+            block_maxdev = dev[np.arange(dev.shape[0]), maxidx]
+            block_maxheights = heights[maxidx]
+
+            maxima.write(np.column_stack((block[:,0], block_maxdev,
+                                          block_maxheights)))
+
+            # Arbitrary reduction of dataset. Here we keep data for turbine
+            # hub height, as well as a few other heights. We skip timesteps
+            # according to N.
+            first = -row % N
+            reduced.write(np.column_stack((block[first::N,0],
+                                           dev[first::N][:,heights_idx])))
+
+            times.append(block[:,0])
+            maxdev.append(block_maxdev)
+            maxheights.append(block_maxheights)
+            hubdev.append(dev[:,heights_idx[0]])
+
+            row += block.shape[0]
+
+    if row == 0:
+        logger.warning(f'{readfile.name} is empty. Skipping {casename}.')
+        return
+
+    cache.record([writefile, maximafile], fingerprint)
+
+    times = np.concatenate(times)
+    maxdev = np.concatenate(maxdev)
+    maxheights = np.concatenate(maxheights)
+    hubdev = np.concatenate(hubdev)
+
+    logger.debug(f'Reduced data from {(row, heights.shape[0])} to '
+                 f'{((row - 1) // N + 1, len(heights_to_keep))}')
+
+    ############################################################################
+
+    time_samples = int(times[-1] // t)
+    times_idx = utils.nearest_index(times, np.arange(1, time_samples+1) * t)
+
+    logger.info(f'Reporting deviation:')
+    for i, idx in enumerate(times_idx, start=1):
+        logger.info(f'After {i*t}s, the max deviation is {maxdev[idx]:.2f}% '
+                    f'at {maxheights[idx]}m')
+        logger.info(f'    Deviation at hub height is {hubdev[idx]:.2f}%')
+
+    logger.info(f'The max deviation at hub height '
+                f'({const.TURBINE_HUB_HEIGHT})m is '
+                f'{np.max(np.abs(hubdev)):.2f}%')
+
+    logger.info(f'The max deviation at any height is {np.max(maxdev):.2f}%')
+
+    logger.info(f'Finished calculating temperature deviation for {casename}')
+
+
+################################################################################
+
+if __name__ == '__main__':
+    utils.configure_root_logger(level=LEVEL)
+
+    DESCRIPTION = """Calculate percentage deviation of T_mean from initial
+                     conditions"""
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('cases', help='list of cases to perform analysis for',
+                        nargs='+')
+    parser.add_argument('-N', help='keep every N-th time in the reduced '
+                        'output', type=int, default=1000)
+    parser.add_argument('-t', help='interval between reported deviations in '
+                        'seconds', type=float, default=20000)
+    parser.add_argument('--heights', help='heights to keep in the reduced '
+                        'output', nargs='+', type=float,
+                        default=list(HEIGHTS_TO_KEEP))
+    parser.add_argument('-o', '--overwrite',
+                        help='option to overwrite exisiting files',
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--max-memory', help='memory budget for streaming '
+                        'the input, e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
+
+    args = parser.parse_args()
+
+    logger.debug(f'Parsed the command line arguments: {args}')
+
+    # Each case is one unit of work, sized by its input
+    sizes = [utils.file_sizes([const.CASES_DIR / casename / const.SOWFATOOLS_DIR
+                               / 'averaging' / f'{casename}_T_mean.gz'])
+             for casename in args.cases]
+
+    for casename in utils.shard_units(args.cases, sizes, args.shard):
+        precursorTdeviation(casename, args.N, args.t, args.heights,
+                            args.overwrite, args.max_memory)
@@ -6,6 +6,7 @@ Jeffrey Johnston   jeffrey.johnston@qub.ac.uk  July 2025
 
 Transforms vector quantities from SOWFA precursor averaging data into
 streamwise and cross stream components, calculates their magnitude and angle.
+Rotates symmetric tensor quantities into the same streamwise frame.
 Assumes data has been stitched with precursorAveraging.py
 
 As a script, takes a list of cases as command line arguments.
@@ -14,22 +15,180 @@ As a script, takes a list of cases as command line arguments.
 import logging
 
 import argparse
-import gzip
 
 import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 LEVEL = logging.INFO
 logger = logging.getLogger(__name__)
 
+MEMORY_EXPANSION = 3 # peak memory per byte of stitched input
+
 ################################################################################
 
-def precursorTransform(casename, overwrite=False):
+VECTOR_QUANTITIES = {'U_mean'  : ('U_mean',  'V_mean',  'W_mean'),
+                     'q_mean'  : ('q1_mean', 'q2_mean', 'q3_mean'),
+                     'Tu_mean' : ('Tu_mean', 'Tv_mean', 'Tw_mean')}
+VECTOR_SUFFIXES = ('sw', 'cs', 'mag', 'dir')
+
+# Upper triangle of each symmetric tensor, row by row
+SYMMTENSOR_QUANTITIES = {'R_mean'     : ('R11_mean', 'R12_mean', 'R13_mean',
+                                         'R22_mean', 'R23_mean', 'R33_mean'),
+                         'uiuj_mean'  : ('uu_mean',  'uv_mean',  'uw_mean',
+                                         'vv_mean',  'vw_mean',  'ww_mean'),
+                         'wuiuj_mean' : ('wuu_mean', 'wuv_mean', 'wuw_mean',
+                                         'wvv_mean', 'wvw_mean', 'www_mean')}
+SYMMTENSOR_SUFFIXES = ('sw_sw', 'sw_cs', 'sw_z', 'cs_cs', 'cs_z', 'z_z')
+
+# Position of each full tensor component in the upper triangle
+SYMMTENSOR_INDICES = np.array([[0, 1, 2],
+                               [1, 3, 4],
+                               [2, 4, 5]])
+
+
+def transform_vectors(data):
+    """Takes an array of shape (time, columns, 4), with x, y and z components
+    of a vector in the first three entries of the last axis for every column
+    after time and dt. Replaces them in place with streamwise and cross stream
+    components, magnitude and direction (degrees clockwise from North).
+    """
+
+    vectors = data[:,2:,:3]
+
+    # Direction of the unrotated vectors
+    data[:,2:,3] = 180 + np.degrees(np.arctan2(vectors[...,0], vectors[...,1]))
+
+    rotated = const.WIND_ROTATION.apply(vectors.reshape(-1,3))
+    rotated = rotated.reshape(vectors.shape)
+
+    data[:,2:,:2] = rotated[...,:2]
+    data[:,2:,2] = np.linalg.norm(rotated, axis=-1)
+
+
+def transform_symmtensors(data):
+    """Takes an array of shape (time, columns, 6), with the upper triangle of a
+    symmetric tensor T in the last axis for every column after time and dt.
+    Replaces it in place with the upper triangle of R.T.R^T, where R is the
+    wind rotation.
+    """
+
+    rotation = const.WIND_ROTATION.as_matrix()
+    tensors = data[:,2:,SYMMTENSOR_INDICES]
+
+    rotated = np.einsum('ij,thjk,lk->thil', rotation, tensors, rotation,
+                        optimize=True)
+
+    rows, cols = np.triu_indices(3)
+    data[:,2:,:] = rotated[...,rows,cols]
+
+
+def _input_size(avgdir, casename, components) -> int:
+    """Returns the size in bytes of the stitched components of a quantity, as
+    loaded into memory (from binary sidecars where they exist)
+    """
+
+    size = 0
+    for component in components:
+        readfile = avgdir / f'{casename}_{component}.gz'
+        binaryfile, _ = iotools.binary_paths(readfile)
+        for path in (binaryfile, readfile):
+            if path.is_file():
+                size += path.stat().st_size
+                break
+
+    return size
+
+
+def _transform_quantity(casename, quantity, components, suffixes, transform,
+                        avgdir, header, overwrite=False, append=False):
+    """Transforms one vector or symmetric tensor quantity and writes its
+    outputs to avgdir. See precursorTransform.
+    """
+
+    logger.info(f'Processing {quantity} for {casename}')
+
+    outputfiles = [(avgdir / f'{casename}_{quantity}_{suffix}.gz')
+                   for suffix in suffixes]
+
+    readfiles = [avgdir / f'{casename}_{component}.gz'
+                 for component in components]
+
+    missing = [readfile.name for readfile in readfiles
+               if not readfile.is_file()]
+    if missing:
+        logger.warning(f'{", ".join(missing)} not found. '
+                       f'Skipping {quantity}.')
+        return
+
+    # Outputs depend on the wind direction in constants.py
+    rotation = const.WIND_ROTATION.as_rotvec(degrees=True).tolist()
+    fingerprint = cache.fingerprint(readfiles, {'rotation': rotation},
+                                    code=[__file__])
+
+    start = 0
+    if (append and all([outputfile.exists() for outputfile in outputfiles])
+        and not cache.can_append(outputfiles, fingerprint)):
+        logger.warning(f'Files were written by other code or parameters. '
+                       f'Rewriting {quantity}.')
+
+    elif append and all([outputfile.exists() for outputfile in outputfiles]):
+        start = min([iotools.valid_rows(outputfile, readfiles)
+                     for outputfile in outputfiles])
+        logger.info(f'Recalculating from row {start}')
+
+    elif cache.is_current(outputfiles, fingerprint) and overwrite is False:
+        logger.warning(f'Files are up to date. Skippping {quantity}.')
+        return
+
+    # Each component is read once into (time, column, output)
+    for i, readfile in enumerate(readfiles):
+        logger.debug(f'Reading {readfile}')
+        rawdata = iotools.load(readfile)[start:]
+
+        if i == 0:
+            data = np.empty((*rawdata.shape,len(suffixes)))
+
+        data[:,:,i] = rawdata[:,:]
+        del rawdata
+
+    if start and data.shape[0] == 0:
+        logger.info(f'Files are up to date. Skipping {quantity}.')
+        cache.record(outputfiles, fingerprint)
+        return
+
+    # Time and dt columns are copied to every output
+    data[:,:2,len(components):] = data[:,:2,:1]
+
+    logger.debug(f'Transforming {quantity}')
+    transform(data)
+
+    inputs = iotools.input_revisions(readfiles)
+    for i, outputfile in enumerate(outputfiles):
+        iotools.write_blocks(outputfile, [data[:,:,i]], header=header,
+                             fmt='%.12g', binary=True,
+                             keep_rows=start or None, inputs=inputs)
+
+    del data
+
+    cache.record(outputfiles, fingerprint)
+
+
+def precursorTransform(casename, overwrite=False, append=False, workers=1,
+                       max_memory=None, shard=None):
     """Transforms vector quantities from SOWFA precursor averaging data into
     streamwise and cross stream components, calculates their magnitude and angle.
+    Rotates symmetric tensor quantities into the same frame.
     Assumes data has been stitched with precursorAveraging.py
+    If append is True, only rows which are new or have changed since existing
+    files were written are recalculated.
+    Quantities are transformed on 'workers' processes, largest first, with as
+    many running at once as fit within max_memory bytes (estimated as
+    MEMORY_EXPANSION times their input sizes). If shard (i, N) is given, only
+    the quantities of that shard are transformed.
     """
 
     casedir = const.CASES_DIR / casename
@@ -46,85 +205,46 @@ def precursorTransform(casename, overwrite=False):
 
     ############################################################################
 
-    logger.info(f'Transforming vectors for {casename}')
-
-    QUANTITIES = {'U_mean'  : ('U_mean',  'V_mean',  'W_mean'),
-                  'q_mean'  : ('q1_mean', 'q2_mean', 'q3_mean'),
-                  'Tu_mean' : ('Tu_mean', 'Tv_mean', 'Tw_mean')}
-
-    header_found = False
-    for components in QUANTITIES.values():
-        for component in components:
-            readfile = avgdir/f'{casename}_{component}.gz'
-            if readfile.is_file():
-                with gzip.open(readfile,mode='rt') as f:
-                    header = f.readline()
-                    logger.debug(f'Using header from file {readfile}')
-                    logger.debug(f'{header=}')
-                header_found = True
-                break
-        if header_found: break
- 
+    logger.info(f'Transforming vectors and tensors for {casename}')
+
+    QUANTITIES = {quantity: (components, VECTOR_SUFFIXES, transform_vectors)
+                  for quantity, components in VECTOR_QUANTITIES.items()}
+    QUANTITIES |= {quantity: (components, SYMMTENSOR_SUFFIXES,
+                              transform_symmtensors)
+                   for quantity, components in SYMMTENSOR_QUANTITIES.items()}
+
+    for components, _, _ in QUANTITIES.values():
+        readfiles = [avgdir/f'{casename}_{component}.gz'
+                     for component in components]
+        readfiles = [readfile for readfile in readfiles if readfile.is_file()]
+        if readfiles:
+            logger.debug(f'Using header from file {readfiles[0]}')
+            header = ' '.join(iotools.read_columns_header(readfiles[0]))
+            logger.debug(f'{header=}')
+            break
+
     if 'header' not in locals():
         logger.error('No file could be found to supply a header. Exiting.')
         raise FileNotFoundError(f'No relevant files found for case {casename}')
 
-    header = header.removeprefix('# ').removesuffix('\n')
- 
     ############################################################################
 
-    for quantity,components in QUANTITIES.items():
-        logger.info(f'Processing {quantity} for {casename}')
-
-        outputfiles = [(avgdir / f'{casename}_{quantity}_{suffix}.gz')
-                       for suffix in ('sw', 'cs', 'mag', 'dir')]
-
-        if ( all([outputfile.exists() for outputfile in outputfiles])
-             and overwrite is False ):
-            logger.warning(f'Files already exist. Skippping {quantity}.')
-            continue
+    sizes = {quantity: _input_size(avgdir, casename, components)
+             for quantity, (components, _, _) in QUANTITIES.items()}
 
-        for i, component in enumerate(components):
-            readfile = avgdir / f'{casename}_{component}.gz'
-            logger.debug(f'Reading {readfile}')
-            rawdata = np.loadtxt(readfile)
+    quantities = utils.shard_units(sizes, list(sizes.values()), shard,
+                                   key=casename)
 
-            if i == 0:
-                data = np.empty((*rawdata.shape,4))
-  
-            data[:,:,i] = rawdata[:,:]
-            del rawdata
+    # Quantities are independent, so they can be transformed in parallel
+    tasks = [(casename, quantity, *QUANTITIES[quantity], avgdir, header,
+              overwrite, append) for quantity in quantities]
 
-        data[:,:,3] = data[:,:,0]
+    utils.run_tasks(_transform_quantity, tasks,
+                    [sizes[quantity] for quantity in quantities], workers,
+                    max_memory, expansion=MEMORY_EXPANSION)
 
-        logger.debug('Transforming vectors')
-        for j in range(2,data.shape[1]): # type: ignore
-            data[:,j,3] = 180 + np.degrees(np.arctan2(data[:,j,0], data[:,j,1]))
-            data[:,j,:3] = const.WIND_ROTATION.apply(data[:,j,:3])
-  
-            # Replace vertical component with magnitude
-            data[:,j,2] = np.linalg.norm(data[:,j,:3],axis=-1)
-
-        for i, outputfile in enumerate(outputfiles):
-            logger.debug(f'Saving file {outputfile.name}')
-            np.savetxt(outputfile,data[:,:,i],header=header,fmt='%.12g')
-
-        del data
-
-    # add symmtensor rotations later
-    # R11_mean    R12_mean    R13_mean
-    #             R22_mean    R23_mean
-    #                         R33_mean
-
-    # uu_mean     uv_mean     uw_mean
-    #             vv_mean     vw_mean
-    #                         ww_mean
-
-    # wuu_mean    wuv_mean    wuw_mean
-    #             wvv_mean    wvw_mean
-    #                         www_mean
-
-    logger.info(f'Finished transforming vectors for case {casename}')
+    logger.info(f'Finished transforming vectors and tensors for case '
+                f'{casename}')
 
 
 ################################################################################
@@ -133,17 +253,29 @@ if __name__ == '__main__':
     utils.configure_root_logger(level=LEVEL)
 
     DESCRIPTION = """Calculate streamwise and cross-stream components of vector
-                     quantities and their magnitude"""
+                     quantities and their magnitude, and rotate symmetric
+                     tensor quantities into the streamwise frame"""
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument('cases', help='list of cases to perform analysis for',
                         nargs='+')
     parser.add_argument('-o', '--overwrite',
                         help='option to overwrite exisiting files',
                         action=argparse.BooleanOptionalAction)
+    parser.add_argument('-a', '--append',
+                        help='option to only recalculate new or changed rows',
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('-j', '--workers', help='number of quantities to '
+                        'transform at once', type=int, default=1)
+    parser.add_argument('--max-memory', help='memory budget for all workers, '
+                        'e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
 
     args = parser.parse_args()
 
     logger.debug(f'Parsed the command line arguments: {args}')
 
     for casename in args.cases:
-        precursorTransform(casename,args.overwrite)
+        precursorTransform(casename,args.overwrite,args.append,args.workers,
+                           args.max_memory,args.shard)
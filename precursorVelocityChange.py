@@ -19,6 +19,7 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
 
 
 ################################################################################
@@ -46,7 +47,7 @@ def precursorVelocityChange(casename, width, starttime, overwrite=False):
     # Magnitude
     fname = datadir / f'{casename}_U_mean_mag_{starttime}_{endtime}.gz'
     logger.debug(f'Reading {fname}')
-    data = np.genfromtxt(fname)
+    data = iotools.load(fname)
     U = np.interp(heights_to_report[:2],data[:,0],data[:,1])
     
     logger.info(f'Wind speed at bottom of Rotor: {U[0]:.2f} m/s')
@@ -56,7 +57,7 @@ def precursorVelocityChange(casename, width, starttime, overwrite=False):
     # Direction
     fname = datadir / f'{casename}_U_mean_dir_{starttime}_{endtime}.gz'
     logger.debug(f'Reading {fname}')
-    data = np.genfromtxt(fname)            
+    data = iotools.load(fname)            
     theta = np.interp(heights_to_report[:2],data[:,0],data[:,1])
     
     logger.info(f'Wind direction at bottom of Rotor: {theta[0]:.2f} \N{DEGREE SIGN}')
@@ -66,12 +67,12 @@ def precursorVelocityChange(casename, width, starttime, overwrite=False):
     # Geodtrophic Wind
     fname = datadir / f'{casename}_U_mean_{starttime}_{endtime}.gz'
     logger.debug(f'Reading {fname}')
-    data = np.genfromtxt(fname)
+    data = iotools.load(fname)
     U = np.interp(heights_to_report[2],data[:,0],data[:,1])
     
     fname = datadir / f'{casename}_V_mean_{starttime}_{endtime}.gz'
     logger.debug(f'Reading {fname}')
-    data = np.genfromtxt(fname)           
+    data = iotools.load(fname)           
     V = np.interp(heights_to_report[2],data[:,0],data[:,1])
     
     logger.info(f'Geostrophic Wind is ({U:.2f}, {V:.2f}) m/s')
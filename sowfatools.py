@@ -17,6 +17,7 @@ from matplotlib import cm
 
 import constants as const
 import utils
+import iotools
 
 logger = logging.getLogger(__name__)
 
@@ -64,7 +65,7 @@ def calculate_average_power(case_name: str, tolerances: tuple) -> np.ndarray:
     data = read_turbine_output(case_dir, "powerRotor")
     data = data[data[:,0] == 0]  # Only turbine 0 considered for now.
     data = utils.remove_overlaps(data, 1)
-    average = utils.calculate_moving_average(data, 3, 2)
+    average = utils.cumulative_average(data[:,3], weights=data[:,2])
     deviation = (average - average[-1]) / average[-1] * 100
     
     logger.debug(f'Average power of Turbine 0 after {data[-1,1]:.2f} s is '
@@ -79,29 +80,31 @@ def calculate_average_power(case_name: str, tolerances: tuple) -> np.ndarray:
                 file.write(f'float({data[i,j]}) ')
             file.write(f'float({average[i]}) float({deviation[i]})\n')
             
-    tolerance_idx = utils.check_tolerance(average,average[-1],tolerances)
-    
-    for i,val in enumerate(tolerance_idx):
-        if val is not None:
-            logger.info(f'Power is converged within {tolerances[i]}% after '
-                        f'{data[val,1]} s')
+    tolerance_idx = utils.convergence_indices(average, tolerances)
+    utils.convergence_report(data[:,1], tolerance_idx, tolerances,
+                             quantity='Power')
             
     return average, deviation, data
 
 
 def read_probe(case: str, probe: str, quantity: str):
+    """Reads 'quantity' from every time folder of the 'probe' postProcessing
+    directory. Returns a 2D array of times followed by the components of each
+    probe point.
+    """
+    
     logger.info(f"Reading {probe} data from {quantity} file")
-    lines = utils.concatenate_files(Path(case, "postProcessing", probe), quantity)
-
-    data = []
-    for line in lines:
-        if line.startswith("#"): pass
-        else:
-             data.append(line.replace("(","").replace(")","").split())
-
-    data = np.array(data, dtype="float")
+    
+    casedir = Path(case)
+    subdirectory = Path("postProcessing", probe)
+    manifest = iotools.scan_directory(casedir, subdirectory)
+    timefolders = iotools.manifest_timefolders(casedir, subdirectory, manifest)
+    
+    times, values = iotools.read_openfoam([timefolder/quantity
+                                           for timefolder in timefolders],
+                                          manifest)
 
-    return data
+    return np.column_stack((times, values.reshape(times.shape[0], -1)))
 
 
 def read_time_directories(base_directory):
@@ -111,17 +114,26 @@ def read_time_directories(base_directory):
     
     logger.info(f'Reading {base_directory} directory')
     
-    # Get a list of all time folders in base_directory
-    time_directories = [i.name for i in Path(base_directory).iterdir()]
-    time_directories.sort(key=float)
+    # Time folders and quantities are listed in the case manifest, which is
+    # kept under the case directory, e.g. case/postProcessing/probes
+    base_directory = Path(base_directory)
+    casedir = base_directory.parent
+    if casedir.name == 'postProcessing':
+        casedir = casedir.parent
+    
+    manifest = iotools.scan_directory(casedir,
+                                      base_directory.relative_to(casedir),
+                                      read_headers=False)
+    
+    # Sorted in time order
+    time_directories = list(manifest['timefolders'])
     
     # Get a list of all quantities, even those only appearing in some time
     # folders.
     
     quantity_names = set()
-    for time in time_directories:
-        for quantity in Path(f'{base_directory}/{time}').iterdir():
-            quantity_names.add(quantity.name)
+    for timefolder in manifest['timefolders'].values():
+        quantity_names.update(timefolder['files'])
             
     quantity_names = list(quantity_names)
     
@@ -129,65 +141,56 @@ def read_time_directories(base_directory):
 
 
 def read_vtk_file(filename, symbol):
-    """Reads a VTK v2.0 polydata file containing hexahedral cell data for a
-    single vector quantity, 'symbol'. Returns vector components and cell
-    centre coordinates.
+    """Reads a VTK v2.0 polydata file containing cell data for a single
+    vector quantity, 'symbol', in ASCII or binary. Returns cell centre
+    coordinates and vector components.
     """
     
     logger = logging.getLogger(f'{__name__}.read_vtk_file')
     logger.info(f'Reading {filename}')
     
-    # Read VTK file and search to find start and end indices for each
-    # section.
-    # 'points' - Contains x, y, z coordinates for each mesh point
-    # 'polygons' - Contains indices of points which make up a cell.  The
-    #     first number is the number of points
-    # 'vectors' - contains x,y,z components of vector at cell centers.
-    
-    with open(filename) as file:
-        surface = file.readlines()
-    
-    for i, line in enumerate(surface):
-        if line.startswith('POINTS'):
-            points_start = i + 1
-        elif line.startswith('POLYGONS'):
-            points_end = i - 2
-            polygons_start = i + 1
-        elif line.startswith(symbol):
-            polygons_end = i - 3
-            vectors_start = i + 1
-    
-    points = surface[points_start:points_end + 1]
-    polygons = surface[polygons_start:polygons_end + 1]
-    vectors = surface[vectors_start:len(surface)]
-    
-    points = [i.split() for i in points]
-    points = [[float(j) for j in i] for i in points]
-    points = np.array(points)
-    
-    polygons = [i.split() for i in polygons]
-    polygons = [[int(j) for j in i] for i in polygons]
-    polygons = [i[1:len(i)] for i in polygons]
-    polygons = np.array(polygons)
-    
-    vectors = [i.split() for i in vectors]
-    vectors = [[float(j) for j in i] for i in vectors]
-    vectors = np.array(vectors)
-    
-    # For each cell in 'polygons', obtain the indices of the cell
-    # vertices; use those indices to obtain vertex coordinates;
-    # then calculate the coordinates of the cell centers.
-    
-    cell_centres = []
-    for i, polygon in enumerate(polygons):
-        cell = np.array([points[j, :] for j in polygon])
-        centre = np.mean(cell, axis=0)
-        cell_centres.append(centre)
-    cell_centres = np.array(cell_centres)
+    vtk = iotools.read_vtk(filename, fields=[symbol])
+    
+    cell_centres = iotools.vtk_cell_centres(vtk)
+    vectors = vtk['cell_data'][symbol]
     
     return cell_centres, vectors
 
 
+def read_vtk_surface(case: str, surface: str, symbol: str, max_memory=None):
+    """Reads 'symbol' on a sampled surface from every time folder of
+    postProcessing/surfaces, where it is written as '{symbol}_{surface}.vtk'.
+    Returns the times, cell centre coordinates and values shaped (time, cell,
+    component).
+    """
+    
+    logger = logging.getLogger(f'{__name__}.read_vtk_surface')
+    logger.info(f'Reading {symbol} on {surface} surface')
+    
+    casedir = Path(case)
+    subdirectory = Path('postProcessing', 'surfaces')
+    manifest = iotools.scan_directory(casedir, subdirectory,
+                                      read_headers=False)
+    
+    readfiles = []
+    times = []
+    for name, timefolder in manifest['timefolders'].items():
+        if f'{symbol}_{surface}.vtk' in timefolder['files']:
+            readfiles.append(casedir/subdirectory/name/f'{symbol}_{surface}.vtk')
+            times.append(float(name))
+    
+    if not readfiles:
+        raise FileNotFoundError(f'No {symbol}_{surface}.vtk files in '
+                                f'{casedir/subdirectory}')
+    
+    logger.info(f'Found {len(readfiles)} time folders')
+    
+    cell_centres, values = iotools.read_vtk_series(readfiles, symbol,
+                                                   max_memory=max_memory)
+    
+    return np.array(times), cell_centres, values
+
+
 # def get_heights_to_plot(base_directory, time_directories, height_domain,
 #                         height_bottom_inversion,
 #                         height_top_inversion, hub_height, rotor_diameter):
@@ -10,6 +10,8 @@ import argparse
 import numpy as np
 
 import utils
+import iotools
+import cache
 import constants as const
 
 QUANTITIES_TO_KEEP = {'UAvg', 'uuPrime2', 'kResolved'}
@@ -17,13 +19,14 @@ QUANTITIES_TO_KEEP = {'UAvg', 'uuPrime2', 'kResolved'}
 
 ################################################################################
 
-def turbineLineSample(casename, time, overwrite=False):
+def turbineLineSample(casename, time, overwrite=False, shard=None):
     """Initial processing of lineSample data. For older version of OpenFOAM,
     this included separating files into each quantity. For newer versions, this
     step is unnecessary. Vertical lines are expected to have a single z
     coordinate column which is preserved. Horizontal lines are expected to have
     x y and z coordinates, and these are used to calculate a distance from the
-    center of the line.
+    center of the line. If shard (i, N) is given, only the files of that shard
+    are processed.
     Intended order of operations:
     turbineLineSample -> turbineLineSampleTransform -> turbineLineSampleFluxes"""
     
@@ -50,10 +53,15 @@ def turbineLineSample(casename, time, overwrite=False):
     writedir = sowfatoolsdir / 'lineSample'
     utils.create_directory(writedir)
         
-    filepaths = [file for file in readdir.iterdir()]
+    filepaths = sorted(readdir.iterdir())
         
     logger.debug(f'Found {len(filepaths)} filenames')
     
+    filepaths = utils.shard_units(filepaths,
+                                  [utils.file_sizes([filepath])
+                                   for filepath in filepaths],
+                                  shard, key=f'{casename}_{time}')
+    
     ############################################################################
     
     for filepath in filepaths:
@@ -116,17 +124,15 @@ def turbineLineSample(casename, time, overwrite=False):
             
         ########################################################################
         
-        if not overwrite:
-            files_exist = True
-            for quantity in quantities_to_keep:
-                writefile = (writedir / f'{linename}_{quantity}_{time}.gz')
-                if not writefile.exists():
-                    files_exist = False
-            if files_exist:
-                logger.warning(f'Files exist. skipping. ')
-                continue
+        writefiles = [writedir / f'{linename}_{quantity}_{time}.gz'
+                      for quantity in quantities_to_keep
+                      if quantity in quantities_found]
+        fingerprint = cache.fingerprint([filepath], code=[__file__])
+        if not overwrite and cache.is_current(writefiles, fingerprint):
+            logger.warning(f'Files are up to date. skipping. ')
+            continue
             
-        data = np.loadtxt(filepath)
+        data = iotools.read_numeric(filepath)
         
         if 'V' in linename:   
             # Vertical lines contain only z coordinate in first column.
@@ -150,8 +156,8 @@ def turbineLineSample(casename, time, overwrite=False):
         
         for quantity in quantities_to_keep:
             writefile = (writedir / f'{linename}_{quantity}_{time}.gz')
-            if writefile.exists() and not overwrite:
-                logger.warning(f'{writefile.name} exists. skipping. ')
+            if not overwrite and cache.is_current([writefile], fingerprint):
+                logger.warning(f'{writefile.name} is up to date. skipping. ')
                 continue
             
             logger.info(f'Processing quantity {quantity}')
@@ -176,7 +182,8 @@ def turbineLineSample(casename, time, overwrite=False):
                     data_to_write = np.column_stack((data_to_write,data[:,idx+i]))
             
             logger.debug(f'Saving file {writefile.name}')
-            np.savetxt(writefile,data_to_write,fmt='%.11e')
+            iotools.savetxt(writefile,data_to_write,fmt='%.11e')
+            cache.record([writefile], fingerprint)
 
 
 ################################################################################
@@ -194,11 +201,14 @@ if __name__=='__main__':
                         nargs='+')
     parser.add_argument('-t','--time', help='time to perfrom analysis for',
                         required=True)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed Command Line Arguments: {args}')
     
     for casename in args.cases:
-        turbineLineSample(casename,args.time)
+        turbineLineSample(casename,args.time,shard=args.shard)
         
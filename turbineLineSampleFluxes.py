@@ -10,14 +10,17 @@ import argparse
 import numpy as np
 
 import utils
+import iotools
+import cache
 import constants as const
 
 
 ################################################################################
 
-def turbineLineSampleFluxes(casename, overwrite=False):
+def turbineLineSampleFluxes(casename, overwrite=False, shard=None):
     """Calculate mean and turbulent vertical fluxes from transformed line sample
-    data."""
+    data. If shard (i, N) is given, only the lines and times of that shard are
+    calculated."""
     
     casedir = const.CASES_DIR / casename
     if not casedir.is_dir():
@@ -62,30 +65,42 @@ def turbineLineSampleFluxes(casename, overwrite=False):
             
     ############################################################################
             
-    for linename in linenames:
-        for time in times:
-            
-            logger.debug(f'Processing time {time} for {linename}')
-            writefile = (lsDir / f'{linename}_fluxes_{time}.gz')
-            
-            if not overwrite:
-                if writefile.exists():
-                    logger.warning(f'{writefile} exists. skipping. ')
-                    continue
-            
-            U = np.loadtxt(lsDir / f'{linename}_UAvg_transformed_{time}')
-            uu = np.loadtxt(lsDir / f'{linename}_uuPrime2_transformed_{time}')
-            
-            # Mean vertical flux of streamwise MKE
-            flux1 = U[:,1] * U[:,1] * U[:,3]
-            
-            # Mean vertical flux of streamwise TKE
-            flux2 = uu[:,1] * U[:,3]
-            
-            data = np.column_stack((U[:,0],flux1,flux2))
-            
-            logger.debug(f'Saving file {writefile.name}')
-            np.savetxt(writefile,data,fmt='%.11e')
+    readfiles = {(linename, time): [iotools.resolve_file(
+                     lsDir / f'{linename}_{quantity}_transformed_{time}')
+                     for quantity in ('UAvg', 'uuPrime2')]
+                 for linename in sorted(linenames) for time in sorted(times)}
+    
+    units = utils.shard_units(readfiles,
+                              [utils.file_sizes(files)
+                               for files in readfiles.values()],
+                              shard, key=casename)
+    
+    for linename, time in units:
+        logger.debug(f'Processing time {time} for {linename}')
+        writefile = (lsDir / f'{linename}_fluxes_{time}.gz')
+        
+        fingerprint = cache.fingerprint(readfiles[linename, time],
+                                        code=[__file__])
+        
+        if not overwrite:
+            if cache.is_current([writefile], fingerprint):
+                logger.warning(f'{writefile} is up to date. skipping. ')
+                continue
+        
+        U = iotools.load(readfiles[linename, time][0])
+        uu = iotools.load(readfiles[linename, time][1])
+        
+        # Mean vertical flux of streamwise MKE
+        flux1 = U[:,1] * U[:,1] * U[:,3]
+        
+        # Mean vertical flux of streamwise TKE
+        flux2 = uu[:,1] * U[:,3]
+        
+        data = np.column_stack((U[:,0],flux1,flux2))
+        
+        logger.debug(f'Saving file {writefile.name}')
+        iotools.savetxt(writefile,data,fmt='%.11e')
+        cache.record([writefile], fingerprint)
             
             
 ################################################################################
@@ -100,11 +115,14 @@ if __name__=='__main__':
     
     parser.add_argument('cases', help='cases to perform analysis for',
                         nargs='+')
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed Command Line Arguments: {args}')
     
     for casename in args.cases:
-        turbineLineSampleFluxes(casename)
+        turbineLineSampleFluxes(casename, shard=args.shard)
         
\ No newline at end of file
@@ -10,6 +10,8 @@ import argparse
 import numpy as np
 
 import utils
+import iotools
+import cache
 import constants as const
 
 CASESDIR = Path('/mnt/d/johnston_2024_thesis')
@@ -18,7 +20,7 @@ HEADER = 'Distance    Momentum    Mean_KE    TKE    Total_KE'
 
 ################################################################################
 
-def turbineLineSampleIntegrate(casename, overwrite=False):
+def turbineLineSampleIntegrate(casename, overwrite=False, shard=None):
     #casedir = const.CASES_DIR / casename
     casedir = CASESDIR / casename
     sowfatoolsdir = casedir / const.SOWFATOOLS_DIR
@@ -89,13 +91,32 @@ def turbineLineSampleIntegrate(casename, overwrite=False):
     
     ############################################################################
     
+    time_readfiles = {time: [iotools.resolve_file(lsdir / f'{linename}_'
+                                                  f'{quantity}_{time}')
+                             for linename in linenames
+                             for quantity in ('UAvg_transformed', 'kResolved')]
+                      for time in sorted(times)}
+    
+    # Each time is integrated separately, so times can be sharded
+    times = utils.shard_units(time_readfiles,
+                              [utils.file_sizes(readfiles)
+                               for readfiles in time_readfiles.values()],
+                              shard, key=casename)
+    
     for time in times:
         hfile = (writedir / f'horizontalLineSamples_integrated_{time}.gz')
         vfile = (writedir / f'verticalLineSamples_integrated_{time}.gz')
         
+        readfiles = time_readfiles[time]
+        fingerprint = cache.fingerprint(
+            readfiles, {'hub_height': const.TURBINE_HUB_HEIGHT,
+                        'radius': const.TURBINE_RADIUS},
+            code=[__file__])
+        
         if not overwrite:
-            if hfile.exists() and vfile.exists():
-                logger.warning(f'Files exist for time {time}. skipping. ')
+            if cache.is_current([hfile, vfile], fingerprint):
+                logger.warning(f'Files are up to date for time {time}. '
+                               f'skipping. ')
                 continue
             
         vdata = np.empty((len(vlinesDict),5))
@@ -130,11 +151,11 @@ def turbineLineSampleIntegrate(casename, overwrite=False):
             
             filepath = lsdir / f'{linename}_UAvg_transformed_{time}'
             logger.debug(f'Reading {filepath.name}')
-            U = np.loadtxt(filepath)
+            U = iotools.load(filepath)
             
             filepath = lsdir / f'{linename}_kResolved_{time}'
             logger.debug(f'Reading {filepath.name}')
-            TKE = np.loadtxt(filepath)
+            TKE = iotools.load(filepath)
             
             # Find idx of all samples within rotor diameter
             idx = np.column_stack((U[:,0] > startx, U[:,0] < endx))
@@ -176,7 +197,9 @@ def turbineLineSampleIntegrate(casename, overwrite=False):
             
             # Save the file
             logger.debug(f'Saving file {writefile.name}')
-            np.savetxt(writefile,data,fmt='%.11e',header=HEADER)
+            iotools.savetxt(writefile,data,fmt='%.11e',header=HEADER)
+        
+        cache.record([hfile, vfile], fingerprint)
             
             
 ################################################################################
@@ -189,11 +212,14 @@ if __name__=='__main__':
     
     parser.add_argument('cases', help='cases to perform analysis for',
                         nargs='+')
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed Command Line Arguments: {args}')
     
     for casename in args.cases:
-        turbineLineSampleIntegrate(casename)
+        turbineLineSampleIntegrate(casename, shard=args.shard)
         
\ No newline at end of file
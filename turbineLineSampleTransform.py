@@ -10,14 +10,18 @@ import argparse
 import numpy as np
 
 import utils
+import iotools
+import cache
 import constants as const
 
 
 ################################################################################
 
-def turbineLineSampleTransform(casename, requested_time, overwrite=False):
+def turbineLineSampleTransform(casename, requested_time, overwrite=False,
+                               shard=None):
     """Takes line sample data already processed by turbineLineSample and
-    transforms so that vector and tensor components align with new axes."""
+    transforms so that vector and tensor components align with new axes. If
+    shard (i, N) is given, only the files of that shard are transformed."""
     casedir = const.CASES_DIR / casename
     if not casedir.is_dir():
         logger.warning(f'{casename} directory does not exist. Skipping.')
@@ -37,12 +41,18 @@ def turbineLineSampleTransform(casename, requested_time, overwrite=False):
         logger.warning(f'{lsDir.name} directory does not exist. Skipping.')
         return
     
-    # exclude already transformed files
-    filepaths = [file for file in lsDir.iterdir()
-                 if 'transformed' not in file.name]
+    # exclude already transformed files and fingerprints
+    filepaths = sorted(file for file in lsDir.iterdir()
+                       if 'transformed' not in file.name
+                       and file.suffix != cache.FINGERPRINT_SUFFIX)
     
     logger.debug(f'Found {len(filepaths)} filenames')
     
+    filepaths = utils.shard_units(filepaths,
+                                  [utils.file_sizes([filepath])
+                                   for filepath in filepaths],
+                                  shard, key=f'{casename}_{requested_time}')
+    
     ############################################################################
     
     for filepath in filepaths:
@@ -82,12 +92,15 @@ def turbineLineSampleTransform(casename, requested_time, overwrite=False):
         ########################################################################
         
         writefile = (lsDir / f'{linename}_{quantity}_transformed_{time}.gz')
+        rotation = const.WIND_ROTATION.as_rotvec(degrees=True).tolist()
+        fingerprint = cache.fingerprint([filepath], {'rotation': rotation},
+                                        code=[__file__])
         if not overwrite:
-            if writefile.exists():
-                logger.warning(f'{writefile} exists. skipping. ')
+            if cache.is_current([writefile], fingerprint):
+                logger.warning(f'{writefile} is up to date. skipping. ')
                 continue
             
-        data = np.loadtxt(filepath)
+        data = iotools.read_numeric(filepath)
         
         if vector:
             data[:,1:] = const.WIND_ROTATION.apply(data[:,1:])
@@ -116,7 +129,8 @@ def turbineLineSampleTransform(casename, requested_time, overwrite=False):
             data[:,2] = ( xx*sin + xy*cos - data[:,4]*sin ) / cos # cs,sw
                 
         logger.debug(f'Saving file {writefile.name}')
-        np.savetxt(writefile,data,fmt='%.11e')
+        iotools.savetxt(writefile,data,fmt='%.11e')
+        cache.record([writefile], fingerprint)
             
             
 ################################################################################
@@ -133,11 +147,14 @@ if __name__=='__main__':
                         nargs='+')
     parser.add_argument('-t','--time', help='time to perfrom analysis for',
                         required=True)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed Command Line Arguments: {args}')
     
     for casename in args.cases:
-        turbineLineSampleTransform(casename,args.time)
+        turbineLineSampleTransform(casename,args.time,shard=args.shard)
         
\ No newline at end of file
@@ -6,20 +6,26 @@ logger = logging.getLogger(__name__)
 
 import sys
 import argparse
-import gzip
 from pathlib import Path
 
 import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 
 ################################################################################
 
-def turbineOutput(casename, overwrite=False):
+def turbineOutput(casename, overwrite=False, append=False, max_memory=None,
+                  shard=None):
     """Stitches SOWFA turbineOutput files from multiple run start times
-    together, removing overlaps.
+    together, removing overlaps. If append is True, existing files are brought
+    up to date by reading only new time folders and appending to them. If
+    max_memory (bytes) is given, files are read in blocks of rows which fit
+    within it. If shard (i, N) is given, only the quantities of that shard
+    are stitched.
     
     Written for Python 3.11, SOWFA 2.4.x as part of sowfatools
     Jeffrey Johnston    NotDrJeff@gmail.com    May 2024
@@ -45,16 +51,23 @@ def turbineOutput(casename, overwrite=False):
     writedir = casedir / const.TURBINEOUTPUT_DIR
     utils.create_directory(writedir)
     
-    timefolders = [timefolder for timefolder in readdir.iterdir()]
-    timefolders.sort(key=lambda x: float(x.name))
+    manifest = iotools.scan_directory(casedir, 'turbineOutput')
+    timefolders = iotools.manifest_timefolders(casedir, 'turbineOutput',
+                                               manifest)
+    
+    quantities = {Path(quantity) for quantity
+                  in iotools.manifest_quantities(manifest)}
     
-    quantities = set()
-    for timefolder in timefolders:
-        for file in timefolder.iterdir():
-            quantities.add(Path(file.name))
-            
     logger.info(f'Found {len(quantities)} quantities across '
                 f'{len(timefolders)} time folders')
+    
+    quantities = sorted(quantities)
+    quantities = utils.shard_units(
+        quantities, [iotools.manifest_size(manifest,
+                                           [timefolder/quantity
+                                            for timefolder in timefolders])
+                     for quantity in quantities],
+        shard, key=casename)
     logger.info('')
     
     ############################################################################
@@ -64,12 +77,9 @@ def turbineOutput(casename, overwrite=False):
         
         # Read first timefolder to check if processed files already exist
         
-        readfile = timefolders[0] / quantity
-        logger.debug(f'Reading {readfile}')
-        data = np.genfromtxt(readfile)
-
-        if len(data.shape) == 1: # For files with only one row of data
-            data = data[np.newaxis,:]
+        readfile, _ = iotools.manifest_resolve(manifest,
+                                               timefolders[0] / quantity)
+        data = iotools.read_numeric(readfile, usecols=[0,1]) # Turbine and Blade
 
         turbines = np.unique(data[:,0]).astype('int')
         blades = np.unique(data[:,1]).astype('int')
@@ -87,45 +97,35 @@ def turbineOutput(casename, overwrite=False):
                                for turbine in turbines
                                for blade in blades])
         
-        if ( all([writefile.exists() for writefile in writefiles])
-             and overwrite is False ):
-            logger.warning(f'Files already exist. Skippping {quantity.stem}.')
+        readfiles = [timefolder/quantity for timefolder in timefolders]
+        fingerprint = cache.fingerprint(
+            [iotools.manifest_resolve(manifest, readfile)[0]
+             for readfile in readfiles], code=[__file__])
+        
+        if ( cache.is_current(writefiles, fingerprint)
+             and overwrite is False and not append ):
+            logger.warning(f'Files are up to date. '
+                           f'Skippping {quantity.stem}.')
             logger.warning('')
             continue
         else:
-            logger.debug(f'Files do not already exist. '
+            logger.debug(f'Files are not up to date. '
                          f'Proceeding with {quantity.stem}')
         
-        # Read remaining timefolders
-        
-        for timefolder in timefolders[1:]:
-            readfile = timefolder / quantity.stem # Using .stem allows for
-            # mixed compressed and uncompressed files in different time folders
-            logger.debug(f'Reading {readfile}')
-            rawdata = np.genfromtxt(readfile)
-            data = np.vstack((data,rawdata))
-            del rawdata # Deleted for memory efficiency only
+        del data # Remaining data is streamed when writing files
         
         ########################################################################
         
+        # Header and first row are cached in the manifest
         for timefolder in timefolders:
-            try:
-                readfile = timefolder / quantity
-                if quantity.name.endswith('.gz'):
-                    f = gzip.open(readfile,mode='rt')
-                else:
-                    f = open(readfile)
-            except FileNotFoundError:
-                continue
-            
-            header = f.readline()
-            firstrow = f.readline()
-            f.close()
-            logger.debug(f'Got header: {header.removesuffix("\n")}')
-            break
-        
-        firstrow = firstrow.removesuffix('\n').split()
-        names = header.removeprefix('#').removesuffix('\n').split('    ')
+            _, info = iotools.manifest_resolve(manifest, timefolder / quantity)
+            if info is not None:
+                header = info['header']
+                firstrow = info['first_row']
+                logger.debug(f'Got header: {header}')
+                break
+        
+        names = header.removeprefix('#').split('    ')
         names = [name.replace(' ','_') for name in names]
         
         if quantity.stem in const.BLADE_QUANTITIES:
@@ -145,37 +145,54 @@ def turbineOutput(casename, overwrite=False):
         
         ########################################################################
         
-        for turbine in turbines:
-            turbinedata = data[data[:,0] == turbine]
-            
-            if quantity.stem in const.TURBINE_QUANTITIES:
-                
-                writefile = writedir / (f'{casename}_{quantity.stem}_'
-                                        f'turbine{int(turbine)}.gz')
-                turbinedata = utils.remove_overlaps(turbinedata,1)
-                turbinedata = turbinedata[:,1:] # Remove "Turbine" column
-                logger.info(f'Saving file {writefile.name}')
-                np.savetxt(writefile,turbinedata,header=header,fmt='%.11e')
-                
-            elif quantity.stem in const.BLADE_QUANTITIES:
-                
-                for blade in blades:
-                    logger.debug(f'{quantity.stem=} {turbine=} {blade=}')
-                    
-                    writefile = writedir / (f'{casename}_{quantity.stem}_'
-                                            f'turbine{int(turbine)}_'
-                                            f'blade{int(blade)}.gz')
-                    
-                    bladedata = turbinedata[turbinedata[:,1] == blade]
-                    bladedata = utils.remove_overlaps(bladedata,2)
-                    bladedata = bladedata[:,2:] # Remove "Turbine", "Blade" cols
-                    logger.info(f'Saving file {writefile.name}')
-                    np.savetxt(writefile,bladedata,header=header,fmt='%.11e')
-                    
-                    del bladedata # Deleted for memory efficiency only
-            
+        if quantity.stem in const.TURBINE_QUANTITIES:
+            group_indices = (0,) # "Turbine" column
+            keys = [(turbine,) for turbine in turbines]
+        elif quantity.stem in const.BLADE_QUANTITIES:
+            group_indices = (0,1) # "Turbine" and "Blade" columns
+            keys = [(turbine,blade) for turbine in turbines for blade in blades]
+        else:
+            logger.warning(f'{quantity.stem} is not a known quantity. Skipping.')
+            logger.warning('')
+            continue
+        
+        sorting_index = len(group_indices) # time column follows groups
+        
+        sources = iotools.manifest_sources(manifest, readfiles)
+        keep_rows = None
+        
+        if ( append and all([writefile.exists() for writefile in writefiles])
+             and not cache.can_append(writefiles, fingerprint) ):
+            logger.warning(f'Files were written by other code or parameters. '
+                           f'Rewriting {quantity.stem}.')
+        elif append and all([writefile.exists() for writefile in writefiles]):
+            plan = iotools.plan_append(writefiles, readfiles, manifest,
+                                       sorting_index)
+            if plan is None:
+                logger.warning('Files cannot be appended to. Rewriting.')
+            elif not plan[0]:
+                logger.info(f'Files are up to date. Skipping {quantity.stem}.')
+                logger.info('')
+                cache.record(writefiles, fingerprint)
+                continue
+            else:
+                readfiles, cutoff = plan
+                keep_rows = {key: iotools.rows_before(writefile, cutoff)
+                             for key, writefile in zip(keys,writefiles)}
+                logger.info(f'Appending {len(readfiles)} time folders from '
+                            f'time {cutoff}')
+        
+        blocks = iotools.stitch_time_folders(readfiles, sorting_index,
+                                             group_indices, manifest=manifest,
+                                             max_memory=max_memory)
+        
+        # Group columns are not written
+        iotools.write_groups(dict(zip(keys,writefiles)), blocks, group_indices,
+                             sorting_index, header=header, fmt='%.11e',
+                             binary=True, keep_rows=keep_rows, sources=sources)
+        cache.record(writefiles, fingerprint)
+        
         logger.info('')
-        del data # Data must be deleted for loop to work correctly
         
     logger.info(f'Finished case {casename}')
     logger.info('')
@@ -193,11 +210,21 @@ if __name__ == '__main__':
     
     parser.add_argument('cases', help='List of turbine cases',
                         nargs='+')
+    parser.add_argument('-o','--overwrite', help='option to overwrite exisiting files',
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('-a','--append', help='option to append new time folders to exisiting files',
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--max-memory', help='memory budget for reading '
+                        'files, e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
     for casename in args.cases:
-        turbineOutput(casename)
+        turbineOutput(casename,args.overwrite,args.append,args.max_memory,
+                      args.shard)
     
@@ -11,14 +11,18 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 
 ################################################################################
 
 def turbineOutputAverage(casename,times_to_report=None,starttime=300,
-                         blade_sample_to_report=27,overwrite=False):
+                         blade_sample_to_report=27,overwrite=False,
+                         shard=None):
     """Reads powerRotor from sowfatools directory, calculates a running average
-    and reports at requested times.
+    and reports at requested times. If shard (i, N) is given, only the
+    turbines of that shard are averaged.
     
     Written for Python 3.12, SOWFA 2.4.x for sowfatools
     Jeffrey Johnston    NotDrJeff@gmail.com    May 2024
@@ -49,7 +53,23 @@ def turbineOutputAverage(casename,times_to_report=None,starttime=300,
     #for quantity in quantities:
         logger.info(f'Processing {casename}, {quantity}')
         
-        for turbine in turbines:
+        if quantity in const.TURBINE_QUANTITIES:
+            readfiles = {turbine: [readdir / (f'{casename}_{quantity}_'
+                                              f'turbine{turbine}.gz')]
+                         for turbine in turbines}
+        else:
+            readfiles = {turbine: [readdir / (f'{casename}_{quantity}_'
+                                              f'turbine{turbine}_blade{blade}'
+                                              f'.gz')
+                                   for blade in blades]
+                         for turbine in turbines}
+        
+        shard_turbines = utils.shard_units(
+            turbines, [utils.file_sizes(readfiles[turbine])
+                       for turbine in turbines],
+            shard, key=f'{casename}_{quantity}')
+        
+        for turbine in shard_turbines:
             logger.info(f'{casename}, {quantity}, turbine{turbine}')
             
             ####################################################################
@@ -58,17 +78,22 @@ def turbineOutputAverage(casename,times_to_report=None,starttime=300,
                 
                 writefile = writedir / (f'{casename}_{quantity}_'
                                         f'turbine{turbine}_averaged.gz')
-                if (writefile.exists() and overwrite is False
-                    and times_to_report is None):
-                    logger.warning(f'{writefile.name} already exists. '
+                readfile = (readdir
+                            / f'{casename}_{quantity}_turbine{turbine}.gz')
+                
+                fingerprint = cache.fingerprint([readfile],
+                                                {'starttime': starttime},
+                                                code=[__file__])
+                current = (cache.is_current([writefile], fingerprint)
+                           and overwrite is False)
+                if current and times_to_report is None:
+                    logger.warning(f'{writefile.name} is up to date. '
                                    f'Skippping.')
                     logger.warning('')
                     continue
                 
-                readfile = (readdir
-                            / f'{casename}_{quantity}_turbine{turbine}.gz')
                 logger.debug(f'Reading {readfile}')
-                data = np.genfromtxt(readfile)
+                data = iotools.load(readfile)
                 
                 with gzip.open(readfile,mode='rt') as f:
                         header = f.readline()
@@ -81,12 +106,14 @@ def turbineOutputAverage(casename,times_to_report=None,starttime=300,
                 
                 data[:start_idx,2] = np.nan
                 data[start_idx:,2] = \
-                    utils.calculate_moving_average(data[start_idx:,:],2,1)
+                    utils.cumulative_average(data[start_idx:,2],
+                                             weights=data[start_idx:,1])
                 
-                if (not writefile.exists() or overwrite is True):
-                    np.savetxt(writefile,data,fmt='%.11e',header=header)
+                if not current:
+                    iotools.savetxt(writefile,data,fmt='%.11e',header=header)
+                    cache.record([writefile], fingerprint)
                 else:
-                    logger.warning(f'{writefile.name} already exists. '
+                    logger.warning(f'{writefile.name} is up to date. '
                                    f'Not overwriting.')
                 
                 if times_to_report is not None:
@@ -104,17 +131,22 @@ def turbineOutputAverage(casename,times_to_report=None,starttime=300,
                     writefile = writedir / (f'{casename}_{quantity}_'
                                             f'turbine{turbine}_blade{blade}_'
                                             f'averaged.gz')
-                    if (writefile.exists() and overwrite is False
-                        and times_to_report is None):
-                        logger.warning(f'{writefile.name} already exists. '
+                    readfile = readdir / (f'{casename}_{quantity}_'
+                                          f'turbine{turbine}_blade{blade}.gz')
+                    
+                    fingerprint = cache.fingerprint([readfile],
+                                                    {'starttime': starttime},
+                                                    code=[__file__])
+                    current = (cache.is_current([writefile], fingerprint)
+                               and overwrite is False)
+                    if current and times_to_report is None:
+                        logger.warning(f'{writefile.name} is up to date. '
                                     f'Skippping.')
                         logger.warning('')
                         continue
                     
-                    readfile = readdir / (f'{casename}_{quantity}_'
-                                          f'turbine{turbine}_blade{blade}.gz')
                     logger.debug(f'Reading {readfile}')
-                    data = np.genfromtxt(readfile)
+                    data = iotools.load(readfile)
                     
                     with gzip.open(readfile,mode='rt') as f:
                         header = f.readline()
@@ -125,16 +157,17 @@ def turbineOutputAverage(casename,times_to_report=None,starttime=300,
                         start_idx = np.argmin(np.abs((data[:,0]-data[0,0])
                                                      -starttime))
                     
-                    for i in range(2,data.shape[1]):
-                        data[:start_idx,i] = np.nan
-                        data[start_idx:,i] = \
-                            utils.calculate_moving_average(data[start_idx:,:],
-                                                           i,1)
+                    # All blade samples are averaged at once
+                    data[:start_idx,2:] = np.nan
+                    data[start_idx:,2:] = \
+                        utils.cumulative_average(data[start_idx:,2:],
+                                                 weights=data[start_idx:,1])
                     
-                    if (not writefile.exists() or overwrite is True):
-                        np.savetxt(writefile,data,fmt='%.11e',header=header)
+                    if not current:
+                        iotools.savetxt(writefile,data,fmt='%.11e',header=header)
+                        cache.record([writefile], fingerprint)
                     else:
-                        logger.warning(f'{writefile.name} already exists. '
+                        logger.warning(f'{writefile.name} is up to date. '
                                        f'Not overwriting.')
                     
                     if times_to_report is not None:
@@ -168,10 +201,13 @@ if __name__ == '__main__':
     
     parser.add_argument("-t", "--times", help="What times to report",
                         nargs='*', type=int)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
     for casename in args.cases:
-        turbineOutputAverage(casename, args.times)
+        turbineOutputAverage(casename, args.times, shard=args.shard)
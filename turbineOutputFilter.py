@@ -6,19 +6,24 @@ logger = logging.getLogger(__name__)
 
 import argparse
 
-import numpy as np
-import scipy.signal as sig
-
 import constants as const
 import utils
+import iotools
+import cache
 
 
 ################################################################################
 
 def turbineOutputFilter(casename, N=1000, blade_samples_to_keep = [27],
-                        quantities_to_keep=['powerRotor'], overwrite=True):
+                        quantities_to_keep=['powerRotor'], overwrite=True,
+                        max_memory=None, shard=None):
     """Filters turbineOutput to create a smooth plot for publishing.
-    Uses a gaussian filter with width N and standard deviation N/10.
+    Uses a gaussian filter with width N and standard deviation N/10, applied
+    to all kept columns of a file at once by overlap-add FFT convolution.
+    Blade quantities are filtered for every turbine and blade, keeping
+    blade_samples_to_keep (all samples if None). If max_memory (bytes) is
+    given, files are streamed in blocks of rows which fit within it. If shard
+    (i, N) is given, only the files of that shard are filtered.
     
     Written for python 3.12, SOWFA 2.4.x for sowfatools
     Jeffrey Johnston    NotDrJeff@gmail.com   June 2024.
@@ -43,7 +48,7 @@ def turbineOutputFilter(casename, N=1000, blade_samples_to_keep = [27],
     writedir = casedir / const.SOWFATOOLS_DIR / 'turbineOutputFiltered'
     utils.create_directory(writedir)
     
-    quantities,turbines,_ = utils.parse_turbineOutput_files(readdir)
+    quantities,turbines,blades = utils.parse_turbineOutput_files(readdir)
     
     ############################################################################
     
@@ -52,65 +57,77 @@ def turbineOutputFilter(casename, N=1000, blade_samples_to_keep = [27],
         if quantity not in quantities:
             logger.warning(f'{quantity} has no files in {readdir}. Skipping.')
             logger.warning('')
-            return
+            continue
         
         logger.info(f'Filtering {quantity} for case {casename}')
         
-        for turbine in turbines:
+        if quantity in const.TURBINE_QUANTITIES:
+            names = [f'{quantity}_turbine{turbine}' for turbine in turbines]
+        elif quantity in const.BLADE_QUANTITIES:
+            names = [f'{quantity}_turbine{turbine}_blade{blade}'
+                     for turbine in turbines for blade in blades]
+        else:
+            logger.warning(f'{quantity} is not a turbineOutput quantity. '
+                           f'Skipping.')
+            continue
+        
+        names = utils.shard_units(
+            names, [utils.file_sizes([readdir / f'{casename}_{name}.gz'])
+                    for name in names],
+            shard, key=f'{casename}_{quantity}')
+        
+        for name in names:
             
-            writefile = (writedir
-                         /f'{casename}_{quantity}_turbine{turbine}_filtered.gz')
-            if writefile.exists() and overwrite is False:
-                logger.warning(f'{writefile.name} already exists. '
-                               f'Skippping {quantity}.')
+            writefile = writedir / f'{casename}_{name}_filtered.gz'
+            readfile = readdir / f'{casename}_{name}.gz'
+            
+            # Blade samples only change the outputs of blade quantities
+            parameters = {'N': N, 'samples': None
+                          if quantity in const.TURBINE_QUANTITIES
+                          else blade_samples_to_keep}
+            fingerprint = cache.fingerprint([readfile], parameters,
+                                            code=[__file__])
+            if cache.is_current([writefile], fingerprint) and overwrite is False:
+                logger.warning(f'{writefile.name} is up to date. '
+                               f'Skippping {name}.')
                 logger.warning('')
                 continue
             
-            header = 'time '
+            rows, columns = iotools.read_shape(readfile)
+            
+            if rows < N:
+                logger.warning(f'{readfile.name} has fewer than {N} rows. '
+                               f'Skipping {name}.')
+                continue
             
             ####################################################################
             
+            # Time and dt are kept at the centre of each filter window
             if quantity in const.TURBINE_QUANTITIES:
-                filename = (readdir
-                            / f'{casename}_{quantity}_turbine{turbine}.gz')
-                
-                logger.debug(f'Reading {filename}')
-                data = np.genfromtxt(filename)
-                
-                filterwindow = sig.windows.gaussian(N,N/10)
-                
-                filtereddata = data[(N//2):-(N//2)+1,:]
-                filtereddata[:,2] = sig.convolve(data[:,2],filterwindow,
-                                                 mode='valid')
-                filtereddata[:,2] /= sum(filterwindow)
-                
-                header += f'{quantity}'
-                
-            ####################################################################
-                
-            elif quantity in const.BLADE_QUANTITIES:
-                filename = readdir / (f'{casename}_{quantity}_'
-                                      f'turbine{turbine}_blade0.gz')
-                
-                logger.debug(f'Reading {filename}')
-                data = np.genfromtxt(filename)
-                
-                filterwindow = sig.windows.gaussian(N,N/10)
-                
-                filtereddata = data[N//2,N//2,:]
-                for i in range(2,data.shape[1]-2):
-                    filtereddata[:,i] = sig.convolve(data[:,i],filterwindow,
-                                                     mode='valid')
-                filtereddata[:,2:] /= sum(filterwindow)
-                
-                header += ' '.join([f'sample{sample} '
-                                    for sample in blade_samples_to_keep])
+                usecols = [0, 1, 2]
+                header = f'time dt {quantity}'
                 
+            else:
+                samples = (range(columns-2) if blade_samples_to_keep is None
+                           else blade_samples_to_keep)
+                usecols = [0, 1, *[sample+2 for sample in samples]]
+                header = 'time dt ' + ' '.join([f'sample{sample}'
+                                                for sample in samples])
+            
+            # Streamed blocks need space for the block, the carried rows and
+            # the FFT convolution
+            blocks = iotools.iter_load(readfile, usecols,
+                                       None if max_memory is None
+                                       else max_memory // 4)
+            filtereddata = utils.iter_gaussian_filter(blocks, N, skip=2)
+            
             ####################################################################
             
             logger.info(f'Writing output to {writefile}')
             logger.info('')
-            np.savetxt(writefile, filtereddata, fmt='%.11e', header=header)
+            iotools.write_blocks(writefile, filtereddata, fmt='%.11e',
+                                 header=header)
+            cache.record([writefile], fingerprint)
             
             
 ################################################################################
@@ -118,14 +135,27 @@ def turbineOutputFilter(casename, N=1000, blade_samples_to_keep = [27],
 if __name__=="__main__":
     utils.configure_root_logger(level=LEVEL)
 
-    description = """Plot turbineOutput time histories"""
+    description = """Filter turbineOutput time histories"""
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('cases', help='list of cases to perform analysis for',
                         nargs='+')
+    parser.add_argument('-q', '--quantities', help='quantities to filter',
+                        nargs='+', default=['powerRotor'])
+    parser.add_argument('-s', '--samples', help='blade samples to keep',
+                        nargs='+', type=int, default=[27])
+    parser.add_argument('-N', '--width', help='width of the gaussian filter',
+                        type=int, default=1000)
+    parser.add_argument('--max-memory', help='memory budget for streaming '
+                        'files, e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
     for casename in args.cases:
-        turbineOutputFilter(casename)
+        turbineOutputFilter(casename, args.width, args.samples,
+                            args.quantities, max_memory=args.max_memory,
+                            shard=args.shard)
@@ -12,6 +12,7 @@ import matplotlib.pyplot as plt
 
 import constants as const
 import utils
+import iotools
 
 
 ################################################################################
@@ -68,7 +69,7 @@ def turbineOutputPlotHistory(casename, overwrite=False):
                 filename = (readdir_raw
                             / f'{casename}_{quantity}_turbine{turbine}.gz')
                 logger.debug(f'Reading {filename}')
-                data = np.genfromtxt(filename)
+                data = iotools.load(filename)
                 
                 plt.plot(data[:,0], data[:,2], alpha=0.3,
                          label=f'Turbine{turbine}')
@@ -76,7 +77,7 @@ def turbineOutputPlotHistory(casename, overwrite=False):
                 filename = (readdir_avg
                             / f'{casename}_{quantity}_turbine{turbine}.gz')
                 logger.debug(f'Reading {filename}')
-                data = np.genfromtxt(filename)
+                data = iotools.load(filename)
                 
                 plt.plot(data[:,0], data[:,2],
                          label=f'Turbine{turbine} (Avg)')
@@ -85,7 +86,7 @@ def turbineOutputPlotHistory(casename, overwrite=False):
                 filename = readdir_raw / (f'{casename}_{quantity}_'
                                         f'turbine{turbine}_blade0.gz')
                 logger.debug(f'Reading {filename}')
-                data = np.genfromtxt(filename)
+                data = iotools.load(filename)
                 
                 plt.plot(data[:,0], data[:,-1], alpha=0.3,
                             label=f'Turbine{turbine},Blade0,Tip')
@@ -93,7 +94,7 @@ def turbineOutputPlotHistory(casename, overwrite=False):
                 filename = readdir_avg / (f'{casename}_{quantity}_'
                                         f'turbine{turbine}_blade0.gz')
                 logger.debug(f'Reading {filename}')
-                data = np.genfromtxt(filename)
+                data = iotools.load(filename)
                 
                 plt.plot(data[:,0], data[:,-1],
                          label=f'Turbine{turbine},Blade0,Tip (Avg)')
@@ -10,14 +10,18 @@ import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
 
 
 ################################################################################
 
 def turbineOutputReduce(casename, N=100, blade_samples_to_keep = [27],
-                        quantities_to_keep=['powerRotor'], overwrite=False):
+                        quantities_to_keep=['powerRotor'], overwrite=False,
+                        shard=None):
     """Extracts a reduced dataset from turbineOutput and averages for publishing
-    and plotting purposes
+    and plotting purposes. If shard (i, N) is given, only the turbines of that
+    shard are reduced.
     
     Written for python 3.12, SOWFA 2.4.x for sowfatools
     Jeffrey Johnston    NotDrJeff@gmail.com   June 2024.
@@ -56,50 +60,53 @@ def turbineOutputReduce(casename, N=100, blade_samples_to_keep = [27],
         
         logger.info(f'Reducing {quantity} for case {casename}')
         
+        turbine_readfiles = {}
         for turbine in turbines:
+            if quantity in const.TURBINE_QUANTITIES:
+                name = f'{quantity}_turbine{turbine}'
+            else:
+                name = f'{quantity}_turbine{turbine}_blade0'
+            turbine_readfiles[turbine] = [
+                readdirs[0] / f'{casename}_{name}.gz',
+                readdirs[1] / f'{casename}_{name}_averaged.gz']
+        
+        shard_turbines = utils.shard_units(
+            turbines, [utils.file_sizes(turbine_readfiles[turbine])
+                       for turbine in turbines],
+            shard, key=f'{casename}_{quantity}')
+        
+        for turbine in shard_turbines:
             
             writefile = (writedir
                          / f'{casename}_{quantity}_turbine{turbine}_reduced.gz')
-            if writefile.exists() and overwrite is False:
-                logger.warning(f'{writefile.name} already exists. '
+            readfiles = turbine_readfiles[turbine]
+            
+            # Blade samples only change the outputs of blade quantities
+            parameters = {'N': N, 'samples': None
+                          if quantity in const.TURBINE_QUANTITIES
+                          else blade_samples_to_keep}
+            fingerprint = cache.fingerprint(readfiles, parameters,
+                                            code=[__file__])
+            if cache.is_current([writefile], fingerprint) and overwrite is False:
+                logger.warning(f'{writefile.name} is up to date. '
                                f'Skippping {quantity}.')
                 logger.warning('')
                 continue
             
             header = 'time '
             
+            logger.debug(f'Reading {readfiles[0]}')
+            data1 = iotools.load(readfiles[0])
+            
+            logger.debug(f'Reading {readfiles[1]}')
+            data2 = iotools.load(readfiles[1])
+            
             if quantity in const.TURBINE_QUANTITIES:
-                filename = (readdirs[0]
-                            / f'{casename}_{quantity}_turbine{turbine}.gz')
-                
-                logger.debug(f'Reading {filename}')
-                data1 = np.genfromtxt(filename)
-                
-                filename = (readdirs[1]
-                            / (f'{casename}_{quantity}_turbine{turbine}_'
-                               f'averaged.gz'))
-                
-                logger.debug(f'Reading {filename}')
-                data2 = np.genfromtxt(filename)
-                
                 idx = [2] # which column to look up in  data1 and data2
                 cols = 3 # number of columns needed in combined array
                 header += f'{quantity} {quantity}_avg'
                 
             elif quantity in const.BLADE_QUANTITIES:
-                filename = readdirs[0] / (f'{casename}_{quantity}_'
-                                        f'turbine{turbine}_blade0.gz')
-                
-                logger.debug(f'Reading {filename}')
-                data1 = np.genfromtxt(filename)
-                
-                filename = (readdirs[1]
-                            / (f'{casename}_{quantity}_turbine{turbine}_'
-                               f'blade0_averaged.gz'))
-                
-                logger.debug(f'Reading {filename}')
-                data2 = np.genfromtxt(filename)
-                
                 # which columns to look up in  data1 and data2
                 idx = [sample+2 for sample in blade_samples_to_keep]
                 cols = len(idx) + 1 # number of columns needed in combined array
@@ -120,7 +127,8 @@ def turbineOutputReduce(casename, N=100, blade_samples_to_keep = [27],
             
             logger.info(f'Writing output to {writefile}')
             logger.info('')
-            np.savetxt(writefile, data, fmt='%.7e', header=header)
+            iotools.savetxt(writefile, data, fmt='%.7e', header=header)
+            cache.record([writefile], fingerprint)
             
             
 ################################################################################
@@ -132,10 +140,13 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('cases', help='list of cases to perform analysis for',
                         nargs='+')
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
     for casename in args.cases:
-        turbineOutputReduce(casename)
+        turbineOutputReduce(casename, shard=args.shard)
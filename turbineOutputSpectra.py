@@ -5,19 +5,74 @@ LEVEL = logging.DEBUG
 logger = logging.getLogger(__name__)
 
 import argparse
-import gzip
 
 import numpy as np
 
 import constants as const
 import utils
+import iotools
+import cache
+
+# Number of Welch segments the history is split into when no segment length is
+# given. With the default overlap of 0.5, 15 periodograms are averaged.
+SEGMENTS = 8
 
 
 ################################################################################
 
-def turbineOutputAverage(casename,blade_sample_to_report=27,overwrite=False):
-    """Reads powerRotor from sowfatools directory and calculates amplitude
-    spectra
+def _pending_files(casename, quantity, turbines, blades, readdir, writedir,
+                   parameters, overwrite):
+    """Returns (readfile, writefile, label, fingerprint) for every turbine, or
+    every turbine and blade, file of a quantity whose spectra are not up to
+    date with 'parameters'.
+    """
+    
+    if quantity in const.TURBINE_QUANTITIES:
+        names = [f'{quantity}_turbine{turbine}' for turbine in turbines]
+    elif quantity in const.BLADE_QUANTITIES:
+        names = [f'{quantity}_turbine{turbine}_blade{blade}'
+                 for turbine in turbines for blade in blades]
+    else:
+        return []
+    
+    files = []
+    for name in names:
+        readfile = readdir / f'{casename}_{name}.gz'
+        writefile = writedir / f'{casename}_{name}_spectra.gz'
+        
+        if not readfile.is_file():
+            logger.warning(f'{readfile.name} does not exist. Skipping.')
+            continue
+        
+        fingerprint = cache.fingerprint([readfile], parameters,
+                                        code=[__file__])
+        if cache.is_current([writefile], fingerprint) and overwrite is False:
+            logger.warning(f'{writefile.name} is up to date. Skippping.')
+            continue
+        
+        files.append((readfile, writefile, name.replace('_', ', '),
+                      fingerprint))
+        
+    return files
+
+
+def turbineOutputAverage(casename,blade_sample_to_report=27,overwrite=False,
+                         max_memory=None,segment=None,overlap=0.5,
+                         window='hann',bins_per_decade=None,
+                         segments=SEGMENTS,shard=None):
+    """Reads turbineOutput quantities from sowfatools directory and calculates
+    power spectral densities with Welch's method, using segments of 'segment'
+    seconds which overlap by the fraction 'overlap' and are tapered with
+    'window'. If segment is None, the history is split into 'segments'
+    segments, and segments=1 gives a single periodogram of the whole history.
+    If bins_per_decade is given, spectra are averaged over logarithmically
+    spaced frequency bins.
+    
+    Every turbine and blade file of a quantity which shares the same times is
+    transformed together. If max_memory (bytes) is given, columns are
+    processed in chunks which fit within it. If shard (i, N) is given, only
+    the quantities of that shard are transformed, keeping each quantity whole
+    so that its files are still transformed together.
     
     Written for Python 3.12, SOWFA 2.4.x for sowfatools
     Jeffrey Johnston    NotDrJeff@gmail.com    June 2024
@@ -36,8 +91,8 @@ def turbineOutputAverage(casename,blade_sample_to_report=27,overwrite=False):
     
     ############################################################################
     
-    logger.info(f'Calculating Amplitude Spectra from turbineOutput for case '
-                f'{casename}')
+    logger.info(f'Calculating Power Spectral Densities from turbineOutput for '
+                f'case {casename}')
     logger.info('')
     
     writedir = casedir / const.SOWFATOOLS_DIR / 'turbineOutputSpectra'
@@ -45,81 +100,121 @@ def turbineOutputAverage(casename,blade_sample_to_report=27,overwrite=False):
     
     quantities,turbines,blades = utils.parse_turbineOutput_files(readdir)
     
+    parameters = {'segment': segment, 'segments': segments,
+                  'overlap': overlap, 'window': window,
+                  'bins_per_decade': bins_per_decade}
+    
+    quantities = utils.shard_units(
+        sorted(quantities),
+        [utils.file_sizes(readdir.glob(f'{casename}_{quantity}_turbine*.gz'))
+         for quantity in sorted(quantities)],
+        shard, key=casename)
+    
     for quantity in quantities:
-        for turbine in turbines:
+        files = _pending_files(casename, quantity, turbines, blades, readdir,
+                               writedir, parameters, overwrite)
+        if not files:
+            continue
+        
+        # Files written over the same times are stacked into one array, so
+        # that all of their columns are transformed together
+        groups = {}
+        for file in files:
+            times = iotools.load(file[0], usecols=[0]).reshape(-1)
+            key = (times.shape[0], times[0], times[-1])
+            groups.setdefault(key, [times, []])[1].append(file)
+        
+        for times, group in groups.values():
+            rows = times.shape[0]
+            if rows < 2:
+                logger.warning(f'Too few times for {quantity}. Skipping.')
+                continue
             
-            if quantity in const.TURBINE_QUANTITIES:
-                
-                logger.info(f'{casename}, {quantity}, turbine{turbine}')
+            shapes = [iotools.read_shape(readfile)[1] - 2
+                      for readfile, *_ in group]
+            firsts = np.cumsum([0, *shapes])
+            
+            logger.info(f'{casename}, {quantity}, transforming {len(group)} '
+                        f'files with {firsts[-1]} columns together')
+            
+            data = iotools.scratch_array((rows, firsts[-1]), writedir,
+                                         max_memory)
+            for (readfile, *_), first, columns in zip(group, firsts, shapes):
+                for chunk in utils.column_chunks(range(2, columns+2), rows,
+                                                 max_memory, copies=2):
+                    logger.debug(f'Reading {readfile} columns '
+                                 f'{chunk[0]}-{chunk[-1]}')
+                    data[:, first+chunk[0]-2:first+chunk[-1]-1] = iotools.load(
+                        readfile, usecols=chunk).reshape(rows, -1)
+            
+            # SOWFA may adjust the time step, in which case the histories are
+            # resampled to uniform time steps
+            steps = np.diff(times)
+            uniform = np.allclose(steps, steps[0])
+            dt = (times[-1] - times[0]) / (rows - 1)
+            if not uniform:
+                logger.warning(f'Time step of {quantity} is not uniform. '
+                               f'Resampling to dt={dt:.5g} s.')
+            
+            if segment is None:
+                segment_rows = max(2, rows // segments)
+            else:
+                segment_rows = int(round(segment/dt))
+            
+            spectra = None
+            for chunk in utils.column_chunks(range(firsts[-1]), rows,
+                                             max_memory, copies=6):
+                values = data[:, chunk[0]:chunk[-1]+1]
+                if not uniform:
+                    _, values = utils.resample_uniform(times, values)
                 
-                writefile = writedir / (f'{casename}_{quantity}_'
-                                        f'turbine{turbine}_spectra.gz')
-                if (writefile.exists() and overwrite is False):
-                    logger.warning(f'{writefile.name} already exists. '
-                                   f'Skippping.')
-                    logger.warning('')
-                    continue
+                freq, psd = utils.welch_spectra(values, dt, segment_rows,
+                                                overlap, window)
+                del values
                 
-                readfile = (readdir
-                            / f'{casename}_{quantity}_turbine{turbine}.gz')
-                logger.debug(f'Reading {readfile}')
-                data = np.genfromtxt(readfile)
-                        
-                header = f'freq {quantity}'
+                if bins_per_decade is not None:
+                    freq, psd = utils.log_bin_spectra(freq, psd,
+                                                      bins_per_decade)
                 
-                freq = np.fft.rfftfreq(data.shape[0])
-                fft = np.abs(np.fft.rfft(data[:,2],norm='forward',axis=0))
+                if spectra is None:
+                    spectra = iotools.scratch_array((freq.shape[0],
+                                                     firsts[-1]+1),
+                                                    writedir, max_memory)
+                    spectra[:,0] = freq
                 
-                fft[1:] *= 2
-                if data.shape[0] % 2 == 0:
-                    fft[0] *=2
-                    
-                data = np.column_stack((freq,fft))
+                spectra[:, chunk[0]+1:chunk[-1]+2] = psd
+                del psd
+            
+            del data
+            
+            for (_, writefile, label, fingerprint), first, columns in zip(
+                    group, firsts, shapes):
+                if quantity in const.TURBINE_QUANTITIES:
+                    header = f'freq_Hz {quantity}'
+                    sample = 0
+                else:
+                    header = 'freq_Hz ' + ' '.join([f'{quantity}_{i}'
+                                                    for i in range(columns)])
+                    sample = min(blade_sample_to_report-1, columns-1)
                 
-                np.savetxt(writefile,data,fmt='%.12g',header=header)
+                output = spectra[:, [0, *range(first+1, first+columns+1)]]
                 
-                mean = data[0,1]
+                logger.debug(f'Saving file {writefile}')
+                iotools.write_blocks(writefile,
+                                     iotools.row_blocks(output, max_memory),
+                                     fmt='%.12g', header=header)
+                cache.record([writefile], fingerprint)
                 
-            elif quantity in const.BLADE_QUANTITIES:
-                for blade in blades:
-                    
-                    logger.info(f'{casename}, {quantity}, turbine{turbine}, '
-                                f'blade{blade}')
-                    
-                    writefile = writedir / (f'{casename}_{quantity}_'
-                                            f'turbine{turbine}_blade{blade}_'
-                                            f'spectra.gz')
-                    if (writefile.exists() and overwrite is False):
-                        logger.warning(f'{writefile.name} already exists. '
-                                    f'Skippping.')
-                        logger.warning('')
-                        continue
-                    
-                    readfile = readdir / (f'{casename}_{quantity}_'
-                                          f'turbine{turbine}_blade{blade}.gz')
-                    logger.debug(f'Reading {readfile}')
-                    data = np.genfromtxt(readfile)
-                        
-                    header = f'freq ' + ' '.join([f'{quantity}_{i}'
-                                                  for i in range(data.shape[1]-2)])
-                    
-                    freq = np.fft.rfftfreq(data.shape[0])
-                    fft = np.abs(np.fft.rfft(data[:,2:],norm='forward',axis=0))
-                    
-                    fft[1:] *= 2
-                    if data.shape[0] % 2 == 0:
-                        fft[0] *=2
-                        
-                    data = np.column_stack((freq,fft))
-                    
-                    np.savetxt(writefile,data,fmt='%.12g',header=header)
-                    
-                    mean = data[0,blade_sample_to_report]
-                        
+                # The zero frequency (mean) is not a peak, but the lowest
+                # frequency bin is
+                first_row = 1 if output[0,0] == 0 else 0
+                peak = output[first_row+np.argmax(output[first_row:,1+sample]),
+                              0]
+                logger.info(f'{label}: peak frequency is {peak:.5e} Hz')
+                del output
             
-            if 'mean' in locals():
-                logger.info(f'Mean amplitude from spectra is is {mean:.5e}')
-                logger.info('')
+            del spectra
+            logger.info('')
                 
     logger.info(f'Finished case {casename}')
     logger.info('')
@@ -129,15 +224,38 @@ def turbineOutputAverage(casename,blade_sample_to_report=27,overwrite=False):
 if __name__ == '__main__':
     utils.configure_root_logger(level=LEVEL)
 
-    description = "Calculate Running Average for turbineOutput"""
+    description = "Calculate Power Spectral Densities for turbineOutput"
     parser = argparse.ArgumentParser(description=description)
     
     parser.add_argument('cases', help='list of cases to perform analysis for',
                         nargs='+')
+    parser.add_argument('-o', '--overwrite',
+                        help='option to overwrite exisiting files',
+                        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--max-memory', help='memory budget for the spectra, '
+                        'e.g. 8G', type=utils.parse_memory)
+    parser.add_argument('--segment', help='length of Welch segments in '
+                        'seconds (default: set by --segments)', type=float)
+    parser.add_argument('--segments', help='number of Welch segments the '
+                        'history is split into when --segment is not given. '
+                        '1 uses the whole history', type=int, default=SEGMENTS)
+    parser.add_argument('--overlap', help='fraction by which segments '
+                        'overlap', type=float, default=0.5)
+    parser.add_argument('--window', help='window applied to each segment',
+                        default='hann')
+    parser.add_argument('--bins-per-decade', help='average spectra over '
+                        'logarithmic frequency bins', type=int)
+    parser.add_argument('--shard', help='only process shard i of N, e.g. '
+                        '2/8, with work split by input size',
+                        type=utils.parse_shard)
     
     args = parser.parse_args()
     
     logger.debug(f'Parsed the command line arguments: {args}')
     
     for casename in args.cases:
-        turbineOutputAverage(casename)
\ No newline at end of file
+        turbineOutputAverage(casename, overwrite=args.overwrite,
+                             max_memory=args.max_memory, segment=args.segment,
+                             overlap=args.overlap, window=args.window,
+                             bins_per_decade=args.bins_per_decade,
+                             segments=args.segments, shard=args.shard)
\ No newline at end of file
@@ -6,7 +6,9 @@ This module contains general utility functions
 """
 
 import sys
+import zlib
 import shutil
+import concurrent.futures
 from pathlib import Path
 import logging
 
@@ -14,6 +16,11 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# Increase when a change to this module alters the results of any function,
+# so that outputs written with the previous version are recalculated (see
+# cache.py)
+CODE_VERSION = 1
+
 ################################################################################
 
 def configure_root_logger(level=logging.DEBUG) -> None:
@@ -37,10 +44,25 @@ def configure_root_logger(level=logging.DEBUG) -> None:
     logger = logging.getLogger(__name__)
     logger.debug(f'__main__ logger configured for console output')
 
+def create_file_handler(filepath: Path) -> logging.FileHandler:
+    """Returns a handler which writes log records to a new file, in the
+    format used for all sowfatools log files
+    """
+    
+    file_formatter = logging.Formatter(datefmt="%d/%m/%Y %H:%M:%S",
+                                       fmt='%(levelname)-8s %(asctime)s '
+                                           '%(name)-20s - %(message)s')
+    file_handler = logging.FileHandler(filepath, mode='w')
+    file_handler.setFormatter(file_formatter)
+    
+    return file_handler
+
+
 def configure_function_logger(filepath: Path, level=logging.DEBUG) -> None:
     """Configures a logger which outputs at the desired level and above to a
     file. logger name is determined by the name of the module which imported
-    this function.
+    this function. The file handler from the previous call is removed, so
+    that each function's log only contains its own output.
     """
     
     # Format the logger from the calling module/script
@@ -48,12 +70,10 @@ def configure_function_logger(filepath: Path, level=logging.DEBUG) -> None:
     loggername = '.'.join(loggername)
     
     logger = logging.getLogger(loggername)
+    close_function_logger()
     
-    file_formatter = logging.Formatter(datefmt="%d/%m/%Y %H:%M:%S",
-                                       fmt='%(levelname)-8s %(asctime)s '
-                                           '%(name)-20s - %(message)s')
-    file_handler = logging.FileHandler(filepath, mode='w')
-    file_handler.setFormatter(file_formatter)
+    file_handler = create_file_handler(filepath)
+    file_handler.function_log = True
     
     logger.addHandler(file_handler)
     logger.setLevel(level)
@@ -65,6 +85,20 @@ def configure_function_logger(filepath: Path, level=logging.DEBUG) -> None:
     logger.debug(f'{loggername} logger configured for file {filepath}')
 
 
+def close_function_logger() -> None:
+    """Removes and closes the file handler added by configure_function_logger,
+    if any
+    """
+    
+    loggername = '.'.join(__name__.split('.')[:-1])
+    logger = logging.getLogger(loggername)
+    
+    for handler in list(logger.handlers):
+        if getattr(handler, 'function_log', False):
+            logger.removeHandler(handler)
+            handler.close()
+
+
 def create_directory(directory: Path, exist_ok=True):
     """Creates a directory with parents. If 'exist_ok' is False, then the user
     is prompted to confirm overwrite if thye directory already exists
@@ -119,86 +153,698 @@ def concatenate_files(parent_directory: Path, filename: str) -> list[str]:
     return concatenated_lines
 
 
-def remove_overlaps(data: np.ndarray, sorting_index: int) -> np.ndarray:
+def find_restarts(data: np.ndarray, sorting_index: int) -> np.ndarray:
+    """Returns the row indices at which the sorting_index column of a 2D
+    numpy array stops increasing, i.e. where a restarted run begins again at
+    an earlier (or equal) value.
+    """
+
+    return np.flatnonzero(data[1:, sorting_index] <= data[:-1, sorting_index]) + 1
+
+
+def remove_overlaps(data: np.ndarray, sorting_index: int,
+                    return_mask=False) -> np.ndarray:
     """Takes a 2D numpy array, and checks that it is sorted by the
     sorting_index column and looks for overlapping ranges. The former data is
     removed. The Later data is kept.
+
+    A row is kept only if its value is less than every value which follows it,
+    so all restart boundaries are resolved in a single pass. If return_mask is
+    True, a boolean mask of rows to keep is returned instead of the data.
     """
 
     logger.debug(f"Searching for overlaps across {data.shape[0]} records")
 
-    finished = False
-    start = 1
-    while not finished:
-        for i in range(start, data.shape[0]):
-            if data[i, sorting_index] > data[i-1, sorting_index]:
-                pass
-            else:
-                diff = data[:i, sorting_index] - data[i, sorting_index]
-                diff[diff < 0] = np.inf
-                j = np.argmin(diff)
-                data = np.delete(data, np.arange(j, i), axis=0)
-                start = j
-                break
-
-        if i == data.shape[0]-1:
-            finished = True
-            
-    logger.debug(f"{data.shape[0]} records remaining")
-    return data
+    values = data[:, sorting_index]
+
+    # Minimum of all values after each row. Final row is always kept.
+    later_min = np.empty_like(values)
+    later_min[-1:] = np.inf
+    later_min[:-1] = np.minimum.accumulate(values[:0:-1])[::-1]
+
+    keep = values < later_min
+
+    logger.debug(f"Found {find_restarts(data, sorting_index).size} restarts. "
+                 f"{np.count_nonzero(keep)} records remaining")
+
+    if return_mask:
+        return keep
 
+    return data[keep]
 
-def calculate_moving_average(data: np.ndarray, val_index = 0,
-                             weight_index = None) -> np.ndarray:
-    """Takes a 2D array and creates a moving average over column specified by
-    'val_index'. Weights can be specified by 'weight_index'
+
+def _weighted(values: np.ndarray, weights) -> tuple[np.ndarray, np.ndarray]:
+    """Returns values multiplied by weights (one per row), and the weights,
+    as float arrays. Weights default to one.
     """
-    logger.debug('Calculating moving average')
     
-    average = np.empty_like(data[:,0])
-    if weight_index is None:
-        average[0] = data[0,val_index]
-        for i in range(1,average.shape[0]):
-            average[i] = average[i-1] + data[i,val_index]
-            
-        average = average / np.arange(1,average.shape[0]+1)
+    values = np.asarray(values, dtype=float)
+    if weights is None:
+        weights = np.ones(values.shape[0])
+    weights = np.asarray(weights, dtype=float)
+    
+    if values.ndim == 1:
+        return values * weights, weights
+    
+    return values * weights[:, np.newaxis], weights
+
+
+def _continued_cumsum(values: np.ndarray, start) -> np.ndarray:
+    """Cumulative sum along the first axis, continuing from a previous total.
+    The total is summed first, so that results are identical to a single
+    cumulative sum over the whole history.
+    """
+    
+    values = np.concatenate((np.asarray(start)[np.newaxis], values))
+    return np.cumsum(values, axis=0)[1:]
+
+
+def cumulative_average(values: np.ndarray, weights=None) -> np.ndarray:
+    """Running average from the first row to each row, of a 1D array or of
+    every column of a 2D array at once. Rows may be weighted, e.g. by the time
+    step dt.
+    """
+    
+    logger.debug('Calculating cumulative average')
+    
+    weighted, weights = _weighted(values, weights)
+    if weighted.shape[0] == 0:
+        return weighted
+    
+    total = np.cumsum(weighted, axis=0)
+    weight_total = np.cumsum(weights)
+    
+    if weighted.ndim == 1:
+        return total / weight_total
+    
+    return total / weight_total[:, np.newaxis]
+
+
+def window_average(values: np.ndarray, window: int,
+                   weights=None) -> np.ndarray:
+    """Running average over the last 'window' rows (fewer for the first rows),
+    of a 1D array or of every column of a 2D array at once. Rows may be
+    weighted, e.g. by the time step dt. Calculated from differences of
+    cumulative sums.
+    """
+    
+    logger.debug(f'Calculating moving average over {window} rows')
+    
+    if window < 1:
+        raise ValueError(f'window must be at least 1, not {window}')
+    
+    weighted, weights = _weighted(values, weights)
+    if weighted.shape[0] == 0:
+        return weighted
+    
+    total = np.cumsum(weighted, axis=0)
+    weight_total = np.cumsum(weights)
+    
+    total[window:] = total[window:] - total[:-window]
+    weight_total[window:] = weight_total[window:] - weight_total[:-window]
+    
+    if weighted.ndim == 1:
+        return total / weight_total
+    
+    return total / weight_total[:, np.newaxis]
+
+
+def nearest_index(values: np.ndarray, targets) -> np.ndarray:
+    """Index of the value nearest to each target in a sorted 1D array, found by
+    binary search. Ties go to the lower index, as with
+    np.argmin(np.abs(values - target)).
+    """
+    
+    values = np.asarray(values)
+    targets = np.asarray(targets, dtype=float)
+    if values.shape[0] == 1:
+        return np.zeros(targets.shape, dtype=int)
+    
+    upper = np.clip(np.searchsorted(values, targets), 1, values.shape[0]-1)
+    lower = upper - 1
+    
+    return np.where(np.abs(values[lower] - targets)
+                    <= np.abs(values[upper] - targets), lower, upper)
+
+
+def interval_averages(values: np.ndarray, starts, ends,
+                      weights=None) -> np.ndarray:
+    """Averages of rows starts[i] to ends[i] (inclusive) of a 1D array or of
+    every column of a 2D array, for any number of intervals, which may
+    overlap. Rows may be weighted, e.g. by the time step dt.
+    
+    The rows between consecutive interval edges are summed in one pass, and a
+    cumulative sum of those sums gives the total up to every edge, so the cost
+    does not grow with the number or width of the intervals.
+    
+    Returns an array with one row per interval.
+    """
+    
+    logger.debug(f'Calculating averages over {len(starts)} intervals')
+    
+    values = np.asarray(values, dtype=float)
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int) + 1
+    if weights is None:
+        weights = np.ones(values.shape[0])
+    weights = np.asarray(weights, dtype=float)
+    
+    # Non-finite values would spoil every later total, so are summed as zero
+    # and the intervals containing them are averaged directly
+    finite = np.isfinite(values)
+    if values.ndim == 2:
+        finite = np.all(finite, axis=1)
+    
+    # Totals are taken relative to the first row, to limit cancellation
+    reference = np.where(np.isfinite(values[0]), values[0], 0)
+    weighted = values - reference
+    weighted[~finite] = 0
+    weighted *= weights[:, np.newaxis] if values.ndim == 2 else weights
+    
+    edges = np.unique(np.concatenate(([0], starts, ends)))
+    inner = edges[edges < values.shape[0]]
+    
+    def edge_totals(array):
+        totals = np.zeros((edges.shape[0], *array.shape[1:]))
+        sums = np.add.reduceat(array, inner, axis=0)
+        totals[1:] = np.cumsum(sums, axis=0)[:edges.shape[0]-1]
+        return totals
+    
+    total = edge_totals(weighted)
+    weight_total = edge_totals(weights)
+    nonfinite_total = edge_totals(~finite)
+    
+    start_edges = np.searchsorted(edges, starts)
+    end_edges = np.searchsorted(edges, ends)
+    
+    interval_weights = weight_total[end_edges] - weight_total[start_edges]
+    if values.ndim == 2:
+        interval_weights = interval_weights[:, np.newaxis]
+    
+    averages = reference + ((total[end_edges] - total[start_edges])
+                            / interval_weights)
+    
+    nonfinite = nonfinite_total[end_edges] - nonfinite_total[start_edges]
+    for i in np.flatnonzero(nonfinite):
+        averages[i] = np.average(values[starts[i]:ends[i]], axis=0,
+                                 weights=weights[starts[i]:ends[i]])
+    
+    return averages
+
+
+# Rows are processed in blocks over which the decay factor stays above
+# exp(-EXPONENTIAL_BLOCK_DECAY), so that it cannot underflow
+EXPONENTIAL_BLOCK_DECAY = 50
+
+
+def exponential_average(values: np.ndarray, timescale, weights=None,
+                        initial=None) -> np.ndarray:
+    """Exponentially weighted running average, of a 1D array or of every
+    column of a 2D array at once. Each row i updates the average with
+    
+        average += (1 - exp(-weights[i]/timescale)) * (values[i] - average)
+    
+    so with weights as the time step dt, timescale is in seconds; without
+    weights, it is in rows. The average starts from the first row, or from
+    'initial' if given (e.g. the last average of a previous call).
+    
+    The recurrence is solved in closed form with cumulative sums and products
+    over blocks of rows, rather than row by row.
+    """
+    
+    logger.debug(f'Calculating exponential average with timescale {timescale}')
+    
+    values = np.asarray(values, dtype=float)
+    if weights is None:
+        weights = np.ones(values.shape[0])
+    
+    # Log of the decay factor (1 - alpha) for each row
+    log_decay = -np.asarray(weights, dtype=float) / timescale
+    
+    average = np.empty_like(values)
+    if values.shape[0] == 0:
+        return average
+    
+    if initial is None:
+        previous = values[0]
     else:
-        weight_sum = np.empty_like(data[:,0])
-        weight_sum[0] = data[0,weight_index]
-        average[0] = data[0,val_index]*data[0,weight_index]
-        for i in range(1,average.shape[0]):
-            average[i] = (average[i-1]
-                          + data[i,val_index]*data[i,weight_index])
-            weight_sum[i] = (weight_sum[i-1]
-                             + data[i,weight_index])
-            
-        average = average / weight_sum
+        previous = np.asarray(initial, dtype=float)
+    
+    decay_total = np.cumsum(log_decay)
+    start = 0
+    while start < values.shape[0]:
+        end = np.searchsorted(-decay_total,
+                              -decay_total[start] + EXPONENTIAL_BLOCK_DECAY,
+                              side='right')
+        end = max(end, start + 1)
+        
+        # decay[i] is the product of decay factors from start to i
+        decay = np.exp(np.cumsum(log_decay[start:end]))
+        alpha = -np.expm1(log_decay[start:end])
+        if values.ndim == 2:
+            decay = decay[:, np.newaxis]
+            alpha = alpha[:, np.newaxis]
+        
+        average[start:end] = decay * (previous + np.cumsum(
+            alpha * values[start:end] / decay, axis=0))
         
+        previous = average[end-1]
+        start = end
+    
     return average
 
 
-def check_tolerance(data: np.ndarray, ref: float, tolerances: tuple) -> list:
-    """Compare a list of values with prescribed percentage tolerances.
-    Find the point after which the data remains within +/- each tolerance
-    of the 'ref' value.
-    """
-    
-    in_tolerance = [False] * len(tolerances)
-    in_tolerance_idx = [None] * len(tolerances)
-    for i, tol in enumerate(tolerances):
-        for j, val in np.ndenumerate(data):
-            if (val < ref*(1-tol/100)) or (val > ref*(1+tol/100)):
-                if in_tolerance[i] is True:
-                    in_tolerance[i] = False
-                    in_tolerance_idx[i] = None
-            elif in_tolerance[i] is False:
-                in_tolerance[i] = True
-                in_tolerance_idx[i] = j[0]
-                
-        if in_tolerance[i] is False:
-            logger.warning(f"Data is never within a tolerance of +/- {tol}")
+class RunningAverage:
+    """Streaming form of cumulative_average, window_average and
+    exponential_average. Each call to update() takes the next rows of a
+    history and returns their averages, continuing from the saved state, so
+    earlier rows need not be read again. The state can be saved to and loaded
+    from a .npz file. Cumulative averages are identical to those calculated
+    from the whole history at once.
+    
+    kind is 'cumulative', 'window' (requires window, in rows) or
+    'exponential' (requires timescale).
+    """
+    
+    def __init__(self, kind='cumulative', window=None, timescale=None):
+        if kind not in ('cumulative', 'window', 'exponential'):
+            raise ValueError(f'Unknown average {kind}')
+        if kind == 'window' and window is None:
+            raise ValueError('A window average requires window')
+        if kind == 'exponential' and timescale is None:
+            raise ValueError('An exponential average requires timescale')
+        
+        self.kind = kind
+        self.window = window
+        self.timescale = timescale
+        self.rows = 0
+        
+        # Weighted totals for cumulative, recent rows for window and last
+        # average for exponential
+        self.total = None
+        self.weight_total = 0.0
+        self.recent_values = None
+        self.recent_weights = None
+        self.last = None
+    
+    def update(self, values: np.ndarray, weights=None) -> np.ndarray:
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] == 0:
+            return values
+        
+        self.rows += values.shape[0]
+        
+        if self.kind == 'cumulative':
+            weighted, weights = _weighted(values, weights)
+            if self.total is None:
+                self.total = np.zeros(weighted.shape[1:])
             
-    return in_tolerance_idx
+            total = _continued_cumsum(weighted, self.total)
+            weight_total = _continued_cumsum(weights, self.weight_total)
+            self.total = total[-1]
+            self.weight_total = weight_total[-1]
+            
+            if weighted.ndim == 2:
+                weight_total = weight_total[:, np.newaxis]
+            average = total / weight_total
+        
+        elif self.kind == 'window':
+            if weights is None:
+                weights = np.ones(values.shape[0])
+            weights = np.asarray(weights, dtype=float)
+            
+            if self.recent_values is not None:
+                values = np.concatenate((self.recent_values, values))
+                weights = np.concatenate((self.recent_weights, weights))
+            history = 0 if self.recent_values is None \
+                      else self.recent_values.shape[0]
+            
+            average = window_average(values, self.window, weights)[history:]
+            
+            self.recent_values = values[-(self.window-1):] \
+                                 if self.window > 1 else values[:0]
+            self.recent_weights = weights[-(self.window-1):] \
+                                  if self.window > 1 else weights[:0]
+        
+        else:
+            average = exponential_average(values, self.timescale, weights,
+                                          initial=self.last)
+            self.last = average[-1]
+        
+        return average
+    
+    def save(self, filepath: Path) -> None:
+        """Saves the state to a .npz file"""
+        
+        state = {'kind': self.kind, 'rows': self.rows,
+                 'weight_total': self.weight_total}
+        for name in ('window', 'timescale', 'total', 'recent_values',
+                     'recent_weights', 'last'):
+            if getattr(self, name) is not None:
+                state[name] = getattr(self, name)
+        
+        with open(filepath, mode='wb') as f:
+            np.savez(f, **state)
+    
+    @classmethod
+    def load(cls, filepath: Path):
+        """Creates a RunningAverage from a state saved with save()"""
+        
+        with np.load(filepath) as state:
+            state = {name: state[name] for name in state.files}
+        
+        running_average = cls(str(state.pop('kind')),
+                              state.pop('window', None),
+                              state.pop('timescale', None))
+        
+        running_average.rows = int(state.pop('rows'))
+        running_average.weight_total = state.pop('weight_total')[()]
+        for name, value in state.items():
+            setattr(running_average, name, value)
+        
+        if running_average.window is not None:
+            running_average.window = int(running_average.window)
+        if running_average.timescale is not None:
+            running_average.timescale = float(running_average.timescale)
+        
+        return running_average
+
+
+# Rows per block when searching for convergence
+CONVERGENCE_BLOCK = 4096
+
+
+def convergence_indices(data: np.ndarray, tolerances, ref=None) -> np.ndarray:
+    """Finds the index after which each series remains within +/- each
+    percentage tolerance of a reference value, which defaults to the last
+    value of the series. data is a 1D series or a 2D array with one series per
+    column, e.g. running averages of several turbines or quantities.
+    
+    Returns an integer array of shape (tolerances,) for a 1D series or
+    (columns, tolerances), with -1 where the last value is outside the band.
+    
+    The maximum and minimum of each block of rows are accumulated in reverse,
+    so "anything outside from here on" becomes a sorted condition on blocks
+    that is found for every tolerance by binary search. Only the block holding
+    the last value outside each band is then compared value by value.
+    """
+    
+    logger.debug(f'Checking convergence within tolerances {tolerances}')
+    
+    data = np.asarray(data, dtype=float)
+    series = data.reshape(data.shape[0], -1)
+    tolerances = np.atleast_1d(np.asarray(tolerances, dtype=float))
+    rows = series.shape[0]
+    
+    if ref is None:
+        ref = series[-1]
+    ref = np.broadcast_to(np.asarray(ref, dtype=float), series.shape[1:])
+    
+    # NaNs are never outside a tolerance, so are ignored by fmax and fmin
+    full = rows // CONVERGENCE_BLOCK * CONVERGENCE_BLOCK
+    blocks = series[:full].reshape(-1, CONVERGENCE_BLOCK, series.shape[1])
+    block_max = np.fmax.reduce(blocks, axis=1)
+    block_min = np.fmin.reduce(blocks, axis=1)
+    if full < rows:
+        block_max = np.vstack((block_max, np.fmax.reduce(series[full:])))
+        block_min = np.vstack((block_min, np.fmin.reduce(series[full:])))
+    
+    # Non-increasing and non-decreasing from each block to the end
+    suffix_max = np.fmax.accumulate(block_max[::-1], axis=0)[::-1]
+    suffix_min = np.fmin.accumulate(block_min[::-1], axis=0)[::-1]
+    
+    indices = np.empty((series.shape[1], tolerances.shape[0]), dtype=int)
+    for i in range(series.shape[1]):
+        lower = ref[i]*(1-tolerances/100)
+        upper = ref[i]*(1+tolerances/100)
+        
+        # First block after which nothing is outside
+        below_upper = np.searchsorted(-suffix_max[:,i], -upper, side='left')
+        above_lower = np.searchsorted(suffix_min[:,i], lower, side='left')
+        
+        # Nothing is outside a NaN bound
+        below_upper[np.isnan(upper)] = 0
+        above_lower[np.isnan(lower)] = 0
+        first_blocks = np.maximum(below_upper, above_lower)
+        
+        for j, block in enumerate(first_blocks):
+            if block == 0:
+                indices[i,j] = 0
+                continue
+            
+            start = (block-1) * CONVERGENCE_BLOCK
+            values = series[start:start+CONVERGENCE_BLOCK, i]
+            outside = (values < lower[j]) | (values > upper[j])
+            indices[i,j] = start + values.shape[0] - np.argmax(outside[::-1])
+    
+    indices[indices == rows] = -1
+    
+    if data.ndim == 1:
+        return indices[0]
+    
+    return indices
+
+
+def convergence_report(times: np.ndarray, indices: np.ndarray, tolerances,
+                       names=None, quantity='Data') -> list[str]:
+    """Logs and returns one line per series and tolerance stating the time
+    after which the series remained within the tolerance, using indices from
+    convergence_indices.
+    """
+    
+    indices = np.atleast_2d(indices)
+    if names is None:
+        names = [''] * indices.shape[0] if indices.shape[0] == 1 \
+                else [f'column {i}' for i in range(indices.shape[0])]
+    
+    lines = []
+    for name, series_indices in zip(names, indices):
+        label = f'{quantity} {name}'.strip()
+        for tolerance, idx in zip(tolerances, series_indices):
+            if idx < 0:
+                line = f'{label} is never within a tolerance of +/- {tolerance}%'
+                logger.warning(line)
+            else:
+                line = (f'{label} is converged within {tolerance}% after '
+                        f'{times[idx]} s')
+                logger.info(line)
+            
+            lines.append(line)
+    
+    return lines
+
+
+def resample_uniform(times: np.ndarray, values: np.ndarray,
+                     samples=None) -> tuple[np.ndarray, np.ndarray]:
+    """Linearly interpolates a 1D array, or every column of a 2D array at once,
+    from sorted 'times' onto 'samples' uniformly spaced times between the
+    first and last. samples defaults to the number of rows. Returns the
+    uniform times and the resampled values.
+    """
+    
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if samples is None:
+        samples = times.shape[0]
+    
+    uniform = np.linspace(times[0], times[-1], samples)
+    if times.shape[0] == 1:
+        return uniform, np.repeat(values, samples, axis=0)
+    
+    lower = np.clip(np.searchsorted(times, uniform, side='right') - 1,
+                    0, times.shape[0]-2)
+    fraction = (uniform - times[lower]) / (times[lower+1] - times[lower])
+    if values.ndim == 2:
+        fraction = fraction[:, np.newaxis]
+    
+    resampled = values[lower] + fraction * (values[lower+1] - values[lower])
+    
+    return uniform, resampled
+
+
+def autocorrelation(values: np.ndarray) -> np.ndarray:
+    """Unbiased, normalised autocorrelation of a 1D array, or of every column
+    of a 2D array at once, for every lag from zero to one less than the
+    number of rows. Values should be fluctuations about the mean, uniformly
+    spaced in time.
+    
+    Calculated from zero-padded FFTs, rather than np.correlate, which is
+    O(n^2).
+    """
+    
+    import scipy.fft
+    
+    values = np.asarray(values, dtype=float)
+    rows = values.shape[0]
+    
+    # Padding to at least twice the length avoids circular correlation
+    size = scipy.fft.next_fast_len(2*rows - 1, real=True)
+    spectrum = scipy.fft.rfft(values, n=size, axis=0)
+    power = spectrum.real**2 + spectrum.imag**2
+    del spectrum
+    
+    correlation = scipy.fft.irfft(power, n=size, axis=0)[:rows]
+    del power
+    
+    lags = rows - np.arange(rows)
+    if values.ndim == 2:
+        lags = lags[:, np.newaxis]
+    correlation /= lags
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return correlation / correlation[0]
+
+
+def welch_spectra(values: np.ndarray, dt: float, segment=None, overlap=0.5,
+                  window='hann') -> tuple[np.ndarray, np.ndarray]:
+    """One-sided power spectral density of a 1D array, or of every column of a
+    2D array at once, sampled every dt seconds. The history is split into
+    segments of 'segment' rows (the whole history if None) which overlap by
+    the fraction 'overlap'. Each segment has its mean removed and is tapered
+    with 'window' (any name accepted by scipy.signal.get_window) before the
+    periodograms of all segments and columns are calculated in one
+    multi-threaded FFT and averaged, as in scipy.signal.welch.
+    
+    Returns the frequencies in Hz and the spectra, one row per frequency.
+    """
+    
+    import scipy.fft
+    import scipy.signal
+    
+    values = np.asarray(values, dtype=float)
+    rows = values.shape[0]
+    
+    if segment is None or segment > rows:
+        segment = rows
+    step = max(1, int(round(segment * (1 - overlap))))
+    starts = np.arange(0, rows - segment + 1, step)
+    
+    taper = scipy.signal.get_window(window, segment)
+    if values.ndim == 2:
+        taper = taper[:, np.newaxis]
+    
+    # Segments are copied into one (segment, row, column) array
+    segments = values[starts[:, np.newaxis] + np.arange(segment)]
+    segments -= np.mean(segments, axis=1, keepdims=True)
+    segments *= taper
+    
+    spectra = scipy.fft.rfft(segments, axis=1, workers=-1)
+    del segments
+    
+    power = np.mean(spectra.real**2 + spectra.imag**2, axis=0)
+    del spectra
+    
+    # Density scaling, with both sides of the spectrum except zero frequency
+    # and, for even segments, the Nyquist frequency
+    power /= np.sum(taper**2) / dt
+    if segment % 2 == 0:
+        power[1:-1] *= 2
+    else:
+        power[1:] *= 2
+    
+    return np.fft.rfftfreq(segment, dt), power
+
+
+def log_bin_spectra(frequencies: np.ndarray, spectra: np.ndarray,
+                    bins_per_decade: int) -> tuple[np.ndarray, np.ndarray]:
+    """Averages spectra (one row per frequency) over logarithmically spaced
+    frequency bins, 'bins_per_decade' per decade. Zero frequency and empty
+    bins are dropped. Returns the mean frequency of each bin and the binned
+    spectra.
+    """
+    
+    positive = frequencies > 0
+    frequencies = frequencies[positive]
+    spectra = spectra[positive]
+    
+    bins = np.floor(np.log10(frequencies) * bins_per_decade).astype(int)
+    
+    # Frequencies are sorted, so each bin is a contiguous run of rows
+    starts = np.flatnonzero(np.diff(bins, prepend=bins[0]-1))
+    counts = np.diff(np.append(starts, bins.shape[0]))
+    
+    binned_frequencies = np.add.reduceat(frequencies, starts) / counts
+    if spectra.ndim == 2:
+        counts = counts[:, np.newaxis]
+    binned_spectra = np.add.reduceat(spectra, starts, axis=0) / counts
+    
+    return binned_frequencies, binned_spectra
+
+
+def gaussian_filter(values: np.ndarray, window: int, std=None,
+                    skip=0) -> np.ndarray:
+    """Convolves every column of a 2D array at once with a normalised Gaussian
+    of 'window' points and standard deviation std (window/10 by default), by
+    overlap-add FFT convolution. Only windows which lie entirely within the
+    data are kept, so rows-window+1 rows are returned. The first 'skip'
+    columns, e.g. times, are not filtered but taken from the row at the centre
+    of each window.
+    """
+    
+    import scipy.signal
+    
+    if std is None:
+        std = window / 10
+    
+    kernel = scipy.signal.windows.gaussian(window, std)
+    kernel /= np.sum(kernel)
+    
+    rows = values.shape[0] - window + 1
+    if rows < 1:
+        return np.empty((0, values.shape[1]))
+    
+    filtered = np.empty((rows, values.shape[1]))
+    filtered[:,:skip] = values[window//2:window//2+rows, :skip]
+    if values.shape[1] > skip:
+        filtered[:,skip:] = scipy.signal.oaconvolve(values[:,skip:],
+                                                    kernel[:, np.newaxis],
+                                                    mode='valid', axes=0)
+    
+    return filtered
+
+
+def iter_gaussian_filter(blocks, window: int, std=None, skip=0):
+    """Generator which applies gaussian_filter to a stream of 2D blocks of
+    rows, e.g. from iotools.iter_load, as if they were one array. The last
+    window-1 rows of each block are carried over to the next.
+    """
+    
+    history = None
+    for block in blocks:
+        if history is not None:
+            block = np.concatenate((history, block))
+        
+        if block.shape[0] >= window:
+            yield gaussian_filter(block, window, std, skip)
+            history = block[block.shape[0]-window+1:]
+        else:
+            history = block
+
+
+def integral_timescale(correlation: np.ndarray, dt: float) -> np.ndarray:
+    """Integrates a normalised autocorrelation (one column per series) with
+    the trapezoidal rule from zero lag to the first lag at which it is zero
+    or negative, or to the last lag if it stays positive.
+    """
+    
+    correlation = np.asarray(correlation, dtype=float)
+    series = correlation.reshape(correlation.shape[0], -1)
+    
+    # First lag at which each series is zero or less
+    crossing = series <= 0
+    first = np.where(np.any(crossing, axis=0), np.argmax(crossing, axis=0),
+                     series.shape[0])
+    
+    areas = (series[1:] + series[:-1]) / 2 * dt
+    cumulative = np.vstack((np.zeros((1, series.shape[1])),
+                            np.cumsum(areas, axis=0)))
+    
+    integral = cumulative[np.maximum(first-1, 0), np.arange(series.shape[1])]
+    
+    if correlation.ndim == 1:
+        return integral[0]
+    
+    return integral
 
 
 def parse_turbineOutput_files(readdir):
@@ -206,7 +852,16 @@ def parse_turbineOutput_files(readdir):
     names, turbines and blades
     """
     
-    files = list(readdir.iterdir())
+    import iotools # imports utils
+    
+    # Listed from the case manifest, with readdir under the case directory
+    casedir = readdir.parent.parent
+    manifest = iotools.scan_directory(casedir, readdir.relative_to(casedir),
+                                      time_folders=False, read_headers=False)
+    
+    # Binary sidecars share the same names, so only text files are parsed
+    files = [Path(filename) for filename in manifest['files']
+             if filename.endswith('.gz')]
     
     filenames_parsed = [''] * len(files)
     for i,file in enumerate(files):
@@ -235,6 +890,156 @@ def parse_turbineOutput_files(readdir):
     return quantities, turbines, blades
 
 
+def parse_memory(size: str) -> int:
+    """Converts a memory size such as '8G', '512M' or '1024' (bytes) to a
+    number of bytes. Suffixes K, M, G and T are powers of 1024.
+    """
+    
+    suffixes = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    
+    size = str(size).strip().upper().removesuffix('B')
+    multiplier = 1
+    if size and size[-1] in suffixes:
+        multiplier = suffixes[size[-1]]
+        size = size[:-1]
+    
+    try:
+        return int(float(size) * multiplier)
+    except ValueError:
+        raise ValueError(f'Cannot interpret memory size {size!r}') from None
+
+
+def column_chunks(columns, rows: int, max_memory=None,
+                  copies=1) -> list:
+    """Splits a list of column indices into chunks, such that 'copies' float64
+    arrays of shape (rows, chunk) fit within max_memory bytes. Returns a
+    single chunk if max_memory is None.
+    """
+    
+    columns = list(columns)
+    if max_memory is None or not columns:
+        return [columns]
+    
+    chunk = max(1, int(max_memory // (8 * copies * max(rows, 1))))
+    logger.debug(f'Processing {len(columns)} columns in chunks of {chunk}')
+    
+    return [columns[i:i+chunk] for i in range(0, len(columns), chunk)]
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Converts a shard such as '2/8' to (2, 8), for splitting work between N
+    independent jobs numbered from 1 to N
+    """
+    
+    try:
+        index, count = (int(part) for part in str(shard).split('/'))
+    except ValueError:
+        raise ValueError(f'Cannot interpret shard {shard!r}') from None
+    
+    if not 1 <= index <= count:
+        raise ValueError(f'Shard {shard!r} must be between 1/{count} and '
+                         f'{count}/{count}')
+    
+    return index, count
+
+
+def shard_units(units, sizes, shard=None, key='') -> list:
+    """Returns the units of work (e.g. cases, quantities or turbine and blade
+    files) belonging to 'shard' (i, N), in their original order, or every
+    unit if shard is None.
+    
+    Every job computes the same partition without coordinating. Units are
+    assigned largest first, by 'sizes' (e.g. input bytes), to the shard with
+    the least work so far. 'key' (e.g. the case name) rotates which shard
+    receives the largest unit, so that shards stay balanced when each case is
+    partitioned separately.
+    """
+    
+    units = list(units)
+    if shard is None:
+        return units
+    
+    index, count = shard
+    offset = zlib.crc32(str(key).encode()) % count
+    loads = [0] * count
+    
+    # Ties are broken by name, so the order of 'units' does not matter
+    order = sorted(range(len(units)), key=lambda i: (-sizes[i], str(units[i])))
+    
+    selected = []
+    for i in order:
+        target = min(range(count),
+                     key=lambda j: (loads[j], (j - offset) % count))
+        loads[target] += sizes[i]
+        if target == index - 1:
+            selected.append(i)
+    
+    logger.debug(f'Shard {index}/{count} has {len(selected)} of {len(units)} '
+                 f'units')
+    
+    return [units[i] for i in sorted(selected)]
+
+
+def file_sizes(filepaths) -> int:
+    """Returns the total size in bytes of those of filepaths which exist"""
+    
+    return sum(Path(filepath).stat().st_size for filepath in filepaths
+               if Path(filepath).is_file())
+
+
+def run_tasks(function, tasks: list[tuple], sizes, workers=1, max_memory=None,
+              expansion=1.0) -> list:
+    """Calls function(*task) for every task, on 'workers' processes if more
+    than one. Tasks are started largest first, where the memory used by each
+    is estimated as its size (e.g. input file bytes) times 'expansion', and a
+    task is only started while the estimates of all running tasks fit within
+    max_memory bytes. At least one task always runs. Returns the results in
+    the order of 'tasks'. The first exception raised by a task is re-raised
+    once running tasks have finished.
+    """
+    
+    order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
+    estimates = [size * expansion for size in sizes]
+    results = [None] * len(tasks)
+    
+    if workers == 1 or len(tasks) < 2:
+        for i in order:
+            results[i] = function(*tasks[i])
+        return results
+    
+    logger.debug(f'Running {len(tasks)} tasks on {workers} workers')
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        error = None
+        
+        while (order and error is None) or running:
+            # Start the largest remaining tasks which fit within max_memory
+            while order and error is None and len(running) < workers:
+                memory = sum(estimates[i] for i in running.values())
+                i = next((i for i in order
+                          if max_memory is None or not running
+                          or memory + estimates[i] <= max_memory), None)
+                if i is None:
+                    break
+                order.remove(i)
+                running[executor.submit(function, *tasks[i])] = i
+            
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    results[i] = future.result()
+                except Exception as exception:
+                    error = error or exception
+    
+    if error is not None:
+        raise error
+    
+    return results
+
+
 def get_time_idx(data, times_to_report):
     return [np.argmin(np.abs((data[:,0]-time))) for time in times_to_report]
 